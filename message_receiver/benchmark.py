@@ -0,0 +1,357 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+import unittest
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from dice import calculate, clear_compile_cache
+from random_source import BufferedRandomSource
+from skill import pass_skill_value_expression, calculate_skill_roll_expression
+from codec import CODECS
+from skill_template import COC7
+from user import CharacterInfo, UserInfo
+
+# 实际游戏中常见的普通投掷
+SIMPLE_ROLLS = ["d", "d20", "3d6", "1d100", "2d6+6", "3d6*5", "(2d6+6)*5", "1d100+1d10", "1d3+1d4"]
+# 嵌套与计算得出参数的投掷
+NESTED_ROLLS = ["(2d4)d6", "2d2d2", "3d(2+4)", "1d(1d6)", "(1d4+1)d(2d6)"]
+# 大量骰子的投掷
+LARGE_ROLLS = ["1000d6", "100000d6", "500d100", "1000d1000"]
+
+# 完整的 CoC 7版角色卡（属性 + 技能，共 70 余项）
+SKILL_SHEET = (
+    "力量50敏捷60意志55体质45外貌70教育80体型60智力75幸运50理智55魔法11体力10"
+    "会计5人类学1估价5考古学1取悦15攀爬20计算机使用5信用评级30克苏鲁神话0乔装5闪避30"
+    "汽车驾驶20电气维修10电子学1话术5斗殴25手枪20急救30历史5恐吓15跳跃20母语80"
+    "法律5图书馆使用60聆听50锁匠1机械维修10医学1博物学10领航10神秘学5操作重型机械1"
+    "说服10精神分析1心理学10骑术5妙手10侦查60潜行20生存10游泳20投掷20追踪10"
+    "驯兽5潜水1爆破1读唇1催眠1炮术1步枪25霰弹枪25弓10剑20斧15链锯10"
+    "英语20日语1拉丁语1摄影5艺术5表演5木匠10厨艺5书法5"
+)
+# 带骰子表达式的角色卡片段
+SKILL_SHEET_WITH_DICE = "力量3d6*5敏捷3d6*5意志3d6*5体质3d6*5外貌3d6*5教育(2d6+6)*5体型(2d6+6)*5智力(2d6+6)*5幸运3d6*5"
+# 技能检定表达式
+SKILL_ROLLS = ["侦查", "聆听", "图书馆使用", "斗殴", "潜行60", "力量", "不存在的技能", "心理学1d100"]
+
+
+@dataclass
+class BenchmarkCase:
+    """
+    单个基准测试用例，function 每次调用执行一轮完整的操作
+    """
+    name: str
+    function: Callable[[], object]
+    # 附加说明，输出在结果行末尾
+    info: str = ""
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    # 每秒执行轮数
+    ops_per_sec: float
+    # 单轮执行期间的内存分配峰值（字节）
+    peak_bytes: int
+    # 每轮分配的内存块数（保留返回值，不含轮内已释放的临时对象）
+    allocations: float
+    # 每轮分配的字节数
+    allocated_bytes: float
+
+
+def _cycle(values: List[str]) -> Callable[[], str]:
+    # 依次循环返回语料中的表达式
+    state = {"index": 0}
+
+    def next_value() -> str:
+        value = values[state["index"] % len(values)]
+        state["index"] += 1
+        return value
+
+    return next_value
+
+
+def _roll_with_details(expression: str, rng=None) -> list:
+    # 返回投掷详情，使其分配计入每次调用的分配块数
+    details: list = []
+    calculate(expression, details, rng=rng)
+    return details
+
+
+def dice_cases() -> List[BenchmarkCase]:
+    cases: List[BenchmarkCase] = []
+    for group_name, corpus in [("simple", SIMPLE_ROLLS), ("nested", NESTED_ROLLS)]:
+        next_expression = _cycle(corpus)
+        cases.append(BenchmarkCase(f"dice.calculate/{group_name}", lambda n=next_expression: calculate(n())))
+        cases.append(BenchmarkCase(f"dice.calculate/{group_name}/details",
+                                   lambda n=next_expression: _roll_with_details(n())))
+
+    def cold() -> None:
+        clear_compile_cache()
+        for expression in SIMPLE_ROLLS:
+            calculate(expression)
+
+    cases.append(BenchmarkCase("dice.calculate/simple/cold-cache", cold))
+    buffered = BufferedRandomSource()
+    next_buffered = _cycle(SIMPLE_ROLLS)
+    cases.append(BenchmarkCase("dice.calculate/simple/buffered-rng",
+                               lambda: _roll_with_details(next_buffered(), rng=buffered)))
+    for expression in LARGE_ROLLS:
+        cases.append(BenchmarkCase(f"dice.calculate/large/{expression}", lambda e=expression: _roll_with_details(e)))
+    return cases
+
+
+def skill_cases() -> List[BenchmarkCase]:
+    character = CharacterInfo("benchmark")
+    for skill_name, skill_value in pass_skill_value_expression(SKILL_SHEET).items():
+        character.set_skill_value(skill_name, skill_value)
+    next_roll = _cycle(SKILL_ROLLS)
+    return [
+        BenchmarkCase("skill.pass_skill_value_expression/sheet",
+                      lambda: pass_skill_value_expression(SKILL_SHEET)),
+        BenchmarkCase("skill.pass_skill_value_expression/dice-sheet",
+                      lambda: pass_skill_value_expression(SKILL_SHEET_WITH_DICE)),
+        BenchmarkCase("skill.calculate_skill_roll_expression",
+                      lambda: calculate_skill_roll_expression(next_roll(), character)),
+    ]
+
+
+def sample_user() -> dict:
+    """
+    生成一个有两个完整角色卡的典型用户数据
+    """
+    user = UserInfo(10000, "benchmark")
+    for name in ["调查员甲", "调查员乙"]:
+        user.set_current_character(name)
+        character = user.get_current_character_info()
+        for skill_name, skill_value in pass_skill_value_expression(SKILL_SHEET).items():
+            character.set_skill_value(skill_name, skill_value)
+    return user.to_dict()
+
+
+def codec_cases() -> List[BenchmarkCase]:
+    data = sample_user()
+    cases: List[BenchmarkCase] = []
+    for codec in CODECS.values():
+        raw = codec.encode(data)
+        info = f"{len(raw)}B/用户"
+        cases.append(BenchmarkCase(f"codec.encode/{codec.name}", lambda c=codec: c.encode(data), info))
+        cases.append(BenchmarkCase(f"codec.decode/{codec.name}", lambda c=codec, r=raw: c.decode(r), info))
+    return cases
+
+
+def measure_user_footprint(data: dict, count: int = 1000) -> float:
+    """
+    测量缓存中每个用户实际占用的内存（字节）
+
+    Args:
+        data: 用户数据
+        count: 构造的用户数量
+
+    Returns:
+        float: 平均每个用户占用的字节数
+    """
+    raw = CODECS["json"].encode(data)
+    tracemalloc.start()
+    try:
+        users = []
+        for user_id in range(count):
+            user = UserInfo(user_id, "benchmark")
+            user.load_dict(CODECS["json"].decode(raw))
+            users.append(user)
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current / count
+
+
+def memory_cases() -> List[BenchmarkCase]:
+    cases: List[BenchmarkCase] = []
+    templated = UserInfo(10001, "benchmark")
+    templated.set_current_character("调查员")
+    character = templated.get_current_character_info()
+    character.set_template(COC7)
+    for skill_name, skill_value in pass_skill_value_expression(SKILL_SHEET).items():
+        character.set_skill_value(skill_name, skill_value)
+    for name, data in [("two-sheets", sample_user()), ("coc7-template", templated.to_dict())]:
+        raw = CODECS["json"].encode(data)
+
+        def load(r=raw) -> UserInfo:
+            user = UserInfo(10000, "benchmark")
+            user.load_dict(CODECS["json"].decode(r))
+            return user
+
+        cases.append(BenchmarkCase(f"user.load_dict/{name}", load, f"{measure_user_footprint(data):.0f}B/用户"))
+    return cases
+
+
+# 所有基准测试套件
+SUITES: dict[str, Callable[[], List[BenchmarkCase]]] = {
+    "dice": dice_cases,
+    "skill": skill_cases,
+    "codec": codec_cases,
+    "memory": memory_cases,
+}
+
+
+# 统计内存分配时的调用次数上限
+ALLOCATION_ITERATIONS = 1000
+
+
+def measure(case: BenchmarkCase, min_time: float = 0.2, repeat: int = 5) -> BenchmarkResult:
+    """
+    测量用例的吞吐量与内存分配
+    分配块数与字节数来自多次调用前后 tracemalloc 快照的差值，保留每次调用的返回值，按调用次数平均；
+    调用内部已释放的临时对象体现在内存峰值中
+
+    Args:
+        case: 基准测试用例
+        min_time: 每轮计时的最短时长（秒）
+        repeat: 计时轮数，取最快的一轮
+
+    Returns:
+        BenchmarkResult: 测量结果
+    """
+    function = case.function
+    # 预热，同时确定每轮的调用次数，使每轮耗时约为 min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 4:
+            break
+        number *= 2
+    number = max(1, int(number * min_time / elapsed))
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    try:
+        function()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+
+        # 比较多次调用前后的快照，保留每次的返回值使其分配计入统计，再按调用次数平均
+        iterations = min(number, ALLOCATION_ITERATIONS)
+        keep: List[object] = [None] * iterations
+        before = tracemalloc.take_snapshot()
+        for i in range(iterations):
+            keep[i] = function()
+        after = tracemalloc.take_snapshot()
+        differences = after.compare_to(before, "filename")
+        del keep
+    finally:
+        tracemalloc.stop()
+    allocations = sum(difference.count_diff for difference in differences) / iterations
+    allocated_bytes = sum(difference.size_diff for difference in differences) / iterations
+    return BenchmarkResult(case.name, 1 / best, peak - current, max(allocations, 0.0), max(allocated_bytes, 0.0))
+
+
+def compare_results(results: List[BenchmarkResult], baseline: dict[str, dict], tolerance: float) -> List[str]:
+    """
+    与基线比较，返回退化的用例描述
+
+    Args:
+        results: 本次测量结果
+        baseline: 基线数据，键为用例名
+        tolerance: 允许的相对退化比例
+
+    Returns:
+        List[str]: 退化描述，为空表示没有退化
+    """
+    regressions: List[str] = []
+    for result in results:
+        if result.name not in baseline:
+            continue
+        base = baseline[result.name]
+        if result.ops_per_sec < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{result.name}: 吞吐量 {result.ops_per_sec:.0f}/s 低于基线 {base['ops_per_sec']:.0f}/s")
+        if result.peak_bytes > base["peak_bytes"] * (1 + tolerance) + 1024:
+            regressions.append(f"{result.name}: 内存峰值 {result.peak_bytes}B 高于基线 {base['peak_bytes']}B")
+        # 旧版基线没有分配次数
+        if "allocations" in base and result.allocations > base["allocations"] * (1 + tolerance) + 1:
+            regressions.append(f"{result.name}: 每次分配 {result.allocations:.1f} 块，高于基线 {base['allocations']:.1f} 块")
+    return regressions
+
+
+def run(suite_names: List[str], name_filter: Optional[str], min_time: float) -> List[BenchmarkResult]:
+    random.seed(0)
+    results: List[BenchmarkResult] = []
+    print(f"{'用例':<50}{'ops/s':>14}{'峰值B/次':>12}{'分配块/次':>10}{'分配B/次':>10}")
+    for suite_name in suite_names:
+        for case in SUITES[suite_name]():
+            if name_filter and name_filter not in case.name:
+                continue
+            result = measure(case, min_time)
+            results.append(result)
+            print(f"{result.name:<50}{result.ops_per_sec:>14.0f}{result.peak_bytes:>12}{result.allocations:>10.1f}"
+                  f"{result.allocated_bytes:>10.0f}  {case.info}".rstrip())
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="骰子、技能解析、序列化与内存占用的性能基准测试")
+    parser.add_argument("suites", nargs="*", help=f"要运行的套件（{', '.join(SUITES)}），默认全部运行")
+    parser.add_argument("-k", "--filter", help="只运行名称包含该字符串的用例")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮计时的最短时长（秒）")
+    parser.add_argument("--save", metavar="PATH", help="将结果保存为基线文件")
+    parser.add_argument("--compare", metavar="PATH", help="与基线文件比较，出现退化时返回非零退出码")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的相对退化比例")
+    args = parser.parse_args()
+    for suite_name in args.suites:
+        if suite_name not in SUITES:
+            parser.error(f"未知的套件: {suite_name}")
+
+    results = run(args.suites or list(SUITES.keys()), args.filter, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({result.name: {"ops_per_sec": result.ops_per_sec, "peak_bytes": result.peak_bytes,
+                                     "allocations": result.allocations}
+                       for result in results}, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.save}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print("检测到性能退化:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("未检测到性能退化")
+    return 0
+
+
+class TestCompareResults(unittest.TestCase):
+    def test_regression_detected(self):
+        """测试吞吐量、内存峰值与分配次数退化的检测"""
+        baseline = {"a": {"ops_per_sec": 1000, "peak_bytes": 10000, "allocations": 10}}
+        self.assertEqual([], compare_results([BenchmarkResult("a", 900, 10000, 10, 500)], baseline, 0.15))
+        self.assertEqual(1, len(compare_results([BenchmarkResult("a", 800, 10000, 10, 500)], baseline, 0.15)))
+        self.assertEqual(1, len(compare_results([BenchmarkResult("a", 1000, 20000, 10, 500)], baseline, 0.15)))
+        self.assertEqual(1, len(compare_results([BenchmarkResult("a", 1000, 10000, 20, 500)], baseline, 0.15)))
+        self.assertEqual([], compare_results([BenchmarkResult("b", 1, 10 ** 9, 10 ** 6, 0)], baseline, 0.15))
+
+    def test_allocations_per_call(self):
+        """测试每次调用的分配块数按调用次数平均"""
+        result = measure(BenchmarkCase("alloc", lambda: [object() for _ in range(10)]), min_time=0.001, repeat=1)
+        self.assertGreaterEqual(result.allocations, 10)
+        self.assertLess(result.allocations, 14)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
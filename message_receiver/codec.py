@@ -0,0 +1,165 @@
+import json
+import unittest
+import zlib
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """
+    用户数据的序列化格式
+    """
+    name: str
+
+    def encode(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, raw: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """
+    标准库 JSON，indent 为 None 时输出紧凑的单行 JSON
+    """
+
+    def __init__(self, name: str, indent: int or None) -> None:
+        self.name = name
+        self.indent = indent
+
+    def encode(self, data: Any) -> bytes:
+        if self.indent is None:
+            return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return json.dumps(data, ensure_ascii=False, indent=self.indent).encode('utf-8')
+
+    def decode(self, raw: bytes) -> Any:
+        return json.loads(raw.decode('utf-8'))
+
+
+class OrjsonCodec(Codec):
+    """
+    orjson 编码的紧凑 JSON，与标准库 JSON 互相兼容
+    """
+    name = "orjson"
+
+    def encode(self, data: Any) -> bytes:
+        # orjson 只接受字符串键，角色与技能的键本身都是字符串
+        return orjson.dumps(data)
+
+    def decode(self, raw: bytes) -> Any:
+        return orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+# 二进制格式的文件头
+BINARY_MAGIC = b"QQB1"
+
+
+class BinaryCodec(Codec):
+    """
+    带文件头的压缩格式：文件头 + zlib 压缩的紧凑 JSON，不依赖第三方库
+    """
+    name = "binary"
+
+    def __init__(self, level: int = 1) -> None:
+        self.level = level
+        self.inner = JsonCodec("json-compact", None)
+
+    def encode(self, data: Any) -> bytes:
+        return BINARY_MAGIC + zlib.compress(self.inner.encode(data), self.level)
+
+    def decode(self, raw: bytes) -> Any:
+        return self.inner.decode(zlib.decompress(raw[len(BINARY_MAGIC):]))
+
+
+# 所有可用的序列化格式，未安装的第三方库对应的格式不会出现
+CODECS: dict[str, Codec] = {
+    "json": JsonCodec("json", 2),
+    "json-compact": JsonCodec("json-compact", None),
+    "binary": BinaryCodec(),
+}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec()
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+_default_codec: Codec = CODECS["json"]
+
+
+def configure(name: str) -> None:
+    """
+    配置写入时使用的序列化格式，读取时总是根据内容自动识别格式
+    """
+    global _default_codec
+    if name not in CODECS:
+        raise ValueError(f"未知或未安装的序列化格式: {name}")
+    _default_codec = CODECS[name]
+
+
+def default_codec() -> Codec:
+    return _default_codec
+
+
+def detect_codec(raw: bytes) -> Codec:
+    """
+    根据内容识别序列化格式：文件头为二进制格式，以空白或 { [ 开头为 JSON，其余按 msgpack 处理
+    """
+    if raw.startswith(BINARY_MAGIC):
+        return CODECS["binary"]
+    if not raw or raw[:1] in b"{[ \t\r\n" or raw.startswith(b"\xef\xbb\xbf"):
+        return CODECS["orjson"] if "orjson" in CODECS else CODECS["json"]
+    if "msgpack" in CODECS:
+        return CODECS["msgpack"]
+    raise ValueError("无法识别的数据格式（可能需要安装 msgpack）")
+
+
+def decode(raw: bytes) -> Any:
+    """
+    自动识别格式并解码
+    """
+    if raw.startswith(b"\xef\xbb\xbf"):
+        raw = raw[3:]
+    return detect_codec(raw).decode(raw)
+
+
+class TestCodec(unittest.TestCase):
+    DATA = {"nickname": "调查员", "points": 3, "current_character_name": None,
+            "characters": {"甲": {"name": "甲", "max_hp": 12, "skills": {"侦查": 60, "聆听": 50}}}}
+
+    def test_round_trip(self):
+        """测试所有格式编码后都能自动识别并还原"""
+        for codec in CODECS.values():
+            raw = codec.encode(self.DATA)
+            self.assertEqual(self.DATA, decode(raw), codec.name)
+
+    def test_legacy_json(self):
+        """测试旧版缩进 JSON 文件能被识别"""
+        raw = json.dumps(self.DATA, ensure_ascii=False, indent=2).encode('utf-8')
+        self.assertEqual(self.DATA, decode(raw))
+        self.assertLess(len(CODECS["json-compact"].encode(self.DATA)), len(raw))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            configure("yaml")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import asyncio
+import inspect
+import time
+import unittest
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from message import TextMessage, GroupTextMessage, UserTextMessage
+from random_source import RandomSource
+from user import UserInfo, CharacterInfo
+
+# 指令的返回值：单条消息、多条消息，或 None 表示参数不符合任何子指令（按未知指令处理）
+CommandResult = Union[TextMessage, list[TextMessage], None]
+CommandHandler = Callable[['CommandContext'], Union[CommandResult, Awaitable[CommandResult]]]
+
+
+class CommandContext:
+    """
+    一次指令执行的上下文，指令名之后的参数只解析一次
+    """
+    __slots__ = ('command', 'name', 'args', 'sender_id', 'sender_nickname', 'group_id', 'user', 'rng', 'store')
+
+    def __init__(self, command: str, name: str, sender_id: int, sender_nickname: str, group_id: int or None,
+                 user: UserInfo, rng: RandomSource, store: Any = None) -> None:
+        # 完整的指令文本（不含开头的 . 或 。）
+        self.command = command
+        # 匹配到的指令名
+        self.name = name
+        # 指令名之后的参数，保留原始大小写
+        self.args = command[len(name):].strip()
+        self.sender_id = sender_id
+        self.sender_nickname = sender_nickname
+        self.group_id = group_id
+        self.user = user
+        self.rng = rng
+        # 用户信息存储，供需要读取其他用户的指令使用
+        self.store = store
+
+    @property
+    def compact_args(self) -> str:
+        """
+        去掉所有空格的参数，用于表达式类指令
+        """
+        return self.args.replace(" ", "")
+
+    @property
+    def character(self) -> CharacterInfo or None:
+        return self.user.get_current_character_info()
+
+    def ensure_character(self) -> CharacterInfo:
+        """
+        获取当前角色，没有时以用户昵称创建一个
+        """
+        character = self.user.get_current_character_info()
+        if character is None:
+            self.user.set_current_character(self.user.nickname)
+            character = self.user.get_current_character_info()
+        return character
+
+    @property
+    def today_start_ns(self) -> int:
+        # 当天0点的时间戳，以纳秒为单位
+        current_date = time.localtime()
+        today_start = time.mktime((current_date.tm_year, current_date.tm_mon, current_date.tm_mday, 0, 0, 0, 0, 0, 0))
+        return int(today_start * 1_000_000_000)
+
+    def reply(self, message: str) -> TextMessage:
+        """
+        回复到指令所在的群或私聊
+        """
+        if self.group_id is not None:
+            return GroupTextMessage(self.group_id, message)
+        return UserTextMessage(self.sender_id, message)
+
+    def private(self, message: str) -> UserTextMessage:
+        """
+        私聊回复发送者
+        """
+        return UserTextMessage(self.sender_id, message)
+
+
+class _TrieNode:
+    __slots__ = ('children', 'handler', 'exact')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode] = {}
+        self.handler: Optional[CommandHandler] = None
+        self.exact = False
+
+
+class CommandRouter:
+    """
+    指令路由，按指令名建立前缀树，取能匹配的最长指令名
+    查找只与指令名长度有关，与注册的指令数量无关
+    """
+
+    def __init__(self) -> None:
+        self.root = _TrieNode()
+        self.names: list[str] = []
+
+    def add(self, name: str, handler: CommandHandler, exact: bool = False) -> None:
+        """
+        注册指令
+
+        Args:
+            name: 指令名，不区分大小写
+            handler: 处理函数，接收 CommandContext，可以是协程函数
+            exact: 为 True 时只有整条指令恰好为指令名时才匹配，否则指令名之后的内容作为参数
+        """
+        node = self.root
+        for char in name.lower():
+            node = node.children.setdefault(char, _TrieNode())
+        if node.handler is not None:
+            raise ValueError(f"指令 {name} 已被注册")
+        node.handler = handler
+        node.exact = exact
+        self.names.append(name)
+
+    def register(self, name: str, exact: bool = False) -> Callable[[CommandHandler], CommandHandler]:
+        """
+        以装饰器形式注册指令
+        """
+        def decorator(handler: CommandHandler) -> CommandHandler:
+            self.add(name, handler, exact)
+            return handler
+
+        return decorator
+
+    def resolve(self, command: str) -> tuple[Optional[CommandHandler], str]:
+        """
+        查找指令对应的处理函数
+
+        Returns:
+            tuple: 处理函数与匹配到的指令名（保留原始大小写），没有匹配时处理函数为 None
+        """
+        node = self.root
+        handler: Optional[CommandHandler] = None
+        matched = 0
+        lower_command = command.lower()
+        for index, char in enumerate(lower_command, 1):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.handler is not None and (not node.exact or index == len(lower_command)):
+                handler = node.handler
+                matched = index
+        return handler, command[:matched]
+
+    async def dispatch(self, context_factory: Callable[[str], CommandContext], command: str) -> CommandResult:
+        """
+        查找并执行指令，context_factory 根据匹配到的指令名创建上下文
+
+        Returns:
+            CommandResult: 处理结果，没有匹配的指令或处理函数返回 None 时为 None
+        """
+        handler, name = self.resolve(command)
+        if handler is None:
+            return None
+        result = handler(context_factory(name))
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
+class TestCommandRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = CommandRouter()
+        for name in ["r", "ra", "rah", "rh", "pc", "st"]:
+            self.router.add(name, lambda context, n=name: n)
+        self.router.add("jrrp", lambda context: "jrrp", exact=True)
+
+    def test_longest_prefix(self):
+        """测试最长前缀匹配: rah 不会被 ra 或 r 抢先匹配"""
+        for command, expected in [("rah 侦查", "rah"), ("ra侦查", "ra"), ("rh", "rh"), ("r 1d6", "r"),
+                                  ("RA 聆听", "ra"), ("rd", "r"), ("st show", "st")]:
+            handler, name = self.router.resolve(command)
+            self.assertEqual(expected, handler(None), command)
+            self.assertEqual(len(expected), len(name))
+
+    def test_exact(self):
+        """测试精确匹配的指令不会把后续内容当作参数"""
+        self.assertEqual("jrrp", self.router.resolve("JRRP")[0](None))
+        self.assertIsNone(self.router.resolve("jrrpx")[0])
+        self.assertIsNone(self.router.resolve("unknown")[0])
+
+    def test_duplicate(self):
+        with self.assertRaises(ValueError):
+            self.router.add("RA", lambda context: None)
+
+    def test_dispatch(self):
+        """测试上下文的参数解析与协程处理函数"""
+        async def echo(context: CommandContext):
+            return context.args
+
+        self.router.add("echo", echo)
+        user = UserInfo(1, "a")
+
+        def factory(name: str) -> CommandContext:
+            return CommandContext("Echo  Hello World ", name, 1, "a", None, user, None)
+
+        self.assertEqual("Hello World", asyncio.run(self.router.dispatch(factory, "Echo  Hello World ")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+import logging
+import re
+import time
+from typing import List
+
+from command import CommandRouter, CommandContext
+from dice import calculate as calculate_dice_expression, calculate_repeated, format_dice_details, DiceRollInfo
+from distribution import calculate_distribution
+from skill import (pass_skill_value_expression, calculate_skill_roll_expression, calculate_group_skill_roll,
+                   SkillRollResult, SkillSheetStats)
+from skill_template import TEMPLATES, get_template
+from user import CharacterInfo
+
+# 内置指令的路由，其他模块可以通过 router.register 注册新的指令
+router = CommandRouter()
+
+
+@router.register("info", exact=True)
+def command_info(context: CommandContext):
+    return context.reply(
+        "自律型外星追车油炸土拨鼠鸡蛋土豆饼bot by potmot(377029227)\n纯文本指令匹配，无协议无核心（")
+
+
+@router.register("help", exact=True)
+def command_help(context: CommandContext):
+    return context.reply("支持的指令: \n.help\n.info\n.pot\n.pot show\n.mot\n.pc new\n.pc del\n.pc list\n.pc use\n.pc show\n.pc rename\n.pc tpl\n.st\n.st show\n.st del\n.nn\n.r\n.rd\n.ra\n.gra\n.dist\n")
+
+
+@router.register("pot")
+def command_pot(context: CommandContext):
+    user = context.user
+    if context.args.lower() == "show":
+        return context.reply(f"{user.nickname} 现在有 {user.points} 个土豆")
+
+    if user.last_point_get_time > context.today_start_ns:
+        return context.reply("今日份土豆已发放~")
+
+    potato_count: int = context.rng.randint(1, 6)
+    if potato_count == 1:
+        if context.rng.randint(1, 100) == 100:
+            potato_count = 100
+    user.increase_points(potato_count)
+    user.set_last_point_get_time(time.time_ns())
+    return context.reply(f"{user.nickname} 获得了 {potato_count} 个土豆")
+
+
+@router.register("mot", exact=True)
+def command_mot(context: CommandContext):
+    voice_force = context.rng.randint(1, 240)
+    return context.reply(f"{context.user.nickname} 触碰土拨鼠，土拨鼠发出了 {voice_force} db 的尖叫")
+
+
+@router.register("jrrp", exact=True)
+def command_jrrp(context: CommandContext):
+    user = context.user
+    if user.last_lucky_point_check_time < context.today_start_ns:
+        user.set_lucky_points(context.rng.randint(1, 100), time.time_ns())
+    return context.reply(f"{user.nickname} 今日人品为 {user.lucky_points}")
+
+
+# 角色部分
+@router.register("pc")
+def command_pc(context: CommandContext):
+    user = context.user
+    nickname = user.nickname
+    expression = context.args
+    if expression.lower().startswith("new"):
+        name = expression[3:].strip()
+        if name == "":
+            return context.reply(f"{nickname} 角色名称不能为空")
+        user.set_current_character(name)
+        return context.reply(f"{nickname} 创建了角色 {name}")
+    if expression.lower().startswith("list"):
+        character_names = "\n".join(list(user.characters.keys()))
+        return context.reply(f"{nickname} 的角色列表: \n{character_names}")
+    if expression.lower().startswith("use"):
+        name = expression[3:].strip()
+        user.set_current_character(name)
+        return context.reply(f"{nickname} 切换角色为 {name}")
+    if expression.lower().startswith("del"):
+        name = expression[3:].strip()
+        if name == "":
+            return context.reply(f"{nickname} 角色名称不能为空")
+        if name in user.characters:
+            user.remove_character(name)
+            return context.reply(f"{nickname} 删除了角色 {name}")
+        else:
+            return context.reply(f"{nickname} 不存在角色 {name}")
+    if expression.lower().startswith("show"):
+        name = expression[4:].strip()
+        if name == "":
+            name = user.current_character_name
+        character: CharacterInfo = user.get_character_info(name)
+        character_skill_str = "\n".join([f"{skill_name}: {skill_value}" for skill_name, skill_value in character.all_skills().items()])
+        return context.reply(f"{nickname} 角色 {character.name}\nhp: {character.get_current_hp()}/{character.get_max_hp()}\n{character_skill_str}")
+
+    if expression.lower().startswith("tpl"):
+        name = expression[3:].strip()
+        current_character = context.ensure_character()
+        if name == "":
+            template_str = "\n".join([f"{template.name}: {template.description}" for template in TEMPLATES.values()])
+            current_template = current_character.template.name if current_character.template is not None else "无"
+            return context.reply(f"{current_character.name} 当前模板: {current_template}\n可用模板:\n{template_str}")
+        if name.lower() == "none":
+            current_character.set_template(None)
+            return context.reply(f"{current_character.name} 已取消技能模板")
+        template = get_template(name)
+        if template is None:
+            return context.reply(f"不存在技能模板 {name}")
+        current_character.set_template(template)
+        return context.reply(f"{current_character.name} 使用技能模板 {template.name}")
+
+    if expression.lower().startswith("rename"):
+        expression = expression[6:].strip()
+        names = expression.split(" ")
+        current_character = context.character
+        if len(names) == 1 and len(names[0]) > 0 and current_character is not None:
+            old_name = current_character.name
+            if user.rename_character(old_name, names[0]):
+                return context.reply(f"{nickname} 角色 {old_name} 重命名为 {names[0]}")
+        elif len(names) == 2 and len(names[0]) > 0 and len(names[1]) > 0:
+            old_name = names[0]
+            new_name = names[1]
+            if user.rename_character(old_name, new_name):
+                return context.reply(f"{nickname} 角色 {old_name} 重命名为 {new_name}")
+    # 其余情况按未知指令处理
+    return None
+
+
+# 名称部分
+@router.register("nn")
+def command_nn(context: CommandContext):
+    user = context.user
+    name = context.args
+    if name == "":
+        user.set_nickname(context.sender_nickname)
+        return context.reply(f"{context.sender_nickname} 昵称已修改为 {context.sender_nickname}")
+    else:
+        nickname = user.nickname
+        user.set_nickname(name)
+        return context.reply(f"{nickname} 昵称已修改为 {name}")
+
+
+# 设置技能
+@router.register("st")
+def command_st(context: CommandContext):
+    expression = context.args
+    current_character = context.ensure_character()
+
+    if expression.lower().startswith("show"):
+        character_skill_str = "\n".join([f"{skill_name}: {skill_value}" for skill_name, skill_value in current_character.all_skills().items()])
+        return context.reply(f"{current_character.name} 当前技能\n{character_skill_str}")
+    if expression.lower().startswith("del"):
+        skill_names: list[str] = expression[3:].split(" ")
+        removed_skill_names: list[str] = []
+        for skill_name in skill_names:
+            if skill_name in current_character.skills:
+                current_character.remove_skill(skill_name)
+                removed_skill_names.append(skill_name)
+        removed_skill_str = "\n".join(removed_skill_names)
+        return context.reply(f"{current_character.name} 移除了技能\n{removed_skill_str}")
+    else:
+        sheet_stats = SkillSheetStats()
+        skill_values = pass_skill_value_expression(expression, rng=context.rng, stats=sheet_stats)
+        logging.info(f"解析技能表 {sheet_stats.entries} 项（骰子表达式 {sheet_stats.dice_entries} 项），"
+                     f"耗时 {sheet_stats.elapsed_ms:.3f}ms")
+        set_skill_str = "\n".join([f"{skill_name}：{skill_value}" for skill_name, skill_value in skill_values.items()])
+        for skill_name, skill_value in skill_values.items():
+            current_character.set_skill_value(skill_name, skill_value)
+        return context.reply(f"{current_character.name} 设置了技能\n{set_skill_str}")
+
+
+def describe_distribution(expression: str) -> str:
+    # 形如 3d6>=15 的表达式额外计算比较成立的概率
+    match = re.match(r"^(.*?)(<=|>=|<|>|=)(-?\d+(?:\.\d+)?)$", expression)
+    target_str = ""
+    try:
+        if match:
+            expression = match.group(1)
+        if len(expression) == 0:
+            expression = "d"
+        distribution = calculate_distribution(expression)
+        if match:
+            comparator, target = match.group(2), float(match.group(3))
+            probability = distribution.probability(comparator, target)
+            target_str = f"\n{comparator}{match.group(3)} 的概率为 {probability:.2%}"
+        return (f"{expression} 的分布: 期望 {distribution.mean():.2f}，标准差 {distribution.variance() ** 0.5:.2f}，"
+                f"范围 {distribution.minimum}~{distribution.maximum}，最可能为 {distribution.mode()}{target_str}")
+    except ValueError as e:
+        return f"值错误: {str(e)}"
+    except Exception as e:
+        return f"未知错误: {str(e)}"
+
+
+# 计算骰子表达式的概率分布
+@router.register("dist")
+def command_dist(context: CommandContext):
+    return context.reply(describe_distribution(context.compact_args.lower()))
+
+
+# 多个角色同时进行技能检定
+@router.register("gra")
+async def command_gra(context: CommandContext):
+    # 形如 "聆听 123 456:角色名"，QQ号后可用冒号指定角色，否则使用该用户当前角色
+    parts = context.args.split()
+    if len(parts) < 2:
+        return context.reply("用法: .gra 技能 QQ号[:角色名] ...")
+    skill_expression = parts[0]
+    targets: list[tuple[int, str or None]] = []
+    for part in parts[1:]:
+        user_id_str, _, character_name = part.partition(":")
+        if not user_id_str.isdigit():
+            return context.reply(f"无效的QQ号: {user_id_str}")
+        targets.append((int(user_id_str), character_name or None))
+
+    users = await context.store.get_users([user_id for user_id, _ in targets])
+    characters: list[CharacterInfo] = []
+    missing: list[str] = []
+    for user_id, character_name in targets:
+        user = users.get(user_id)
+        character = None
+        if user is not None:
+            character = user.get_character_info(character_name) if character_name is not None else (
+                user.get_current_character_info())
+        if character is None:
+            missing.append(f"{user_id}:{character_name}" if character_name is not None else str(user_id))
+        else:
+            characters.append(character)
+
+    lines = [f"{context.user.nickname} 发起了群体检定 {skill_expression}"]
+    for character, result in zip(characters, calculate_group_skill_roll(skill_expression, characters, rng=context.rng)):
+        lines.append(f"{character.name} {result.skill_name} ({result.roll_result}/{result.skill_value})，{result.success_type}")
+    if missing:
+        lines.append(f"未找到角色: {'、'.join(missing)}")
+    return context.reply("\n".join(lines))
+
+
+def roll_skill(context: CommandContext, expression: str) -> str:
+    current_character = context.ensure_character()
+    result: SkillRollResult = calculate_skill_roll_expression(expression, current_character, rng=context.rng)
+    text = f"{current_character.name} 投掷技能 {result.skill_name} ({result.roll_result}/{result.skill_value})，{result.success_type}~"
+    if result.suggestions:
+        text += f"\n未找到技能 {result.skill_name}，是否想投掷: {'、'.join(result.suggestions)}"
+    return text
+
+
+# 投掷技能
+@router.register("rah")
+def command_rah(context: CommandContext):
+    current_character = context.ensure_character()
+    return [
+        context.reply(f"{current_character.name} 秘密投掷了技能"),
+        context.private(roll_skill(context, context.compact_args))
+    ]
+
+
+@router.register("ra")
+def command_ra(context: CommandContext):
+    return context.reply(roll_skill(context, context.compact_args))
+
+
+def roll_dice(context: CommandContext, expression: str) -> str:
+    nickname = context.user.nickname
+    try:
+        if "#" in expression:
+            results = calculate_repeated(expression, rng=context.rng)
+            body = expression.partition("#")[2] or "d"
+            results_str = ", ".join(map(str, results))
+            return f"{nickname} 掷出了 {len(results)} 次 {body}: {results_str}"
+        if len(expression) == 0:
+            expression = "d"
+        dice_infos: List[DiceRollInfo] = []
+        result = calculate_dice_expression(expression, dice_infos, rng=context.rng)
+        dice_info_str = f"[\n{format_dice_details(dice_infos)}\n]"
+        return f"{nickname} 掷出了 {result}{dice_info_str}" if (
+                    len(dice_infos) > 0
+            ) else f"{nickname} 计算得到 {result}"
+    except ValueError as e:
+        return f"值错误: {str(e)}"
+    except Exception as e:
+        return f"未知错误: {str(e)}"
+
+
+# 投掷普通骰子
+@router.register("rh")
+def command_rh(context: CommandContext):
+    current_character = context.character
+    name = current_character.name if current_character is not None else context.user.nickname
+    return [
+        context.reply(f"{name} 秘密投掷了骰子"),
+        context.private(roll_dice(context, context.compact_args.lower()))
+    ]
+
+
+@router.register("r")
+def command_r(context: CommandContext):
+    return context.reply(roll_dice(context, context.compact_args.lower()))
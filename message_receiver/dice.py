@@ -1,220 +1,671 @@
+import math
+import operator
 import random
+import sys
 import unittest
-from typing import List, Union, Optional
+from functools import lru_cache
+from array import array
+from typing import List, Union, Optional, Callable, Tuple, Sequence, Iterable
 from dataclasses import dataclass
 
+from random_source import RandomSource, default_source, byte_tables
+
+
+# 文本中每组骰子最多展示的点数个数
+DISPLAY_ROLL_LIMIT = 20
+# 文本中最多展示的骰子组数
+DISPLAY_DETAIL_LIMIT = 10
+
+
+def _array_typecode(sides: int) -> Optional[str]:
+    # 选择能容纳所有点数的最小数组类型
+    if sides <= 0xFF:
+        return 'B'
+    if sides <= 0xFFFF:
+        return 'H'
+    if sides <= 0xFFFFFFFF:
+        return 'L'
+    if sides <= 0xFFFFFFFFFFFFFFFF:
+        return 'Q'
+    return None
+
 
-@dataclass
 class DiceRollInfo:
     """
-    骰子投掷信息的数据类
+    骰子投掷信息，点数保存在紧凑的数组中，文本只在需要时生成
     """
+    __slots__ = ('count', 'sides', 'rolls', 'result', 'lowest', 'highest')
+
     count: int
     sides: int
-    rolls: List[int]
+    # 投掷点数，大量投掷时只保留前 ROLL_SAMPLE_SIZE 个作为样本
+    rolls: Sequence[int]
     result: int
+    lowest: int
+    highest: int
 
-    def __str__(self) -> str:
-        if self.count > 1:
+    def __init__(self, count: int, sides: int, rolls: Iterable[int], result: int,
+                 lowest: int = 0, highest: int = 0) -> None:
+        self.count = count
+        self.sides = sides
+        typecode = _array_typecode(sides)
+        self.rolls = array(typecode, rolls) if typecode is not None else list(rolls)
+        self.result = result
+        self.lowest = lowest
+        self.highest = highest
+
+    def __repr__(self) -> str:
+        return (f"DiceRollInfo(count={self.count}, sides={self.sides}, rolls={list(self.rolls)}, "
+                f"result={self.result}, lowest={self.lowest}, highest={self.highest})")
+
+    def format(self, limit: int = DISPLAY_ROLL_LIMIT) -> str:
+        """
+        生成投掷详情文本，点数超过 limit 个时只展示前 limit 个
+        :param limit: 最多展示的点数个数
+        """
+        if self.count <= 1:
+            return f"D{self.sides}={self.result}"
+        if self.count <= limit and len(self.rolls) == self.count:
             return f"{self.count}D{self.sides}={'+'.join(map(str, self.rolls))}={self.result}"
+        shown = '+'.join(map(str, self.rolls[:limit]))
+        return (f"{self.count}D{self.sides}={shown}+…(另{self.count - min(limit, len(self.rolls))}个, "
+                f"最小{self.lowest}, 最大{self.highest})={self.result}")
+
+    def __str__(self) -> str:
+        return self.format()
+
+
+def format_dice_details(dice_details: Sequence[DiceRollInfo],
+                        detail_limit: int = DISPLAY_DETAIL_LIMIT,
+                        roll_limit: int = DISPLAY_ROLL_LIMIT) -> str:
+    """
+    将多组骰子投掷详情格式化为多行文本，超出 detail_limit 组的部分只给出数量
+    :param dice_details: 骰子投掷详情
+    :param detail_limit: 最多展示的组数
+    :param roll_limit: 每组最多展示的点数个数
+    """
+    lines = [info.format(roll_limit) for info in dice_details[:detail_limit]]
+    if len(dice_details) > detail_limit:
+        lines.append(f"…(另{len(dice_details) - detail_limit}组)")
+    return "\n".join(lines)
+
+
+# 达到该数量的骰子使用批量投掷路径
+BULK_ROLL_THRESHOLD = 64
+# 批量投掷时每块抽取的骰子数量
+BULK_ROLL_CHUNK = 65536
+# 批量投掷时 DiceRollInfo 中保留的点数样本数量
+ROLL_SAMPLE_SIZE = 100
+
+# 运算符字符
+operator_chars = "+-*/%^d()"
+
+# 二元运算符的优先级，数值越大结合越紧
+precedence: dict[str, int] = {'+': 1, '-': 1, '*': 2, '/': 2, '%': 2, '^': 3, 'd': 4}
+right_associative: set[str] = {'^', 'd'}
+# 一元正负号的优先级，高于所有二元运算符
+unary_precedence: int = 5
+
+
+def _divide(a: Union[int, float], b: Union[int, float]) -> Union[int, float]:
+    if b == 0:
+        raise ValueError("除零错误")
+    return a / b
+
+
+def _modulo(a: Union[int, float], b: Union[int, float]) -> Union[int, float]:
+    if b == 0:
+        raise ValueError("除零错误")
+    return a % b
+
+
+binary_operators: dict[str, Callable[[Union[int, float], Union[int, float]], Union[int, float]]] = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': _divide,
+    '%': _modulo,
+    '^': operator.pow,
+}
+
+
+def roll_dice(count: Union[int, float], sides: Union[int, float],
+              dice_details: Optional[List[DiceRollInfo]] = None,
+              rng: Optional[RandomSource] = None) -> int:
+    """
+    投掷 count 个 sides 面的骰子并返回点数之和
+    :param count: 骰子数量
+    :param sides: 骰子面数
+    :param dice_details: 可选参数，用于记录骰子投掷的详细信息
+    :param rng: 可选参数，随机数来源，默认使用 random_source.default_source()
+    """
+    if rng is None:
+        rng = default_source()
+    # 骰子运算需要整数参数
+    if count <= 0 or sides <= 0:
+        raise ValueError("骰子参数必须是正数")
+    if isinstance(sides, float):
+        sides = int(sides)
+    if isinstance(count, float):
+        count = int(count)
+
+    # 大量骰子走批量投掷路径，不逐个生成点数列表
+    if count >= BULK_ROLL_THRESHOLD:
+        sample_size = ROLL_SAMPLE_SIZE if dice_details is not None else 0
+        roll_result, lowest, highest, rolls = bulk_roll(count, sides, sample_size, rng)
+    else:
+        rolls = rng.roll(count, sides)
+        roll_result = sum(rolls)
+        lowest = min(rolls, default=0)
+        highest = max(rolls, default=0)
+
+    # 记录骰子投掷详情（如果提供了记录参数）
+    if dice_details is not None:
+        dice_details.append(DiceRollInfo(
+            count=count,
+            sides=sides,
+            rolls=rolls,
+            result=roll_result,
+            lowest=lowest,
+            highest=highest
+        ))
+    return roll_result
+
+
+def bulk_roll(count: int, sides: int, sample_size: int = 0,
+              rng: Optional[RandomSource] = None) -> Tuple[int, int, int, List[int]]:
+    """
+    批量投掷大量骰子，按块抽取随机数并在 C 层完成求和，不构造完整的点数列表
+    :param count: 骰子数量
+    :param sides: 骰子面数
+    :param sample_size: 需要保留的点数样本数量
+    :param rng: 可选参数，随机数来源，默认使用 random_source.default_source()
+    :return: (点数之和, 最小点数, 最大点数, 前 sample_size 个点数)
+    """
+    if rng is None:
+        rng = default_source()
+    if sides == 1:
+        return count, 1, 1, [1] * min(count, sample_size)
+
+    total = 0
+    lowest = sides
+    highest = 1
+    sample: List[int] = []
+    remaining = count
+    if sides <= 256:
+        table, rejected = byte_tables(sides)
+        # 按接受率多抽取一些字节，减少补抽次数
+        acceptance = (256 - len(rejected)) / 256
+        while remaining > 0:
+            size = min(remaining, BULK_ROLL_CHUNK)
+            values = rng.randbytes(int(size / acceptance) + 16).translate(table, rejected)[:size]
+            if not values:
+                continue
+            # 转换表得到的是 0 ~ sides-1，每个点数需加1
+            total += sum(values) + len(values)
+            lowest = min(lowest, min(values) + 1)
+            highest = max(highest, max(values) + 1)
+            if len(sample) < sample_size:
+                sample.extend(value + 1 for value in values[:sample_size - len(sample)])
+            remaining -= len(values)
+    else:
+        faces = range(1, sides + 1)
+        while remaining > 0:
+            size = min(remaining, BULK_ROLL_CHUNK)
+            if sides <= sys.maxsize:
+                values = rng.choices(faces, k=size)
+            else:
+                values = [rng.randint(1, sides) for _ in range(size)]
+            total += sum(values)
+            lowest = min(lowest, min(values))
+            highest = max(highest, max(values))
+            if len(sample) < sample_size:
+                sample.extend(values[:sample_size - len(sample)])
+            remaining -= size
+    return total, lowest, highest, sample
+
+
+@dataclass
+class ExpressionBudget:
+    """
+    表达式求值预算，用于拒绝会长时间占用事件循环的表达式
+    """
+    # 最多投掷的骰子数量
+    max_dice: int = 100_000
+    # 最多执行的运算次数
+    max_operations: int = 10_000
+    # 中间结果允许的最大二进制位数
+    max_bits: int = 1024
+    # 最大嵌套深度
+    max_depth: int = 64
+
+
+# 默认预算，修改后需要调用 clear_compile_cache 使已编译的表达式重新检查
+default_budget = ExpressionBudget()
+
+
+@dataclass
+class ExpressionCost:
+    """
+    表达式的静态开销估计，均为最坏情况下的上界
+    """
+    # 最多投掷的骰子数量
+    dice: float
+    # 结果绝对值的二进制位数上界（log2）
+    bits: float
+    # 运算次数
+    operations: int
+    # 嵌套深度
+    depth: int
+
+
+def _bits(value: Union[int, float]) -> float:
+    value = abs(value)
+    if value <= 1:
+        return 0.0
+    return math.log2(value)
+
+
+def _exp2(bits: float) -> float:
+    # 避免浮点数溢出
+    return math.inf if bits > 1023 else 2.0 ** bits
+
+
+def check_power(base: Union[int, float], exponent: Union[int, float], max_bits: int) -> None:
+    """
+    在计算乘方之前估计结果大小，超出位数上限时抛出异常
+    """
+    if exponent > 1 and _bits(base) * exponent > max_bits:
+        raise ValueError("数值过大")
+
+
+class EvaluationContext:
+    """
+    一次求值的上下文，记录骰子详情并扣减运行时预算
+    """
+    __slots__ = ('dice_details', 'rng', 'max_bits', 'dice_left', 'operations_left')
+
+    def __init__(self, dice_details: Optional[List[DiceRollInfo]] = None,
+                 budget: ExpressionBudget = default_budget,
+                 rng: Optional[RandomSource] = None) -> None:
+        self.dice_details = dice_details
+        self.rng = rng if rng is not None else default_source()
+        self.max_bits = budget.max_bits
+        self.dice_left = budget.max_dice
+        self.operations_left = budget.max_operations
+
+    def draw(self, count: Union[int, float]) -> None:
+        self.dice_left -= count
+        if self.dice_left < 0:
+            raise ValueError("骰子数量过多")
+
+    def operate(self, result: Union[int, float]) -> Union[int, float]:
+        self.operations_left -= 1
+        if self.operations_left < 0:
+            raise ValueError("运算次数过多")
+        if isinstance(result, int) and result.bit_length() > self.max_bits:
+            raise ValueError("数值过大")
+        return result
+
+
+class Node:
+    """
+    表达式语法树节点
+    """
+    __slots__ = ()
+
+    def evaluate(self, context: EvaluationContext) -> Union[int, float]:
+        raise NotImplementedError
+
+    def cost(self) -> ExpressionCost:
+        raise NotImplementedError
+
+
+class Number(Node):
+    """
+    常量节点，所有不含骰子的子树都会在编译期折叠为该节点
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value: Union[int, float]) -> None:
+        self.value = value
+
+    def evaluate(self, context: EvaluationContext) -> Union[int, float]:
+        return self.value
+
+    def cost(self) -> ExpressionCost:
+        return ExpressionCost(dice=0, bits=_bits(self.value), operations=0, depth=1)
+
+
+class Negate(Node):
+    """
+    一元负号节点
+    """
+    __slots__ = ('operand',)
+
+    def __init__(self, operand: Node) -> None:
+        self.operand = operand
+
+    def evaluate(self, context: EvaluationContext) -> Union[int, float]:
+        return context.operate(-self.operand.evaluate(context))
+
+    def cost(self) -> ExpressionCost:
+        operand = self.operand.cost()
+        return ExpressionCost(operand.dice, operand.bits, operand.operations + 1, operand.depth + 1)
+
+
+class BinaryOperation(Node):
+    """
+    二元运算节点
+    """
+    __slots__ = ('operator', 'left', 'right', 'apply')
+
+    def __init__(self, operator_char: str, left: Node, right: Node) -> None:
+        self.operator = operator_char
+        self.left = left
+        self.right = right
+        self.apply = binary_operators[operator_char]
+
+    def evaluate(self, context: EvaluationContext) -> Union[int, float]:
+        a = self.left.evaluate(context)
+        b = self.right.evaluate(context)
+        if self.operator == '^':
+            check_power(a, b, context.max_bits)
+        return context.operate(self.apply(a, b))
+
+    def cost(self) -> ExpressionCost:
+        left = self.left.cost()
+        right = self.right.cost()
+        if self.operator in '+-':
+            high, low = max(left.bits, right.bits), min(left.bits, right.bits)
+            bits = high + math.log2(1 + _exp2(low - high))
+        elif self.operator == '*':
+            bits = left.bits + right.bits
+        elif self.operator == '/':
+            bits = left.bits
+            # 除以绝对值小于1的常量会放大结果
+            if isinstance(self.right, Number) and 0 < abs(self.right.value) < 1:
+                bits -= math.log2(abs(self.right.value))
+        elif self.operator == '%':
+            bits = right.bits
         else:
-            return f"D{self.sides}={self.result}"
+            bits = left.bits * _exp2(right.bits) if left.bits > 0 else 0.0
+        return ExpressionCost(
+            dice=left.dice + right.dice,
+            bits=bits,
+            operations=left.operations + right.operations + 1,
+            depth=max(left.depth, right.depth) + 1
+        )
+
+
+class Dice(Node):
+    """
+    骰子节点，数量与面数本身也可以是表达式
+    """
+    __slots__ = ('count', 'sides')
 
+    def __init__(self, count: Node, sides: Node) -> None:
+        self.count = count
+        self.sides = sides
 
-all_precedence = "+-*/%^d()"
-left_precedence = "+-*/%^("
-right_precedence = "+-*/%^)"
+    def evaluate(self, context: EvaluationContext) -> Union[int, float]:
+        count = self.count.evaluate(context)
+        sides = self.sides.evaluate(context)
+        context.draw(count)
+        return context.operate(roll_dice(count, sides, context.dice_details, context.rng))
 
-precedence: dict[str, int] = {'+': 1, '-': 1, '*': 2, '/': 2, '%': 2, '^': 3, 'd': 4, 'P': 5, 'N': 5}
-right_associative: set[str] = {'^', 'd', 'P', 'N'}
+    def cost(self) -> ExpressionCost:
+        count = self.count.cost()
+        sides = self.sides.cost()
+        max_count = abs(self.count.value) if isinstance(self.count, Number) else _exp2(count.bits)
+        return ExpressionCost(
+            dice=count.dice + sides.dice + max_count,
+            bits=count.bits + sides.bits,
+            operations=count.operations + sides.operations + 1,
+            depth=max(count.depth, sides.depth) + 1
+        )
 
 
-def tokenize(expression: str, default_sides: int = 100) -> List[Union[int, float, str]]:
+def check_cost(node: Node, budget: ExpressionBudget = default_budget) -> ExpressionCost:
     """
-    将表达式字符串分解为标记列表
+    静态估计表达式的最坏开销，超出预算时抛出 ValueError
+    :param node: 语法树根节点
+    :param budget: 求值预算
+    :return: 开销估计
+    """
+    cost = node.cost()
+    if cost.depth > budget.max_depth:
+        raise ValueError("表达式嵌套过深")
+    if cost.dice > budget.max_dice:
+        raise ValueError(f"骰子数量过多，最多允许 {budget.max_dice} 个")
+    if cost.operations > budget.max_operations:
+        raise ValueError("表达式过长")
+    if cost.bits > budget.max_bits:
+        raise ValueError("数值过大")
+    return cost
+
+
+def tokenize(expression: str) -> List[Union[int, float, str]]:
+    """
+    将表达式字符串分解为标记列表，数字转换为 int 或 float，运算符保留为单字符
     """
     expression = expression.replace(' ', '').lower()
     tokens: List[Union[int, float, str]] = []
     i: int = 0
-    while i < len(expression):
-        if expression[i].isdigit() or expression[i] == '.':
+    length: int = len(expression)
+    while i < length:
+        char = expression[i]
+        if char.isdigit() or char == '.':
             # 处理数字（包括小数）
             start: int = i
-            while i < len(expression) and (expression[i].isdigit() or expression[i] == '.'):
-                i += 1
-            tokens.append(float(expression[start:i]) if '.' in expression[start:i] else int(expression[start:i]))
-        elif expression[i] in all_precedence:
-            # 处理一元正号的情况：如果+号在开头或前面是另一个运算符或左括号
-            if (
-                    expression[i] == '+' and (
-                    i == 0 or (i > 0 and (isinstance(expression[i - 1], str) and expression[i - 1] in left_precedence)))
-            ):
-                tokens.append('P')
-                i += 1
-            # 处理一元负号的情况：如果-号在开头或前面是另一个运算符或左括号
-            elif (
-                    expression[i] == '-' and (
-                    i == 0 or (i > 0 and (isinstance(expression[i - 1], str) and expression[i - 1] in left_precedence)))
-            ):
-                tokens.append('N')
-                i += 1
-            # 特如果当前是'd'且下一个有效字符是运算符或表达式结束
-            elif (
-                    expression[i] == 'd' and
-                    (i + 1 >= len(expression) or expression[i + 1] in right_precedence)
-            ):
-                tokens.append('d')
-                tokens.append(default_sides)
-                i += 1
-            else:
-                tokens.append(expression[i])
+            while i < length and (expression[i].isdigit() or expression[i] == '.'):
                 i += 1
+            text = expression[start:i]
+            tokens.append(float(text) if '.' in text else int(text))
+        elif char in operator_chars:
+            tokens.append(char)
+            i += 1
         else:
-            raise ValueError(f"非法字符: {expression[i]}")
+            raise ValueError(f"非法字符: {char}")
     return tokens
 
 
-def infix_to_postfix(tokens: List[Union[int, float, str]]) -> List[Union[int, float, str]]:
-    """
-    使用调度场算法将中缀表达式转换为后缀表达式（逆波兰表示法）
-    """
-    output: List[Union[int, float, str]] = []
-    operator_stack: List[str] = []
-
-    for i, token in enumerate(tokens):
-        if isinstance(token, (int, float)):
-            # 如果是数字，直接加入输出队列
-            output.append(token)
-        elif token in precedence:
-            # 处理一元d运算符的情况
-            if token == 'd' and (
-                    i == 0 or (i > 0 and (isinstance(tokens[i - 1], str) and tokens[i - 1] in left_precedence))):
-                # 如果d前面是运算符或表达式开始，则在前面加一个1作为默认骰子数量
-                output.append(1)
-
-            # 判断运算符优先级
-            while (operator_stack and
-                   operator_stack[-1] != '(' and
-                   operator_stack[-1] in precedence and
-                   (precedence[operator_stack[-1]] > precedence[token] or
-                    (precedence[operator_stack[-1]] == precedence[token] and
-                     token not in right_associative))):
-                output.append(operator_stack.pop())
-            operator_stack.append(token)
-        elif token == '(':
-            # 左括号直接入栈
-            operator_stack.append(token)
-        elif token == ')':
-            # 右括号：弹出运算符直到遇到左括号
-            while operator_stack and operator_stack[-1] != '(':
-                output.append(operator_stack.pop())
-            if not operator_stack:
+class Parser:
+    """
+    优先级爬升（Pratt）解析器，将标记列表解析为语法树并折叠常量子树
+    """
+
+    def __init__(self, tokens: List[Union[int, float, str]], default_sides: int = 100,
+                 max_depth: int = default_budget.max_depth) -> None:
+        self.tokens = tokens
+        self.position = 0
+        self.default_sides = default_sides
+        self.depth = 0
+        self.max_depth = max_depth
+
+    def parse(self) -> Node:
+        node = self.parse_expression(1)
+        if self.position < len(self.tokens):
+            if self.tokens[self.position] == ')':
                 raise ValueError("括号不匹配")
-            operator_stack.pop()  # 弹出左括号
+            raise ValueError("表达式格式错误")
+        return node
+
+    def peek(self) -> Union[int, float, str, None]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def parse_expression(self, min_precedence: int) -> Node:
+        # 限制递归深度，避免超长的括号或正负号序列耗尽调用栈
+        self.depth += 1
+        if self.depth > self.max_depth:
+            raise ValueError("表达式嵌套过深")
+        left = self.parse_prefix()
+        while True:
+            token = self.peek()
+            if not isinstance(token, str) or token not in precedence or precedence[token] < min_precedence:
+                self.depth -= 1
+                return left
+            token_precedence = precedence[token]
+            self.position += 1
+            # 左结合运算符的右侧只接受更高优先级的运算
+            next_precedence = token_precedence if token in right_associative else token_precedence + 1
+            if token == 'd':
+                left = make_dice(left, self.parse_sides(next_precedence))
+            else:
+                left = make_binary(token, left, self.parse_expression(next_precedence))
+
+    def parse_prefix(self) -> Node:
+        token = self.peek()
+        if token is None:
+            raise ValueError("表达式格式错误")
+        self.position += 1
+        if not isinstance(token, str):
+            return Number(token)
+        if token == '(':
+            node = self.parse_expression(1)
+            if self.peek() != ')':
+                raise ValueError("括号不匹配")
+            self.position += 1
+            return node
+        if token == '+':
+            return self.parse_expression(unary_precedence)
+        if token == '-':
+            return make_negate(self.parse_expression(unary_precedence))
+        if token == 'd':
+            # 省略数量的骰子，如 d20，数量默认为1
+            return make_dice(Number(1), self.parse_sides(precedence['d']))
+        raise ValueError("表达式格式错误")
+
+    def parse_sides(self, min_precedence: int) -> Node:
+        # d 后面是运算符、右括号或表达式结束时，使用默认面数
+        token = self.peek()
+        if token is None or (isinstance(token, str) and token != '('):
+            return Number(self.default_sides)
+        return self.parse_expression(min_precedence)
+
+
+def make_negate(operand: Node) -> Node:
+    if isinstance(operand, Number):
+        return Number(-operand.value)
+    return Negate(operand)
 
-    # 弹出剩余运算符
-    while operator_stack:
-        if operator_stack[-1] in '()':
-            raise ValueError("括号不匹配")
-        output.append(operator_stack.pop())
 
-    return output
+def make_binary(operator_char: str, left: Node, right: Node) -> Node:
+    if isinstance(left, Number) and isinstance(right, Number):
+        if operator_char == '^':
+            check_power(left.value, right.value, default_budget.max_bits)
+        return Number(binary_operators[operator_char](left.value, right.value))
+    return BinaryOperation(operator_char, left, right)
 
 
-def evaluate_postfix(postfix_tokens: List[Union[int, float, str]],
-                     dice_details: Optional[List[DiceRollInfo]] = None) -> Union[int, float]:
+def make_dice(count: Node, sides: Node) -> Node:
+    # 骰子节点总是保留到求值阶段
+    return Dice(count, sides)
+
+
+# 编译缓存的最大条目数
+COMPILE_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_expression(expression: str, default_sides: int = 100) -> Node:
     """
-    计算后缀表达式的值
-    :param postfix_tokens: 后缀表达式标记列表
-    :param dice_details: 可选参数，用于记录骰子投掷的详细信息
+    将中缀表达式编译为语法树，不含骰子的子树在编译期折叠为常量
+    结果按 (表达式, 默认面数) 缓存在有界 LRU 缓存中，编译失败不会被缓存
+    :param expression: 中缀表达式字符串
+    :param default_sides: 默认的骰子面数
+    :return: 语法树根节点，求值时不应被修改
     """
-    stack: List[Union[int, float]] = []
-
-    for token in postfix_tokens:
-        if isinstance(token, (int, float)):
-            stack.append(token)
-        elif token == 'P':
-            if len(stack) < 1:
-                raise ValueError("表达式格式错误")
-            stack.append(stack.pop())
-        elif token == 'N':
-            if len(stack) < 1:
-                raise ValueError("表达式格式错误")
-            stack.append(-stack.pop())
-        elif token == 'd':
-            if len(stack) < 2:
-                raise ValueError("表达式格式错误")
-
-            sides: Union[int, float] = stack.pop()
-            count: Union[int, float] = stack.pop()
-
-            # 骰子运算需要整数参数
-            if count <= 0 or sides <= 0:
-                raise ValueError("骰子参数必须是正数")
-            if isinstance(sides, float):
-                sides = int(sides)
-            if isinstance(count, float):
-                count = int(count)
-
-            # 执行骰子投掷
-            rolls = [random.randint(1, sides) for _ in range(count)]
-            roll_result = sum(rolls)
-            stack.append(roll_result)
-
-            # 记录骰子投掷详情（如果提供了记录参数）
-            if dice_details is not None:
-                dice_details.append(DiceRollInfo(
-                    count=count,
-                    sides=sides,
-                    rolls=rolls,
-                    result=roll_result
-                ))
-        elif token in precedence:
-            if len(stack) < 2:
-                raise ValueError("表达式格式错误")
-
-            b: Union[int, float] = stack.pop()
-            a: Union[int, float] = stack.pop()
-
-            if token == '+':
-                stack.append(a + b)
-            elif token == '-':
-                stack.append(a - b)
-            elif token == '*':
-                stack.append(a * b)
-            elif token == '/':
-                if b == 0:
-                    raise ValueError("除零错误")
-                stack.append(a / b)
-            elif token == '%':
-                if b == 0:
-                    raise ValueError("除零错误")
-                stack.append(a % b)
-            elif token == '^':
-                stack.append(a ** b)
-
-    if len(stack) != 1:
-        raise ValueError("表达式格式错误")
+    try:
+        node = Parser(tokenize(expression), default_sides).parse()
+    except OverflowError:
+        raise ValueError("数值过大")
+    check_cost(node)
+    return node
+
+
+def compile_cache_info():
+    """
+    获取编译缓存的统计信息
+    :return: 包含 hits, misses, maxsize, currsize 的命名元组
+    """
+    return compile_expression.cache_info()
 
-    return stack[0]
+
+def clear_compile_cache() -> None:
+    """
+    清空编译缓存并重置命中计数
+    """
+    compile_expression.cache_clear()
 
 
 def calculate(expression: str,
               dice_details: Optional[List[DiceRollInfo]] = None,
-              default_sides: int = 100) -> Union[int, float]:
+              default_sides: int = 100,
+              budget: Optional[ExpressionBudget] = None,
+              rng: Optional[RandomSource] = None) -> Union[int, float]:
     """
     计算中缀表达式的值
     :param expression: 中缀表达式字符串
     :param dice_details: 可选参数，用于记录骰子投掷的详细信息
     :param default_sides: 可选参数，设置默认的骰子面数
+    :param budget: 可选参数，求值预算，默认使用 default_budget
+    :param rng: 可选参数，随机数来源，默认使用 random_source.default_source()
     :return: 计算结果
     """
-    # 1. 分词
-    tokens: List[Union[int, float, str]] = tokenize(expression, default_sides)
-    # 2. 转换为后缀表达式
-    postfix: List[Union[int, float, str]] = infix_to_postfix(tokens)
-    # 3. 计算后缀表达式
-    return evaluate_postfix(postfix, dice_details)
+    node = compile_expression(expression, default_sides)
+    if budget is None:
+        budget = default_budget
+    else:
+        check_cost(node, budget)
+    try:
+        return node.evaluate(EvaluationContext(dice_details, budget, rng))
+    except OverflowError:
+        raise ValueError("数值过大")
+
+
+# 重复投掷的最大次数
+MAX_REPEAT = 100
+
+
+def calculate_repeated(expression: str,
+                       dice_details: Optional[List[DiceRollInfo]] = None,
+                       default_sides: int = 100,
+                       budget: Optional[ExpressionBudget] = None,
+                       rng: Optional[RandomSource] = None) -> List[Union[int, float]]:
+    """
+    计算形如 "6#3d6*5" 的重复表达式，# 前为重复次数
+    表达式只编译一次，所有重复共享同一份求值预算
+    :param expression: 重复表达式字符串，不含 # 时只计算一次
+    :param dice_details: 可选参数，用于按顺序记录所有骰子投掷的详细信息
+    :param default_sides: 可选参数，设置默认的骰子面数
+    :param budget: 可选参数，求值预算，默认使用 default_budget
+    :param rng: 可选参数，随机数来源，默认使用 random_source.default_source()
+    :return: 每次计算的结果
+    """
+    times_expression, separator, body = expression.partition('#')
+    times: Union[int, float] = 1
+    if separator:
+        times = calculate(times_expression, default_sides=default_sides, rng=rng) if times_expression else 0
+        if times != int(times) or not 1 <= times <= MAX_REPEAT:
+            raise ValueError(f"重复次数必须是 1 到 {MAX_REPEAT} 的整数")
+        times = int(times)
+    else:
+        body = times_expression
+    if len(body) == 0:
+        body = "d"
+    node = compile_expression(body, default_sides)
+    if budget is None:
+        budget = default_budget
+    else:
+        check_cost(node, budget)
+    context = EvaluationContext(dice_details, budget, rng)
+    try:
+        return [node.evaluate(context) for _ in range(times)]
+    except OverflowError:
+        raise ValueError("数值过大")
 
 
 class TestDiceInfixCalculator(unittest.TestCase):
@@ -400,6 +851,197 @@ class TestDiceInfixCalculator(unittest.TestCase):
         self.assertGreaterEqual(len(dice_info), 1)
 
 
+class TestCompileCache(unittest.TestCase):
+    def setUp(self):
+        clear_compile_cache()
+
+    def test_repeated_expression_hits_cache(self):
+        """测试重复表达式命中编译缓存"""
+        calculate("2d6+6")
+        calculate("2d6+6")
+        calculate("2d6+6")
+        info = compile_cache_info()
+        self.assertEqual(1, info.misses)
+        self.assertEqual(2, info.hits)
+
+    def test_default_sides_is_part_of_key(self):
+        """测试默认面数不同的表达式分别编译"""
+        self.assertEqual(100, compile_expression("d", 100).sides.value)
+        self.assertEqual(20, compile_expression("d", 20).sides.value)
+        self.assertEqual(2, compile_cache_info().misses)
+
+    def test_invalid_expression_not_cached(self):
+        """测试非法表达式抛出异常且不进入缓存"""
+        with self.assertRaises(ValueError):
+            calculate("(1+2")
+        self.assertEqual(0, compile_cache_info().currsize)
+
+
+class TestBulkRoll(unittest.TestCase):
+    def test_bulk_roll_bounds(self):
+        """测试批量投掷的点数范围与样本"""
+        for sides in [2, 6, 100, 1000]:
+            total, lowest, highest, sample = bulk_roll(10000, sides, 20)
+            self.assertGreaterEqual(lowest, 1)
+            self.assertLessEqual(highest, sides)
+            self.assertGreaterEqual(total, 10000 * lowest)
+            self.assertLessEqual(total, 10000 * highest)
+            self.assertEqual(20, len(sample))
+            self.assertTrue(all(1 <= value <= sides for value in sample))
+
+    def test_bulk_roll_is_uniform(self):
+        """测试批量投掷的均值接近理论期望"""
+        total, _, _, _ = bulk_roll(200000, 6)
+        self.assertAlmostEqual(3.5, total / 200000, delta=0.05)
+
+    def test_large_roll_keeps_summary(self):
+        """测试大量投掷只保留摘要: 100000d6"""
+        dice_info: List[DiceRollInfo] = []
+        result = calculate("100000d6", dice_info)
+        self.assertGreaterEqual(result, 100000)
+        self.assertLessEqual(result, 600000)
+        self.assertEqual(100000, dice_info[0].count)
+        self.assertEqual(ROLL_SAMPLE_SIZE, len(dice_info[0].rolls))
+        self.assertEqual(result, dice_info[0].result)
+        self.assertIn(f"另{100000 - DISPLAY_ROLL_LIMIT}个", str(dice_info[0]))
+
+
+class TestExpressionBudget(unittest.TestCase):
+    def test_dice_bomb_rejected(self):
+        """测试拒绝骰子数量过多的表达式: 99999d99999d99999"""
+        with self.assertRaisesRegex(ValueError, "骰子数量过多"):
+            calculate("99999d99999d99999")
+
+    def test_power_tower_rejected(self):
+        """测试拒绝结果过大的乘方: 9^9^9, 2^d100000"""
+        with self.assertRaisesRegex(ValueError, "数值过大"):
+            calculate("9^9^9")
+        with self.assertRaisesRegex(ValueError, "数值过大"):
+            calculate("2^d100000")
+        with self.assertRaisesRegex(ValueError, "数值过大"):
+            calculate("2.5^2000")
+
+    def test_deep_nesting_rejected(self):
+        """测试拒绝嵌套过深的表达式"""
+        with self.assertRaisesRegex(ValueError, "嵌套过深"):
+            calculate("(" * 1000 + "1" + ")" * 1000)
+        with self.assertRaisesRegex(ValueError, "嵌套过深"):
+            calculate("-" * 1000 + "1")
+
+    def test_static_cost_of_nested_dice(self):
+        """测试嵌套骰子的静态开销: (2d4)d6 最多投掷 2 + 8 个骰子"""
+        cost = check_cost(compile_expression("(2d4)d6"))
+        self.assertEqual(10, cost.dice)
+        self.assertLessEqual(2 ** cost.bits, 64)
+
+    def test_custom_budget(self):
+        """测试自定义预算"""
+        budget = ExpressionBudget(max_dice=10)
+        self.assertLessEqual(calculate("(2d4)d6", budget=budget), 48)
+        with self.assertRaisesRegex(ValueError, "骰子数量过多"):
+            calculate("20d6", budget=budget)
+
+    def test_runtime_budget(self):
+        """测试运行时预算在求值过程中中止"""
+        node = compile_expression("2d6 + 2d6")
+        with self.assertRaisesRegex(ValueError, "骰子数量过多"):
+            node.evaluate(EvaluationContext(None, ExpressionBudget(max_dice=3)))
+        with self.assertRaisesRegex(ValueError, "运算次数过多"):
+            node.evaluate(EvaluationContext(None, ExpressionBudget(max_operations=2)))
+
+
+class TestDiceRollInfo(unittest.TestCase):
+    def test_compact_storage(self):
+        """测试点数保存在紧凑数组中"""
+        self.assertEqual('B', DiceRollInfo(3, 6, [1, 2, 3], 6).rolls.typecode)
+        self.assertEqual('H', DiceRollInfo(1, 1000, [999], 999).rolls.typecode)
+        self.assertEqual([2 ** 70], list(DiceRollInfo(1, 2 ** 80, [2 ** 70], 2 ** 70).rolls))
+
+    def test_format(self):
+        """测试投掷详情文本"""
+        self.assertEqual("D20=7", str(DiceRollInfo(1, 20, [7], 7)))
+        self.assertEqual("3D6=1+2+3=6", str(DiceRollInfo(3, 6, [1, 2, 3], 6)))
+        info = DiceRollInfo(30, 6, [1] * 30, 30, 1, 1)
+        self.assertEqual("30D6=1+1+1+…(另27个, 最小1, 最大1)=30", info.format(3))
+
+    def test_format_details_limit(self):
+        """测试多组详情的截断"""
+        details = [DiceRollInfo(1, 6, [1], 1)] * 3
+        self.assertEqual("D6=1\nD6=1\n…(另1组)", format_dice_details(details, detail_limit=2))
+
+
+class TestRandomSource(unittest.TestCase):
+    def test_seeded_source_is_deterministic(self):
+        """测试相同种子的随机数来源得到相同的投掷结果"""
+        for expression in ["3d6+1d100", "1000d6", "100d1000"]:
+            first: List[DiceRollInfo] = []
+            second: List[DiceRollInfo] = []
+            calculate(expression, first, rng=RandomSource(random.Random(7)))
+            calculate(expression, second, rng=RandomSource(random.Random(7)))
+            self.assertEqual([info.result for info in first], [info.result for info in second])
+            self.assertEqual([list(info.rolls) for info in first], [list(info.rolls) for info in second])
+
+
+class TestRepeatedRoll(unittest.TestCase):
+    def test_repeated_expression(self):
+        """测试重复投掷: 6#3d6*5"""
+        dice_info: List[DiceRollInfo] = []
+        results = calculate_repeated("6#3d6*5", dice_info)
+        self.assertEqual(6, len(results))
+        for result in results:
+            self.assertEqual(0, result % 5)
+            self.assertGreaterEqual(result, 15)
+            self.assertLessEqual(result, 90)
+        self.assertEqual(6, len(dice_info))
+
+    def test_without_repeat(self):
+        """测试不含 # 的表达式只计算一次"""
+        self.assertEqual([7], calculate_repeated("3+4"))
+
+    def test_invalid_times(self):
+        """测试非法的重复次数"""
+        for expression in ["0#d6", f"{MAX_REPEAT + 1}#d6", "1.5#d6", "#d6"]:
+            with self.assertRaisesRegex(ValueError, "重复次数", msg=expression):
+                calculate_repeated(expression)
+
+    def test_budget_is_shared(self):
+        """测试所有重复共享同一份预算"""
+        with self.assertRaisesRegex(ValueError, "骰子数量过多"):
+            calculate_repeated("4#3d6", budget=ExpressionBudget(max_dice=10))
+
+
+class TestConstantFolding(unittest.TestCase):
+    def test_dice_free_expression_folds_to_number(self):
+        """测试不含骰子的表达式在编译期折叠为常量: 50 * 5"""
+        node = compile_expression("50 * 5")
+        self.assertIsInstance(node, Number)
+        self.assertEqual(250, node.value)
+
+    def test_dice_sides_subtree_is_folded(self):
+        """测试骰子面数的常量子树被折叠: 3d(2+4)"""
+        node = compile_expression("3d(2+4)")
+        self.assertIsInstance(node, Dice)
+        self.assertIsInstance(node.sides, Number)
+        self.assertEqual(6, node.sides.value)
+
+    def test_only_random_parts_remain(self):
+        """测试常量部分折叠后仅保留骰子运算: 2d6 + (2 * 3)"""
+        node = compile_expression("2d6 + (2 * 3)")
+        self.assertIsInstance(node, BinaryOperation)
+        self.assertIsInstance(node.left, Dice)
+        self.assertIsInstance(node.right, Number)
+        self.assertEqual(6, node.right.value)
+
+    def test_malformed_expressions(self):
+        """测试格式错误的表达式"""
+        for expression in ["", "()", "3(4)", "1+", "*2"]:
+            with self.assertRaises(ValueError, msg=expression):
+                calculate(expression)
+        for expression in ["(1+2", "1+2)"]:
+            with self.assertRaisesRegex(ValueError, "括号不匹配", msg=expression):
+                calculate(expression)
+
+
 if __name__ == "__main__":
     # 运行测试
     unittest.main(verbosity=2)
@@ -0,0 +1,402 @@
+import math
+import unittest
+from functools import lru_cache
+from typing import List, Callable, Union
+
+from dice import compile_expression, Node, Number, Negate, BinaryOperation, Dice
+
+# 分布的取值范围上限
+MAX_SUPPORT = 100_000
+# 分布中所有频数的总位数上限，限制精确计算的大整数开销
+MAX_WEIGHT_BITS = 1 << 20
+# 两个随机变量逐对组合时的组合数上限，计算在事件循环中进行，需控制在几十毫秒内
+MAX_PAIRS = 100_000
+# 骰子数量或面数为随机变量时混合的情况数上限
+MAX_MIXTURE_CASES = 1000
+# 混合时计算各情况分布的估算开销上限（卷积处理的频数项数之和，约 1.5 微秒一项）
+MAX_MIXTURE_COST = 50_000
+# 频数列表长度小于该值时直接逐项卷积
+DIRECT_CONVOLUTION_LIMIT = 32
+
+
+def _convolve_direct(a: List[int], b: List[int]) -> List[int]:
+    result = [0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b):
+                result[i + j] += x * y
+    return result
+
+
+def convolve(a: List[int], b: List[int]) -> List[int]:
+    """
+    计算两个频数列表的卷积
+    较长的列表使用 Kronecker 代换：将频数打包为大整数，利用大整数乘法（Karatsuba）一次完成卷积，结果精确
+
+    Args:
+        a: 第一个频数列表
+        b: 第二个频数列表
+
+    Returns:
+        List[int]: 卷积结果，长度为 len(a) + len(b) - 1
+    """
+    if min(len(a), len(b)) < DIRECT_CONVOLUTION_LIMIT:
+        return _convolve_direct(a, b)
+    # 每个槽位需要容纳最大可能的系数，避免相邻槽位进位
+    slot_bits = (max(a) * max(b) * min(len(a), len(b))).bit_length()
+    width = slot_bits // 8 + 1
+    packed_a = int.from_bytes(b''.join(x.to_bytes(width, 'little') for x in a), 'little')
+    packed_b = int.from_bytes(b''.join(y.to_bytes(width, 'little') for y in b), 'little')
+    size = len(a) + len(b) - 1
+    data = (packed_a * packed_b).to_bytes(size * width, 'little')
+    return [int.from_bytes(data[i:i + width], 'little') for i in range(0, size * width, width)]
+
+
+class Distribution:
+    """
+    整数随机变量的精确分布
+    取值 offset + i 的概率为 weights[i] / total
+    """
+    __slots__ = ('offset', 'weights', 'total')
+
+    def __init__(self, offset: int, weights: List[int], total: int) -> None:
+        # 去掉两端概率为0的取值
+        start = 0
+        while start < len(weights) - 1 and weights[start] == 0:
+            start += 1
+        end = len(weights)
+        while end > start + 1 and weights[end - 1] == 0:
+            end -= 1
+        self.offset = offset + start
+        self.weights = weights[start:end]
+        self.total = total
+
+    @classmethod
+    def constant(cls, value: int) -> 'Distribution':
+        return cls(value, [1], 1)
+
+    @property
+    def minimum(self) -> int:
+        return self.offset
+
+    @property
+    def maximum(self) -> int:
+        return self.offset + len(self.weights) - 1
+
+    def values(self) -> range:
+        return range(self.minimum, self.maximum + 1)
+
+    def pmf(self, value: int) -> float:
+        """
+        取值恰好为 value 的概率
+        """
+        index = value - self.offset
+        if 0 <= index < len(self.weights):
+            return self.weights[index] / self.total
+        return 0.0
+
+    def cdf(self, value: Union[int, float]) -> float:
+        """
+        取值小于等于 value 的概率
+        """
+        index = math.floor(value) - self.offset
+        if index < 0:
+            return 0.0
+        if index >= len(self.weights) - 1:
+            return 1.0
+        return sum(self.weights[:index + 1]) / self.total
+
+    def probability(self, comparator: str, target: Union[int, float]) -> float:
+        """
+        计算取值与目标值比较成立的概率
+
+        Args:
+            comparator: 比较运算符，支持 <, <=, >, >=, =
+            target: 目标值
+
+        Returns:
+            float: 概率
+        """
+        if comparator == '<=':
+            return self.cdf(target)
+        if comparator == '<':
+            return self.cdf(math.ceil(target) - 1)
+        if comparator == '>':
+            return 1.0 - self.cdf(target)
+        if comparator == '>=':
+            return 1.0 - self.cdf(math.ceil(target) - 1)
+        if comparator == '=':
+            return self.pmf(target) if target == int(target) else 0.0
+        raise ValueError(f"不支持的比较运算符: {comparator}")
+
+    def _moment_sums(self) -> tuple[int, int]:
+        first = 0
+        second = 0
+        for index, weight in enumerate(self.weights):
+            if weight:
+                value = self.offset + index
+                first += weight * value
+                second += weight * value * value
+        return first, second
+
+    def mean(self) -> float:
+        first, _ = self._moment_sums()
+        return first / self.total
+
+    def variance(self) -> float:
+        first, second = self._moment_sums()
+        # 使用整数运算保证精确，最后才做除法
+        return (self.total * second - first * first) / (self.total * self.total)
+
+    def mode(self) -> int:
+        return self.offset + max(range(len(self.weights)), key=self.weights.__getitem__)
+
+    def __neg__(self) -> 'Distribution':
+        return Distribution(-self.maximum, self.weights[::-1], self.total)
+
+    def __add__(self, other: 'Distribution') -> 'Distribution':
+        _check_size(len(self.weights) + len(other.weights) - 1,
+                    self.total.bit_length() + other.total.bit_length())
+        return Distribution(self.offset + other.offset, convolve(self.weights, other.weights), self.total * other.total)
+
+    def __sub__(self, other: 'Distribution') -> 'Distribution':
+        return self + (-other)
+
+    def scale(self, factor: int) -> 'Distribution':
+        """
+        乘以常数
+        """
+        if factor == 0:
+            return Distribution.constant(0)
+        if factor < 0:
+            return (-self).scale(-factor)
+        _check_size((len(self.weights) - 1) * factor + 1, self.total.bit_length())
+        weights = [0] * ((len(self.weights) - 1) * factor + 1)
+        weights[::factor] = self.weights
+        return Distribution(self.offset * factor, weights, self.total)
+
+    def combine(self, other: 'Distribution', function: Callable[[int, int], int]) -> 'Distribution':
+        """
+        对两个独立随机变量的每一对取值应用 function，得到结果的分布
+        """
+        pairs = sum(1 for weight in self.weights if weight) * sum(1 for weight in other.weights if weight)
+        if pairs > MAX_PAIRS:
+            raise ValueError("分布过大，无法精确计算")
+        result: dict[int, int] = {}
+        for i, a_weight in enumerate(self.weights):
+            if not a_weight:
+                continue
+            for j, b_weight in enumerate(other.weights):
+                if not b_weight:
+                    continue
+                value = _require_integer(function(self.offset + i, other.offset + j))
+                result[value] = result.get(value, 0) + a_weight * b_weight
+        return Distribution.from_counts(result, self.total * other.total)
+
+    @classmethod
+    def from_counts(cls, counts: dict[int, int], total: int) -> 'Distribution':
+        minimum = min(counts)
+        size = max(counts) - minimum + 1
+        _check_size(size, total.bit_length())
+        weights = [0] * size
+        for value, weight in counts.items():
+            weights[value - minimum] = weight
+        return cls(minimum, weights, total)
+
+
+def _check_size(support: int, weight_bits: int) -> None:
+    if support > MAX_SUPPORT or support * weight_bits > MAX_WEIGHT_BITS:
+        raise ValueError("分布过大，无法精确计算")
+
+
+def _require_integer(value: Union[int, float]) -> int:
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("概率计算只支持整数")
+        return int(value)
+    return value
+
+
+@lru_cache(maxsize=256)
+def dice_distribution(count: int, sides: int) -> Distribution:
+    """
+    count 个 sides 面骰子点数之和的分布，使用平方求幂的方式做卷积并缓存结果
+
+    Args:
+        count: 骰子数量
+        sides: 骰子面数
+
+    Returns:
+        Distribution: 点数之和的分布
+    """
+    if count <= 0 or sides <= 0:
+        raise ValueError("骰子参数必须是正数")
+    _check_size(count * (sides - 1) + 1, math.ceil(count * math.log2(sides + 1)))
+    result = [1]
+    base = [1] * sides
+    remaining = count
+    while remaining:
+        if remaining & 1:
+            result = convolve(result, base)
+        remaining >>= 1
+        if remaining:
+            base = convolve(base, base)
+    return Distribution(count, result, sides ** count)
+
+
+def _mixture(count: Distribution, sides: Distribution) -> Distribution:
+    """
+    骰子数量或面数本身是随机变量时，按全概率公式混合各情况的分布
+    """
+    if count.minimum <= 0 or sides.minimum <= 0:
+        raise ValueError("骰子参数必须是正数")
+    # 在计算各情况的分布之前，先根据取值范围估算规模，过大的表达式直接拒绝
+    side_values = [sides.offset + j for j, weight in enumerate(sides.weights) if weight]
+    case_count = sum(1 for weight in count.weights if weight) * len(side_values)
+    if case_count > MAX_MIXTURE_CASES:
+        raise ValueError("分布过大，无法精确计算")
+    # 每种情况平方求幂约做 log2(数量) 次卷积，每次处理的项数不超过点数和的取值个数
+    side_span = sum(side - 1 for side in side_values)
+    cost = sum(c.bit_length() * (c * side_span + len(side_values))
+               for c in (count.offset + i for i, weight in enumerate(count.weights) if weight))
+    if cost > MAX_MIXTURE_COST:
+        raise ValueError("分布过大，无法精确计算")
+    # 公分母整除各面数的最大次幂之积，以此估算频数的位数
+    denominator_bits = math.ceil(count.maximum * sum(math.log2(side) for side in side_values))
+    _check_size(count.maximum * (sides.maximum - 1) + 1,
+                count.total.bit_length() + sides.total.bit_length() + denominator_bits)
+    cases = [
+        (count_weight * sides_weight, dice_distribution(count.offset + i, sides.offset + j))
+        for i, count_weight in enumerate(count.weights) if count_weight
+        for j, sides_weight in enumerate(sides.weights) if sides_weight
+    ]
+    denominator = math.lcm(*(case.total for _, case in cases))
+    result: dict[int, int] = {}
+    for weight, case in cases:
+        factor = weight * (denominator // case.total)
+        for index, case_weight in enumerate(case.weights):
+            if case_weight:
+                value = case.offset + index
+                result[value] = result.get(value, 0) + factor * case_weight
+    return Distribution.from_counts(result, count.total * sides.total * denominator)
+
+
+def node_distribution(node: Node) -> Distribution:
+    """
+    计算语法树对应随机变量的精确分布
+    """
+    if isinstance(node, Number):
+        return Distribution.constant(_require_integer(node.value))
+    if isinstance(node, Negate):
+        return -node_distribution(node.operand)
+    if isinstance(node, Dice):
+        count = node_distribution(node.count)
+        sides = node_distribution(node.sides)
+        if len(count.weights) == 1 and len(sides.weights) == 1:
+            return dice_distribution(count.offset, sides.offset)
+        return _mixture(count, sides)
+    if isinstance(node, BinaryOperation):
+        if node.operator == '/':
+            raise ValueError("概率计算不支持除法")
+        left = node_distribution(node.left)
+        right = node_distribution(node.right)
+        if node.operator == '+':
+            return left + right
+        if node.operator == '-':
+            return left - right
+        if node.operator == '*':
+            if len(right.weights) == 1:
+                return left.scale(right.offset)
+            if len(left.weights) == 1:
+                return right.scale(left.offset)
+        if node.operator == '^' and right.minimum < 0:
+            raise ValueError("概率计算只支持整数")
+        return left.combine(right, node.apply)
+    raise ValueError("表达式格式错误")
+
+
+@lru_cache(maxsize=128)
+def calculate_distribution(expression: str, default_sides: int = 100) -> Distribution:
+    """
+    计算骰子表达式结果的精确分布，不做随机抽样
+
+    Args:
+        expression: 中缀表达式字符串
+        default_sides: 默认的骰子面数
+
+    Returns:
+        Distribution: 结果的分布，调用方不应修改
+    """
+    return node_distribution(compile_expression(expression, default_sides))
+
+
+class TestDistribution(unittest.TestCase):
+    def test_two_d6(self):
+        """测试 2d6 的分布"""
+        distribution = calculate_distribution("2d6")
+        self.assertEqual(2, distribution.minimum)
+        self.assertEqual(12, distribution.maximum)
+        self.assertAlmostEqual(6 / 36, distribution.pmf(7))
+        self.assertAlmostEqual(1.0, distribution.cdf(12))
+        self.assertEqual(7, distribution.mode())
+
+    def test_mean_and_variance(self):
+        """测试 3d6 的期望与方差"""
+        distribution = calculate_distribution("3d6")
+        self.assertAlmostEqual(10.5, distribution.mean())
+        self.assertAlmostEqual(8.75, distribution.variance())
+
+    def test_sum_of_dice(self):
+        """测试 10d10+2d6 的分布"""
+        distribution = calculate_distribution("10d10+2d6")
+        self.assertEqual(12, distribution.minimum)
+        self.assertEqual(112, distribution.maximum)
+        self.assertAlmostEqual(55 + 7, distribution.mean())
+        self.assertAlmostEqual(10 * 8.25 + 2 * 35 / 12, distribution.variance())
+
+    def test_kronecker_convolution_matches_direct(self):
+        """测试大整数卷积与逐项卷积结果一致"""
+        a = [i * 7 % 13 for i in range(100)]
+        b = [i * i % 17 + 1 for i in range(80)]
+        self.assertEqual(_convolve_direct(a, b), convolve(a, b))
+
+    def test_random_dice_count(self):
+        """测试骰子数量为随机变量: (2d4)d6"""
+        distribution = calculate_distribution("(2d4)d6")
+        self.assertEqual(2, distribution.minimum)
+        self.assertEqual(48, distribution.maximum)
+        self.assertAlmostEqual(5 * 3.5, distribution.mean())
+
+    def test_constant_operations(self):
+        """测试与常数的运算: 2*d6-1, -d6"""
+        distribution = calculate_distribution("2*d6-1")
+        self.assertEqual([1, 3, 5, 7, 9, 11], [value for value in distribution.values() if distribution.pmf(value)])
+        self.assertAlmostEqual(-3.5, calculate_distribution("-d6").mean())
+
+    def test_probability(self):
+        """测试比较概率"""
+        distribution = calculate_distribution("1d100")
+        self.assertAlmostEqual(0.5, distribution.probability('<=', 50))
+        self.assertAlmostEqual(0.49, distribution.probability('<', 50))
+        self.assertAlmostEqual(0.5, distribution.probability('>', 50))
+        self.assertAlmostEqual(0.01, distribution.probability('=', 50))
+
+    def test_unsupported(self):
+        """测试不支持的表达式"""
+        with self.assertRaises(ValueError):
+            calculate_distribution("d6/2")
+        with self.assertRaises(ValueError):
+            calculate_distribution("100000d100")
+
+    def test_oversized_rejected_quickly(self):
+        """测试过大的表达式在计算前就被拒绝"""
+        import time
+        for expression in ["(1d100)d(1d100)", "(1d1000)d6", "(1d100)d6", "(1d1000)*(1d1000)"]:
+            start = time.perf_counter()
+            with self.assertRaises(ValueError):
+                calculate_distribution(expression)
+            self.assertLess(time.perf_counter() - start, 0.1, expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
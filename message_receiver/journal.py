@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from typing import List, Iterable
+
+# 日志段文件的扩展名
+SEGMENT_SUFFIX = ".log"
+
+
+def list_segments(directory: str) -> List[str]:
+    """
+    按写入顺序列出目录中的日志段文件
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory)
+                   if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_records(segments: Iterable[str]) -> List[list]:
+    """
+    按顺序读取日志段中的记录，崩溃时写了一半的记录会被跳过
+    """
+    records = []
+    for segment in segments:
+        with open(segment, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"跳过日志 {segment} 第 {line_number} 行的不完整记录")
+    return records
+
+
+class Journal:
+    """
+    用户修改日志
+    每次修改追加一条只包含修改后取值的记录（重复应用结果不变），由后台线程每隔 flush_interval 秒批量写入并刷入磁盘
+    存储保存一轮前先切换到新的日志段，保存成功后删除之前的日志段
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 0.005) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        # 已封存、等待存储保存成功后删除的日志段，包括上次运行遗留的日志段
+        # 遗留日志段中恢复失败的用户会留在 UserInfoStore 中待保存，因此这些日志段同样要等一轮保存全部成功后才删除
+        self.sealed: List[str] = list_segments(directory)
+        self.next_number = int(os.path.basename(self.sealed[-1])[:-len(SEGMENT_SUFFIX)]) + 1 if self.sealed else 0
+        self.file = self._open_segment()
+        self.pending: List[str] = []
+        self.condition = threading.Condition()
+        # 写入文件与切换日志段互斥
+        self.io_lock = threading.Lock()
+        self.running = True
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"{self.next_number:08d}{SEGMENT_SUFFIX}")
+        self.next_number += 1
+        return open(path, 'a', encoding='utf-8')
+
+    def append(self, record: list) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self.condition:
+            self.pending.append(line)
+            self.condition.notify()
+
+    def _write_pending(self) -> None:
+        # 调用方需持有 io_lock
+        with self.condition:
+            lines, self.pending = self.pending, []
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+            # 等待一小段时间，把这段时间内的修改合并为一次写入
+            time.sleep(self.flush_interval)
+            try:
+                with self.io_lock:
+                    self._write_pending()
+            except OSError as e:
+                logging.error(f"写入修改日志时出错: {e}")
+
+    def flush(self) -> None:
+        with self.io_lock:
+            self._write_pending()
+
+    def rotate(self) -> List[str]:
+        """
+        封存当前日志段并开始新的日志段
+
+        Returns:
+            List[str]: 所有尚未删除的已封存日志段
+        """
+        with self.io_lock:
+            self._write_pending()
+            self.file.close()
+            self.sealed.append(self.file.name)
+            self.file = self._open_segment()
+            return list(self.sealed)
+
+    def discard(self, segments: Iterable[str]) -> None:
+        """
+        删除内容已经全部保存到存储中的日志段
+        """
+        for segment in segments:
+            try:
+                os.remove(segment)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"删除日志段 {segment} 时出错: {e}")
+                continue
+            if segment in self.sealed:
+                self.sealed.remove(segment)
+
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.flush_thread.join()
+        with self.io_lock:
+            self._write_pending()
+            self.file.close()
+
+
+_journal: Journal or None = None
+
+
+def open_journal(directory: str, flush_interval: float = 0.005) -> Journal:
+    """
+    打开全局修改日志，之后用户与角色的修改都会写入该日志
+    """
+    global _journal
+    close_journal()
+    _journal = Journal(directory, flush_interval)
+    return _journal
+
+
+def get_journal() -> Journal or None:
+    return _journal
+
+
+def close_journal() -> None:
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        close_journal()
+        shutil.rmtree(self.directory)
+
+    def test_append_rotate_discard(self):
+        """测试追加、切换与删除日志段"""
+        journal = Journal(self.directory, flush_interval=0.001)
+        journal.append([1, "u", {"points": 3}])
+        journal.append([1, "u", {"points": 5}])
+        sealed = journal.rotate()
+        journal.append([2, "new", "甲"])
+        journal.flush()
+        self.assertEqual([[1, "u", {"points": 3}], [1, "u", {"points": 5}], [2, "new", "甲"]],
+                         read_records(list_segments(self.directory)))
+        journal.discard(sealed)
+        self.assertEqual([[2, "new", "甲"]], read_records(list_segments(self.directory)))
+        journal.close()
+
+    def test_torn_record_skipped(self):
+        """测试跳过崩溃时写了一半的记录，重新打开后遗留日志段被视为已封存"""
+        with open(os.path.join(self.directory, f"{3:08d}{SEGMENT_SUFFIX}"), 'w', encoding='utf-8') as f:
+            f.write('[1,"u",{"points":3}]\n[1,"u",{"poi')
+        self.assertEqual([[1, "u", {"points": 3}]], read_records(list_segments(self.directory)))
+        journal = Journal(self.directory)
+        self.assertEqual(1, len(journal.sealed))
+        self.assertTrue(journal.file.name.endswith(f"{4:08d}{SEGMENT_SUFFIX}"))
+        journal.close()
+
+    def test_replay(self):
+        """测试重放日志恢复用户修改"""
+        from storage import configure, JsonStorage
+        from user import UserInfoStore, UserInfo
+        configure(f"json:{os.path.join(self.directory, 'users')}")
+        try:
+            journal_directory = os.path.join(self.directory, "journal")
+            open_journal(journal_directory, flush_interval=0.001)
+            user = UserInfo(1, "a")
+            user.set_current_character("甲")
+            user.get_current_character_info().set_skill_value("侦查", 60)
+            user.rename_character("甲", "乙")
+            user.increase_points(3)
+            close_journal()
+
+            store = UserInfoStore()
+            self.assertEqual(1, store.recover(journal_directory))
+            store.stop()
+            self.assertEqual([], list_segments(journal_directory))
+            data = JsonStorage(os.path.join(self.directory, "users")).load_user(1)
+            self.assertEqual(3, data["points"])
+            self.assertEqual("乙", data["current_character_name"])
+            self.assertEqual({"侦查": 60}, data["characters"]["乙"]["skills"])
+        finally:
+            configure("json")
+
+    def test_failed_recovery_kept_until_saved(self):
+        """测试恢复时保存失败的用户留待之后保存，保存成功前不删除遗留日志段"""
+        from unittest.mock import patch
+        from storage import configure, JsonStorage
+        from user import UserInfoStore
+        configure(f"json:{os.path.join(self.directory, 'users')}")
+        try:
+            journal_directory = os.path.join(self.directory, "journal")
+            journal = Journal(journal_directory, flush_interval=0.001)
+            journal.append([1, "u", {"points": 42}])
+            journal.close()
+
+            store = UserInfoStore()
+            with patch.object(UserInfoStore, "_write", return_value=[]):
+                self.assertEqual(1, store.recover(journal_directory))
+            legacy = list_segments(journal_directory)
+            self.assertEqual(1, len(legacy))
+
+            open_journal(journal_directory, flush_interval=0.001)
+            # 再次保存失败时遗留日志段不会被删除
+            with patch.object(UserInfoStore, "_write", return_value=[]):
+                self.assertEqual(1, store.save_all_users().failed)
+            self.assertTrue(os.path.exists(legacy[0]))
+
+            stats = store.save_all_users()
+            self.assertEqual(1, stats.written)
+            self.assertEqual(42, JsonStorage(os.path.join(self.directory, "users")).load_user(1)["points"])
+            self.assertFalse(os.path.exists(legacy[0]))
+        finally:
+            configure("json")
+
+
+if __name__ == '__main__':
+    unittest.main()
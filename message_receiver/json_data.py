@@ -1,11 +1,26 @@
-import json
 import os
 import logging
+import tempfile
+import zlib
+from typing import Iterable, List
+
+from codec import Codec, decode, default_codec
+
+
+def _default_file_mode() -> int:
+    # 读取 umask 需要先设置再恢复，只在导入时读取一次
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# 新建文件的权限，与 open() 创建的文件一致
+DEFAULT_FILE_MODE = _default_file_mode()
 
 
 def load_data(file_path: str) -> dict[str, any]:
     """
-    从指定JSON文件加载数据
+    从指定文件加载数据，根据内容自动识别序列化格式
 
     Args:
         file_path: 数据文件路径
@@ -15,41 +30,106 @@ def load_data(file_path: str) -> dict[str, any]:
     """
     if os.path.exists(file_path):
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
+            with open(file_path, 'rb') as f:
+                return decode(f.read())
+        except (ValueError, IOError, zlib.error) as e:
             logging.error(f"加载数据文件 {file_path} 时出错: {e}")
             return {}
     return {}
 
 
-def save_data(file_path: str, data: dict[str, any]) -> bool:
+def make_directories(dir_name: str) -> List[str]:
     """
-    将数据保存到指定JSON文件
+    创建目录及不存在的上级目录
+
+    Args:
+        dir_name: 目录路径
+
+    Returns:
+        List[str]: 新建目录所在的上级目录，需要刷入磁盘才能使新建的目录在断电后仍然存在
+    """
+    missing = []
+    current = os.path.abspath(dir_name)
+    while not os.path.isdir(current):
+        missing.append(current)
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    if not missing:
+        return []
+    os.makedirs(dir_name, exist_ok=True)
+    logging.info(f"创建目录 {dir_name}")
+    return [os.path.dirname(path) for path in missing]
+
+
+def save_data(file_path: str, data: dict[str, any], fsync_dir: bool = True, codec: Codec or None = None) -> bool:
+    """
+    将数据保存到指定文件
+    先写入同目录下的临时文件并刷入磁盘，再原子替换目标文件，写入中途崩溃不会损坏原文件
 
     Args:
         data: 要保存的数据
         file_path: 数据文件路径
+        fsync_dir: 是否立即将目录项刷入磁盘，批量保存时可关闭，由调用方预先调用 make_directories 并在最后调用 sync_directories
+        codec: 序列化格式，默认使用 codec.configure 配置的格式
 
     Returns:
         操作是否成功
     """
+    # 获取文件的绝对路径
+    abs_file_path = os.path.abspath(file_path)
+    dir_name = os.path.dirname(abs_file_path)
+    temp_path = None
     try:
-        # 获取文件的绝对路径
-        abs_file_path = os.path.abspath(file_path)
-        dir_name = os.path.dirname(abs_file_path)
-
-        # 确保目录存在（只有非空目录名才创建）
-        if dir_name and not os.path.exists(dir_name):
-            os.makedirs(dir_name, exist_ok=True)
-            logging.info(f"创建目录 {dir_name}")
-        else:
-            # 如果没有目录部分，则使用当前目录
-            dir_name = '.'
-
-        with open(abs_file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # 确保目录存在
+        created_parents = make_directories(dir_name)
+
+        raw = (codec or default_codec()).encode(data)
+        fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(abs_file_path)}.", suffix=".tmp", dir=dir_name)
+        # mkstemp 创建的文件权限为 0600，替换前改为原文件的权限，新文件则使用默认权限
+        try:
+            mode = os.stat(abs_file_path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = DEFAULT_FILE_MODE
+        os.chmod(temp_path, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, abs_file_path)
+        temp_path = None
+        if fsync_dir:
+            sync_directories([dir_name, *created_parents])
         return True
-    except IOError as e:
+    except (IOError, TypeError, ValueError) as e:
         logging.error(f"保存数据到 {file_path} 时出错: {e}")
         return False
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+def sync_directories(dir_names: Iterable[str]) -> None:
+    """
+    将目录项刷入磁盘，使替换后的文件在断电后仍然可见
+    同一目录只需刷入一次，批量写入多个文件后统一调用以分摊开销
+
+    Args:
+        dir_names: 目录路径
+    """
+    for dir_name in set(dir_names):
+        try:
+            fd = os.open(dir_name, os.O_RDONLY)
+        except OSError:
+            # 部分平台（如 Windows）不支持打开目录
+            continue
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.error(f"刷新目录 {dir_name} 时出错: {e}")
+        finally:
+            os.close(fd)
@@ -1,22 +1,27 @@
 import atexit
 import json
-import random
+import os
 import asyncio
-import time
 from logging.handlers import TimedRotatingFileHandler
-import re
 import websockets
 import logging
 import signal
-from typing import List
-from dice import calculate as calculate_dice_expression, DiceRollInfo
+from random_source import configure as configure_random_source, get_stream
+from storage import configure as configure_storage, get_storage
+from codec import configure as configure_codec
+from journal import open_journal, close_journal, list_segments
+from pipeline import MessagePipeline, KeyedLock
 from message import TextMessage, send_message, GroupTextMessage, UserTextMessage
-from skill import pass_skill_value_expression, calculate_skill_roll_expression, SkillRollResult
-from user import UserInfoStore, UserInfo, CharacterInfo
+from command import CommandContext
+from commands import router
+from user import UserInfoStore, UserInfo
 
 # 全局用户信息缓存实例
 user_infos = UserInfoStore()
 
+# 按发送者互斥，流水线只保证同一群或私聊内的顺序
+sender_locks = KeyedLock()
+
 # 用于标识是否已执行清理
 cleanup_done = False
 
@@ -26,6 +31,8 @@ def cleanup():
     if not cleanup_done:
         logging.info("执行清理操作...")
         user_infos.stop()
+        close_journal()
+        get_storage().close()
         cleanup_done = True
 
 
@@ -46,94 +53,42 @@ async def async_input(prompt: str = "") -> str:
     return await loop.run_in_executor(None, input, prompt)
 
 
-async def receive_messages(ws):
+def message_key(message_dict: dict) -> str:
+    """
+    消息的顺序键：群聊按群、私聊按发送者，同一个键的消息按收到的顺序处理
+    同一用户在不同键中的指令由 sender_locks 保证依次执行
+    """
+    if "group_id" in message_dict:
+        return f"group:{message_dict['group_id']}"
+    return f"user:{message_dict.get('sender', {}).get('user_id')}"
+
+
+async def receive_messages(ws, pipeline: MessagePipeline):
+    """
+    读取消息并提交到流水线，队列已满时在这里等待，不再继续读取
+    """
     while True:
         try:
             message = await ws.recv()
             message_dict = json.loads(message)
 
-            if "self_id" not in message_dict:
+            if "self_id" not in message_dict or "sender" not in message_dict or "message" not in message_dict:
                 continue
 
-            self_id: int = message_dict["self_id"]
-            group_id: int or None = None
-            if "group_id" in message_dict:
-                group_id = message_dict["group_id"]
-
-            if "sender" in message_dict and "message" in message_dict:
-                sender = message_dict["sender"]
-                if "user_id" not in sender or "nickname" not in sender:
-                    continue
-
-                sender_id: int = sender["user_id"]
-                if self_id == sender_id:
-                    continue
-
-                logging.info(f"收到消息: {message_dict}")
-
-                sender_nickname = sender["nickname"]
-                messages = message_dict["message"]
+            sender = message_dict["sender"]
+            messages = message_dict["message"]
+            if "user_id" not in sender or "nickname" not in sender or not isinstance(messages, list):
+                continue
+            if message_dict["self_id"] == sender["user_id"]:
+                continue
 
-                if not isinstance(messages, list):
-                    continue
+            # 消息中含有指令时提前读取发送者信息，与排队等待并行
+            if any(isinstance(message, dict) and message.get("type") == "text"
+                   and str(message.get("data", {}).get("text", "")).lstrip().startswith(('.', '。'))
+                   for message in messages):
+                user_infos.prefetch(sender["user_id"], sender["nickname"])
 
-                has_at = False
-                at_self = False
-                message_results: list[TextMessage] = []
-
-                for message in messages:
-                    if "type" not in message:
-                        continue
-                    message_type = message["type"]
-
-                    # 处理文本消息
-                    if message_type == "text":
-                        if "data" not in message:
-                            continue
-                        message_data = message["data"]
-                        if "text" not in message_data:
-                            continue
-
-                        message_text: str = message_data["text"]
-                        stripped_message = message_text.lstrip()
-                        if stripped_message.startswith(('.', '。')):
-                            command = stripped_message.strip()
-                            if len(command) == 1:
-                                continue
-                            commands = command.split('\n')
-                            for single_command in commands:
-                                single_command = single_command.strip()
-                                # 检查每行是否以 . 或 。 开头
-                                if single_command.startswith(('.', '。')):
-                                    # 如果是，则去掉前缀并执行命令
-                                    actual_command = single_command[1:].strip()
-                                    if len(actual_command) > 0:  # 忽略空行
-                                        result: TextMessage or list[TextMessage] = (
-                                            execute_command(actual_command, sender_id, sender_nickname, group_id)
-                                        )
-                                        if isinstance(result, TextMessage):
-                                            message_results.append(result)
-                                        elif isinstance(result, list):
-                                            message_results.extend(result)
-
-                    elif message_type == "at":
-                        has_at = True
-                        if "data" not in message:
-                            continue
-
-                        message_data = message["data"]
-                        if "qq" in message_data:
-                            at_qq: str = message_data["qq"]
-                            if at_qq == str(self_id) or at_qq == "all":
-                                at_self = True
-
-                if (
-                        has_at and at_self
-                ) or (
-                        not has_at
-                ):
-                    for result in message_results:
-                        await send_message(ws, result)
+            await pipeline.submit(message_key(message_dict), message_dict)
 
         except websockets.exceptions.ConnectionClosed:
             logging.info("WebSocket 连接已关闭")
@@ -144,198 +99,103 @@ async def receive_messages(ws):
             logging.error(f"发生未知错误: {e}")
 
 
-def execute_command(
+async def handle_message(ws, message_dict: dict):
+    self_id: int = message_dict["self_id"]
+    group_id: int or None = None
+    if "group_id" in message_dict:
+        group_id = message_dict["group_id"]
+
+    sender = message_dict["sender"]
+    sender_id: int = sender["user_id"]
+
+    logging.info(f"收到消息: {message_dict}")
+
+    sender_nickname = sender["nickname"]
+    messages = message_dict["message"]
+
+    has_at = False
+    at_self = False
+    message_results: list[TextMessage] = []
+
+    for message in messages:
+        if "type" not in message:
+            continue
+        message_type = message["type"]
+
+        # 处理文本消息
+        if message_type == "text":
+            if "data" not in message:
+                continue
+            message_data = message["data"]
+            if "text" not in message_data:
+                continue
+
+            message_text: str = message_data["text"]
+            stripped_message = message_text.lstrip()
+            if stripped_message.startswith(('.', '。')):
+                command = stripped_message.strip()
+                if len(command) == 1:
+                    continue
+                commands = command.split('\n')
+                for single_command in commands:
+                    single_command = single_command.strip()
+                    # 检查每行是否以 . 或 。 开头
+                    if single_command.startswith(('.', '。')):
+                        # 如果是，则去掉前缀并执行命令
+                        actual_command = single_command[1:].strip()
+                        if len(actual_command) > 0:  # 忽略空行
+                            # 同一用户在不同群或私聊中的指令依次执行
+                            async with sender_locks.hold(sender_id):
+                                result: TextMessage or list[TextMessage] = (
+                                    await execute_command(actual_command, sender_id, sender_nickname, group_id)
+                                )
+                            if isinstance(result, TextMessage):
+                                message_results.append(result)
+                            elif isinstance(result, list):
+                                message_results.extend(result)
+
+        elif message_type == "at":
+            has_at = True
+            if "data" not in message:
+                continue
+
+            message_data = message["data"]
+            if "qq" in message_data:
+                at_qq: str = message_data["qq"]
+                if at_qq == str(self_id) or at_qq == "all":
+                    at_self = True
+
+    if (
+            has_at and at_self
+    ) or (
+            not has_at
+    ):
+        for result in message_results:
+            await send_message(ws, result)
+
+
+async def execute_command(
         command: str, sender_id: int, sender_nickname: str, group_id: int or None = None
 ) -> TextMessage or list[TextMessage]:
     # 记录执行的命令
     logging.info(f"用户 {sender_nickname}({sender_id}) 执行命令: {command}")
 
-    # 获取当前日期的时间戳（当天0点的时间戳）
-    current_date = time.localtime()
-    today_start = time.mktime((current_date.tm_year, current_date.tm_mon, current_date.tm_mday, 0, 0, 0, 0, 0, 0))
-    today_start_ns = int(today_start * 1_000_000_000)  # 转换为纳秒
-
-    current_user: UserInfo = user_infos.get_user(sender_id, sender_nickname)
-    current_user_nickname = current_user.nickname
-    current_character: CharacterInfo or None = None
-    if current_user.current_character_name is not None:
-        current_character = current_user.get_current_character_info()
+    # 群聊按群、私聊按用户区分随机数流
+    rng = get_stream(f"group:{group_id}" if group_id is not None else f"user:{sender_id}")
 
-    def to_user_message(message: str) -> UserTextMessage:
-        return UserTextMessage(sender_id, message)
+    current_user: UserInfo = await user_infos.get_user(sender_id, sender_nickname)
 
-    def to_text_message(message: str) -> TextMessage:
-        if group_id is not None:
-            return GroupTextMessage(group_id, message)
-        else:
-            return UserTextMessage(sender_id, message)
+    def create_context(name: str) -> CommandContext:
+        return CommandContext(command, name, sender_id, sender_nickname, group_id, current_user, rng, user_infos)
 
-    def roll_dice(expression: str) -> str:
-        try:
-            if len(expression) == 0:
-                expression = "d"
-            dice_infos: List[DiceRollInfo] = []
-            result = calculate_dice_expression(expression, dice_infos)
-            dice_info_strs = [str(info) for info in dice_infos]
-            dice_info_strs_join = "\n".join(dice_info_strs)
-            dice_info_str = f"[\n{dice_info_strs_join}\n]"
-            return f"{current_user_nickname} 掷出了 {result}{dice_info_str}" if (
-                        len(dice_infos) > 0
-                ) else f"{current_user_nickname} 计算得到 {result}"
-        except ValueError as e:
-            return f"值错误: {str(e)}"
-        except Exception as e:
-            return f"未知错误: {str(e)}"
-
-    def roll_skill(expression: str, current_character: CharacterInfo or None) -> str:
-        if current_character is None:
-            current_user.set_current_character(current_user_nickname)
-            current_character = current_user.get_current_character_info()
-        result: SkillRollResult = calculate_skill_roll_expression(expression, current_character)
-        return f"{current_character.name} 投掷技能 {result.skill_name} ({result.roll_result}/{result.skill_value})，{result.success_type}~"
-
-    lower_command = command.lower()
-    if lower_command == "info":
-        return to_text_message(
-            "自律型外星追车油炸土拨鼠鸡蛋土豆饼bot by potmot(377029227)\n纯文本指令匹配，无协议无核心（")
-
-    if lower_command == "help":
-        return to_text_message("支持的指令: \n.help\n.info\n.pot\n.pot show\n.mot\n.pc new\n.pc del\n.pc list\n.pc use\n.pc show\n.pc rename\n.st\n.st show\n.st del\n.nn\n.r\n.rd\n.ra\n")
-
-    if lower_command.startswith("pot"):
-        if re.match(r"pot\s+show", lower_command):
-            return to_text_message(f"{current_user_nickname} 现在有 {current_user.points} 个土豆")
-
-        if current_user.last_point_get_time > today_start_ns:
-            return to_text_message("今日份土豆已发放~")
-
-        potato_count: int = random.randint(1, 6)
-        if potato_count == 1:
-            if random.randint(1, 100) == 100:
-                potato_count = 100
-        current_user.increase_points(potato_count)
-        current_user.last_point_get_time = time.time_ns()
-        return to_text_message(f"{current_user_nickname} 获得了 {potato_count} 个土豆")
-
-    if lower_command == "mot":
-        voice_force = random.randint(1, 240)
-        return to_text_message(f"{current_user_nickname} 触碰土拨鼠，土拨鼠发出了 {voice_force} db 的尖叫")
-
-    if lower_command == "jrrp":
-        if current_user.last_lucky_point_check_time < today_start_ns:
-            current_user.lucky_points = random.randint(1, 100)
-            current_user.last_lucky_point_check_time = time.time_ns()
-        return to_text_message(f"{current_user_nickname} 今日人品为 {current_user.lucky_points}")
-
-    # 角色部分
-    if lower_command.startswith("pc"):
-        expression = command[2:].strip()
-        if expression.lower().startswith("new"):
-            name = expression[3:].strip()
-            if name == "":
-                return to_text_message(f"{current_user_nickname} 角色名称不能为空")
-            current_user.set_current_character(name)
-            return to_text_message(f"{current_user_nickname} 创建了角色 {name}")
-        if expression.lower().startswith("list"):
-            character_names = "\n".join(list(current_user.characters.keys()))
-            return to_text_message(f"{current_user_nickname} 的角色列表: \n{character_names}")
-        if expression.lower().startswith("use"):
-            name = expression[3:].strip()
-            current_user.set_current_character(name)
-            return to_text_message(f"{current_user_nickname} 切换角色为 {name}")
-        if expression.lower().startswith("del"):
-            name = expression[3:].strip()
-            if name == "":
-                return to_text_message(f"{current_user_nickname} 角色名称不能为空")
-            if name in current_user.characters:
-                current_user.remove_character(name)
-                return to_text_message(f"{current_user_nickname} 删除了角色 {name}")
-            else:
-                return to_text_message(f"{current_user_nickname} 不存在角色 {name}")
-        if expression.lower().startswith("show"):
-            name = expression[4:].strip()
-            if name == "":
-                name = current_user.current_character_name
-            character: CharacterInfo = current_user.get_character_info(name)
-            character_skill_str = "\n".join([f"{skill_name}: {skill_value}" for skill_name, skill_value in current_character.skills.items()])
-            return to_text_message(f"{current_user_nickname} 角色 {character.name}\nhp: {character.get_current_hp()}/{character.get_max_hp()}\n{character_skill_str}")
-
-        if expression.lower().startswith("rename"):
-            expression = expression[6:].strip()
-            names = expression.split(" ")
-            if len(names) == 1 and len(names[0]) > 0:
-                current_character.name = names[0]
-                return to_text_message(f"{current_user_nickname} 角色 {current_character.name} 重命名为 {names[0]}")
-            elif len(names) == 2 and len(names[0]) > 0 and len(names[1]) > 0:
-                old_name = names[0]
-                new_name = names[1]
-                if old_name in current_user.characters:
-                    old_character = current_user.characters.pop(old_name)
-                    old_character.name = new_name
-                    current_user.characters[new_name] = old_character
-                    return to_text_message(f"{current_user_nickname} 角色 {old_name} 重命名为 {new_name}")
-
-    # 名称部分
-    if lower_command.startswith("nn"):
-        name = command[2:].strip()
-        if name == "":
-            current_user.nickname = sender_nickname
-            current_user_nickname = sender_nickname
-            return to_text_message(f"{current_user_nickname} 昵称已修改为 {sender_nickname}")
-        else:
-            current_user.nickname = name
-            return to_text_message(f"{current_user_nickname} 昵称已修改为 {name}")
-
-    # 设置技能
-    if lower_command.startswith("st"):
-        expression = command[2:].strip()
-        if current_character is None:
-            current_user.set_current_character(current_user_nickname)
-            current_character: CharacterInfo = current_user.get_current_character_info()
-
-        if expression.lower().startswith("show"):
-            character_skill_str = "\n".join([f"{skill_name}: {skill_value}" for skill_name, skill_value in current_character.skills.items()])
-            return to_text_message(f"{current_character.name} 当前技能\n{character_skill_str}")
-        if expression.lower().startswith("del"):
-            skill_names: list[str] = expression[3:].split(" ")
-            removed_skill_names: list[str] = []
-            for skill_name in skill_names:
-                if skill_name in current_character.skills:
-                    current_character.remove_skill(skill_name)
-                    removed_skill_names.append(skill_name)
-            removed_skill_str = "\n".join(removed_skill_names)
-            return to_text_message(f"{current_character.name} 移除了技能\n{removed_skill_str}")
-        else:
-            skill_values = pass_skill_value_expression(expression)
-            set_skill_str = "\n".join([f"{skill_name}：{skill_value}" for skill_name, skill_value in skill_values.items()])
-            for skill_name, skill_value in skill_values.items():
-                current_character.set_skill_value(skill_name, skill_value)
-            return to_text_message(f"{current_character.name} 设置了技能\n{set_skill_str}")
-
-    # 投掷技能
-    if lower_command.startswith("rah"):
-        expression = command[3:].strip().replace(" ", "")
-        return [
-            to_text_message(f"{current_character.name} 秘密投掷了技能"),
-            to_user_message(roll_skill(expression, current_character))
-        ]
-    if lower_command.startswith("ra"):
-        expression = command[2:].strip().replace(" ", "")
-        return to_text_message(roll_skill(expression, current_character))
-
-    # 投掷普通骰子
-    if lower_command.startswith("rh"):
-        expression = lower_command[2:].strip().replace(" ", "")
-        return [
-            to_text_message(f"{current_character.name} 秘密投掷了骰子"),
-            to_user_message(roll_dice(expression))
-        ]
-    if lower_command.startswith("r"):
-        expression = lower_command[1:].strip().replace(" ", "")
-        return to_text_message(roll_dice(expression))
+    result = await router.dispatch(create_context, command)
+    if result is not None:
+        return result
 
     # 未知指令
-    return to_text_message(f"未知指令: {command}\n支持的指令请执行.help")
+    if group_id is not None:
+        return GroupTextMessage(group_id, f"未知指令: {command}\n支持的指令请执行.help")
+    return UserTextMessage(sender_id, f"未知指令: {command}\n支持的指令请执行.help")
 
 
 async def main():
@@ -357,16 +217,77 @@ async def main():
     timed_handler.setFormatter(logging.Formatter(log_format))
     logging.getLogger().addHandler(timed_handler)
 
+    # 随机数后端，如 QQ_BOT_RNG=seeded:12345 可使每个群的投掷序列确定、可重放
+    random_spec = os.environ.get("QQ_BOT_RNG")
+    if random_spec:
+        configure_random_source(random_spec)
+        logging.info(f"随机数后端: {random_spec}")
+
+    # 用户文件的序列化格式，如 QQ_BOT_CODEC=json-compact，读取时自动识别，已有文件不受影响
+    codec_name = os.environ.get("QQ_BOT_CODEC")
+    if codec_name:
+        configure_codec(codec_name)
+        logging.info(f"序列化格式: {codec_name}")
+
+    # 存储后端，如 QQ_BOT_STORAGE=sqlite:users.db，默认为 users 目录下的 JSON 文件
+    storage_spec = os.environ.get("QQ_BOT_STORAGE")
+    if storage_spec:
+        configure_storage(storage_spec)
+        logging.info(f"存储后端: {storage_spec}")
+
+    # 用户缓存上限，如 QQ_BOT_CACHE_USERS=5000、QQ_BOT_CACHE_MB=32
+    if os.environ.get("QQ_BOT_CACHE_USERS"):
+        user_infos.max_users = int(os.environ["QQ_BOT_CACHE_USERS"])
+    if os.environ.get("QQ_BOT_CACHE_MB"):
+        user_infos.max_bytes = int(float(os.environ["QQ_BOT_CACHE_MB"]) * 1024 * 1024)
+
+    # 修改日志目录，重启时重放上次未保存的修改，QQ_BOT_JOURNAL=off 时关闭
+    journal_directory = os.environ.get("QQ_BOT_JOURNAL", "journal")
+    recovered = 0
+    unrecovered_segments = []
+    if journal_directory != "off":
+        recovered = user_infos.recover(journal_directory)
+        # 恢复失败时遗留的日志段仍然存在
+        unrecovered_segments = list_segments(journal_directory)
+        open_journal(journal_directory)
+
+    # 最近活跃用户的快照，启动时一次读入预热缓存，QQ_BOT_SNAPSHOT=off 时关闭
+    snapshot_path = os.environ.get("QQ_BOT_SNAPSHOT", "users.snapshot")
+    if snapshot_path != "off":
+        user_infos.snapshot_path = snapshot_path
+        if (recovered or unrecovered_segments) and os.path.exists(snapshot_path):
+            # 修改日志中的数据比快照更新，丢弃快照
+            os.remove(snapshot_path)
+        else:
+            user_infos.load_snapshot()
+
+    # 消息处理的并发数与积压上限，如 QQ_BOT_WORKERS=8、QQ_BOT_QUEUE_SIZE=1000、QQ_BOT_QUEUE_TIMEOUT=0.5、
+    # QQ_BOT_QUEUE_PER_CHAT=50（单个群或私聊的积压上限）
+    workers = int(os.environ.get("QQ_BOT_WORKERS", "8"))
+    queue_size = int(os.environ.get("QQ_BOT_QUEUE_SIZE", "1000"))
+    queue_timeout = float(os.environ.get("QQ_BOT_QUEUE_TIMEOUT", "0.5"))
+    queue_per_chat = int(os.environ.get("QQ_BOT_QUEUE_PER_CHAT", "50"))
+
     uri = "ws://localhost:3001"
 
+    # 用户信息的定期保存与清理在事件循环中进行
+    save_task = asyncio.create_task(user_infos.run())
     try:
         async with websockets.connect(uri) as websocket:
             logging.info(f"已连接到WebSocket服务器: {uri}")
-            await asyncio.create_task(receive_messages(websocket))
+            pipeline = MessagePipeline(lambda message_dict: handle_message(websocket, message_dict),
+                                       workers, queue_size, queue_timeout, queue_per_chat)
+            pipeline.start()
+            try:
+                await receive_messages(websocket, pipeline)
+            finally:
+                await pipeline.stop()
             stop_event = asyncio.Event()
             await stop_event.wait()  # 永远等待
     except Exception as e:
         logging.error(f"WebSocket连接失败: {e}")
+    finally:
+        save_task.cancel()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,17 @@ import json
 import uuid
 
 
+# 单条消息的最大字符数，超出部分会被截断，避免平台拒绝发送
+MAX_TEXT_LENGTH = 3000
+
+
+def truncate_text(text: str, max_length: int = MAX_TEXT_LENGTH) -> str:
+    if len(text) <= max_length:
+        return text
+    suffix = f"…(已截断{len(text) - max_length}字)"
+    return text[:max_length - len(suffix)] + suffix
+
+
 class TextMessage:
     text: str
 
@@ -32,7 +43,7 @@ async def send_message(websocket, message: TextMessage):
                 "message": {
                     "type": "text",
                     "data": {
-                        "text": message.text
+                        "text": truncate_text(message.text)
                     }
                 }
             },
@@ -46,7 +57,7 @@ async def send_message(websocket, message: TextMessage):
                 "message": {
                     "type": "text",
                     "data": {
-                        "text": message.text
+                        "text": truncate_text(message.text)
                     }
                 }
             },
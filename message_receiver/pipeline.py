@@ -0,0 +1,325 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+import unittest
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, List
+
+
+@dataclass
+class PipelineStats:
+    """
+    消息处理的统计
+    """
+    accepted: int = 0
+    processed: int = 0
+    failed: int = 0
+    # 队列已满且等待超时后被丢弃的消息数
+    shed: int = 0
+    # 所在子队列积压过多而被直接丢弃的消息数
+    key_shed: int = 0
+    # 队列中同时等待处理的最多消息数
+    max_pending: int = 0
+
+
+class MessagePipeline:
+    """
+    消息处理流水线
+    读取消息的一方调用 submit 把消息放入对应键（群或私聊用户）的子队列，多个工作协程并发处理不同键的消息
+    同一个键的消息同一时间只由一个工作协程处理，保证顺序；处理完一条后该键排到就绪队列末尾，各键轮流处理
+    单个键积压的消息达到 max_pending_per_key 时直接丢弃该键的新消息，刷屏的群不会占满整个队列而拖慢其他群
+    等待处理的消息总数达到 max_pending 时 submit 最多等待 put_timeout 秒，超时后丢弃该消息
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int = 8, max_pending: int = 1000,
+                 put_timeout: float = 0.5, max_pending_per_key: int = 50) -> None:
+        """
+        Args:
+            handler: 处理单条消息的协程函数，抛出的异常会被记录，不影响后续消息
+            workers: 工作协程数量，即最多同时处理的键数
+            max_pending: 等待处理的消息总数上限
+            put_timeout: 队列已满时提交消息的最长等待时间（秒）
+            max_pending_per_key: 单个键等待处理的消息数上限
+        """
+        self.handler = handler
+        self.worker_count = workers
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_pending_per_key = max_pending_per_key
+        self.stats = PipelineStats()
+        # 每个键的子队列，键正在处理或等待处理时才存在
+        self.queues: Dict[Hashable, Deque[Any]] = {}
+        # 有消息等待处理、且没有工作协程正在处理的键
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.pending = 0
+        # 有消息处理完成时通知等待空位的提交方
+        self.space = asyncio.Condition()
+        self.workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for index in range(self.worker_count):
+            self.workers.append(asyncio.create_task(self._work(), name=f"pipeline-worker-{index}"))
+
+    async def submit(self, key: Hashable, item: Any) -> bool:
+        """
+        提交一条消息
+
+        Returns:
+            bool: 是否已放入队列，该键积压过多或队列已满且等待超时时返回 False
+        """
+        queue = self.queues.get(key)
+        if queue is not None and len(queue) >= self.max_pending_per_key:
+            # 只丢弃积压过多的键自己的消息，不阻塞读取其他键的消息
+            self.stats.key_shed += 1
+            logging.warning(f"{key} 积压了 {len(queue)} 条消息，丢弃新消息，累计丢弃 {self.stats.key_shed} 条")
+            return False
+
+        if self.pending >= self.max_pending:
+            try:
+                async with self.space:
+                    await asyncio.wait_for(self.space.wait_for(lambda: self.pending < self.max_pending),
+                                           self.put_timeout)
+            except asyncio.TimeoutError:
+                self.stats.shed += 1
+                logging.warning(f"消息队列已满（{self.pending} 条），丢弃来自 {key} 的消息，累计丢弃 {self.stats.shed} 条")
+                return False
+
+        self.pending += 1
+        self.stats.accepted += 1
+        self.stats.max_pending = max(self.stats.max_pending, self.pending)
+        # 等待空位期间子队列可能已被处理完并移除
+        queue = self.queues.get(key)
+        if queue is None:
+            # 该键没有正在处理或等待处理的消息，排入就绪队列
+            self.queues[key] = collections.deque((item,))
+            self.ready.put_nowait(key)
+        else:
+            queue.append(item)
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            item = queue.popleft()
+            try:
+                await self.handler(item)
+                self.stats.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.failed += 1
+                logging.error(f"处理来自 {key} 的消息时出错: {e}")
+            finally:
+                self.pending -= 1
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
+            async with self.space:
+                self.space.notify()
+
+    async def join(self, timeout: float or None = None) -> bool:
+        """
+        等待所有已提交的消息处理完成
+
+        Returns:
+            bool: 是否在超时前全部处理完成
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    async def stop(self, timeout: float = 5) -> None:
+        """
+        等待已提交的消息处理完成（最多 timeout 秒）后停止工作协程
+        """
+        if not await self.join(timeout):
+            logging.warning(f"停止时仍有 {self.pending} 条消息未处理")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+        logging.info(f"消息处理统计: 接收 {self.stats.accepted}，完成 {self.stats.processed}，"
+                     f"出错 {self.stats.failed}，丢弃 {self.stats.shed + self.stats.key_shed}（其中单键积压 {self.stats.key_shed}），"
+                     f"最大积压 {self.stats.max_pending}")
+
+
+class KeyedLock:
+    """
+    按键互斥的锁，同一个键的持有者按申请顺序依次执行，没有持有者或等待者的键会被移除
+    用于让同一用户在不同群或私聊中的指令依次执行
+    """
+
+    def __init__(self) -> None:
+        # 键 -> [锁, 持有及等待的数量]
+        self.locks: Dict[Hashable, list] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self.locks[key] = entry
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+
+class TestMessagePipeline(unittest.TestCase):
+    def test_ordering_per_key(self):
+        """测试同一个键的消息按提交顺序处理，不同键的消息并发处理"""
+        handled: List[tuple] = []
+        running: Dict[str, int] = collections.Counter()
+        overlap: List[bool] = []
+
+        async def handler(item):
+            key, index = item
+            running[key] += 1
+            overlap.append(running[key] > 1)
+            await asyncio.sleep(0.001 * (3 - index % 3))
+            handled.append(item)
+            running[key] -= 1
+
+        async def run():
+            pipeline = MessagePipeline(handler, workers=4)
+            pipeline.start()
+            for index in range(9):
+                for key in ("a", "b", "c"):
+                    self.assertTrue(await pipeline.submit(key, (key, index)))
+            await pipeline.stop()
+            return pipeline
+
+        pipeline = asyncio.run(run())
+        self.assertEqual(27, pipeline.stats.processed)
+        self.assertFalse(any(overlap))
+        for key in ("a", "b", "c"):
+            self.assertEqual(list(range(9)), [index for k, index in handled if k == key])
+
+    def test_slow_key_does_not_block(self):
+        """测试一个键处理缓慢时其他键的消息不受影响"""
+        handled: List[str] = []
+
+        async def handler(item):
+            if item == "slow":
+                await asyncio.sleep(0.2)
+            handled.append(item)
+
+        async def run():
+            pipeline = MessagePipeline(handler, workers=2)
+            pipeline.start()
+            await pipeline.submit("a", "slow")
+            for index in range(5):
+                await pipeline.submit("b", f"fast{index}")
+            await asyncio.sleep(0.05)
+            self.assertEqual([f"fast{index}" for index in range(5)], handled)
+            await pipeline.stop()
+
+        asyncio.run(run())
+
+    def test_backpressure_and_shed(self):
+        """测试队列已满时提交方等待空位，超时后丢弃消息"""
+        async def run():
+            gate = asyncio.Event()
+
+            async def handler(item):
+                await gate.wait()
+
+            pipeline = MessagePipeline(handler, workers=1, max_pending=2, put_timeout=0.02)
+            pipeline.start()
+            self.assertTrue(await pipeline.submit("a", 1))
+            self.assertTrue(await pipeline.submit("a", 2))
+            # 队列已满且没有空位，等待超时后丢弃
+            self.assertFalse(await pipeline.submit("b", 3))
+            # 等待期间出现空位则放入队列
+            asyncio.get_running_loop().call_later(0.005, gate.set)
+            pipeline.put_timeout = 1
+            self.assertTrue(await pipeline.submit("b", 4))
+            await pipeline.stop()
+            return pipeline.stats
+
+        stats = asyncio.run(run())
+        self.assertEqual(1, stats.shed)
+        self.assertEqual(3, stats.processed)
+        self.assertEqual(2, stats.max_pending)
+
+    def test_per_key_limit(self):
+        """测试刷屏的键只丢弃自己的消息，其他键的消息不受影响"""
+        async def run():
+            gate = asyncio.Event()
+            handled: List[tuple] = []
+
+            async def handler(item):
+                await gate.wait()
+                handled.append(item)
+
+            pipeline = MessagePipeline(handler, workers=2, max_pending=10, put_timeout=0.01, max_pending_per_key=3)
+            pipeline.start()
+            accepted = [await pipeline.submit("flood", ("flood", index)) for index in range(20)]
+            # 第一条已由工作协程取出，子队列中再积压 3 条
+            await asyncio.sleep(0)
+            self.assertTrue(await pipeline.submit("quiet", ("quiet", 0)))
+            gate.set()
+            await pipeline.stop()
+            return accepted, handled, pipeline.stats
+
+        accepted, handled, stats = asyncio.run(run())
+        self.assertIn(("quiet", 0), handled)
+        self.assertEqual(0, stats.shed)
+        self.assertEqual(20 - sum(accepted), stats.key_shed)
+        self.assertLessEqual(sum(accepted), 4)
+
+    def test_keyed_lock(self):
+        """测试同一个键依次执行且按申请顺序，不同键并发执行，释放后不保留锁"""
+        async def run():
+            lock = KeyedLock()
+            events: List[str] = []
+
+            async def task(key: str, name: str, delay: float):
+                async with lock.hold(key):
+                    events.append(f"{name}+")
+                    await asyncio.sleep(delay)
+                    events.append(f"{name}-")
+
+            await asyncio.gather(task("u", "a", 0.02), task("u", "b", 0), task("v", "c", 0))
+            return events, lock.locks
+
+        events, locks = asyncio.run(run())
+        self.assertLess(events.index("a-"), events.index("b+"))
+        self.assertLess(events.index("c-"), events.index("a-"))
+        self.assertEqual({}, locks)
+
+    def test_handler_error(self):
+        """测试处理出错不影响同一个键的后续消息"""
+        handled: List[int] = []
+
+        async def handler(item):
+            if item == 1:
+                raise ValueError("bad")
+            handled.append(item)
+
+        async def run():
+            pipeline = MessagePipeline(handler)
+            pipeline.start()
+            for item in range(3):
+                await pipeline.submit("a", item)
+            await pipeline.stop()
+            return pipeline.stats
+
+        stats = asyncio.run(run())
+        self.assertEqual([0, 2], handled)
+        self.assertEqual(1, stats.failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
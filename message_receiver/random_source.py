@@ -0,0 +1,171 @@
+import random
+import threading
+import unittest
+from functools import lru_cache
+from typing import List, Sequence, Any, Tuple
+
+
+class RandomSource:
+    """
+    随机数来源，默认直接使用梅森旋转算法（random 模块）
+    generator 可以是 random 模块本身或任意 random.Random 实例
+    """
+
+    def __init__(self, generator: Any = random) -> None:
+        self.generator = generator
+
+    def randint(self, a: int, b: int) -> int:
+        return self.generator.randint(a, b)
+
+    def randbytes(self, n: int) -> bytes:
+        return self.generator.randbytes(n)
+
+    def choices(self, population: Sequence, k: int) -> list:
+        return self.generator.choices(population, k=k)
+
+    def roll(self, count: int, sides: int) -> List[int]:
+        """
+        投掷 count 个 sides 面的骰子，返回每个骰子的点数
+        """
+        randint = self.generator.randint
+        return [randint(1, sides) for _ in range(count)]
+
+
+@lru_cache(maxsize=256)
+def byte_tables(sides: int) -> Tuple[bytes, bytes]:
+    """
+    生成将随机字节映射为 0 ~ sides-1 的转换表，以及需要丢弃的字节（拒绝采样，保证均匀分布）
+    """
+    limit = 256 - 256 % sides
+    return bytes(b % sides for b in range(256)), bytes(range(limit, 256))
+
+
+class BufferedRandomSource(RandomSource):
+    """
+    预先批量抽取随机字节的随机数来源
+    面数不超过256的骰子直接从缓冲区按字节查表得到点数，省去逐个骰子调用 randint 的开销
+    """
+
+    def __init__(self, generator: Any = random, buffer_size: int = 4096) -> None:
+        super().__init__(generator)
+        self.buffer_size = buffer_size
+        self.buffer = b''
+        self.position = 0
+
+    def randbytes(self, n: int) -> bytes:
+        if n > self.buffer_size:
+            return self.generator.randbytes(n)
+        if self.position + n > len(self.buffer):
+            self.buffer = self.buffer[self.position:] + self.generator.randbytes(self.buffer_size)
+            self.position = 0
+        data = self.buffer[self.position:self.position + n]
+        self.position += n
+        return data
+
+    def roll(self, count: int, sides: int) -> List[int]:
+        if sides > 256 or count > self.buffer_size:
+            return super().roll(count, sides)
+        table, rejected = byte_tables(sides)
+        values = b''
+        while len(values) < count:
+            # 被拒绝的字节会被丢弃，不足时继续补抽
+            values += self.randbytes(count - len(values) + 2).translate(table, rejected)
+        return [value + 1 for value in values[:count]]
+
+    def randint(self, a: int, b: int) -> int:
+        sides = b - a + 1
+        if 0 < sides <= 256:
+            return self.roll(1, sides)[0] + a - 1
+        return self.generator.randint(a, b)
+
+
+# 随机数后端：mt 为全局梅森旋转，buffered 为缓冲字节，seeded 为按会话确定性播种
+BACKENDS = ("mt", "buffered", "seeded")
+
+_lock = threading.Lock()
+_backend: str = "mt"
+_seed: str = ""
+_default_source: RandomSource = RandomSource()
+_streams: dict[str, RandomSource] = {}
+
+
+def configure(spec: str) -> None:
+    """
+    配置随机数后端，格式为 "mt"、"buffered" 或 "seeded:<种子>"
+    seeded 模式下每个会话拥有独立的确定性随机数流，相同种子下同一会话的投掷序列可以完整重放
+
+    Args:
+        spec: 后端描述
+    """
+    global _backend, _seed, _default_source
+    backend, _, seed = spec.partition(":")
+    if backend not in BACKENDS:
+        raise ValueError(f"未知的随机数后端: {backend}")
+    with _lock:
+        _backend = backend
+        _seed = seed
+        _streams.clear()
+        if backend == "buffered":
+            _default_source = BufferedRandomSource()
+        elif backend == "seeded":
+            _default_source = RandomSource(random.Random(f"{seed}:"))
+        else:
+            _default_source = RandomSource()
+
+
+def default_source() -> RandomSource:
+    """
+    获取不区分会话的默认随机数来源
+    """
+    return _default_source
+
+
+def get_stream(key: str) -> RandomSource:
+    """
+    获取指定会话（如群或私聊）的随机数流，非 seeded 模式下所有会话共享默认来源
+
+    Args:
+        key: 会话标识，如 "group:123"
+
+    Returns:
+        RandomSource: 随机数来源
+    """
+    if _backend != "seeded":
+        return _default_source
+    stream = _streams.get(key)
+    if stream is None:
+        with _lock:
+            stream = _streams.setdefault(key, RandomSource(random.Random(f"{_seed}:{key}")))
+    return stream
+
+
+class TestRandomSource(unittest.TestCase):
+    def tearDown(self):
+        configure("mt")
+
+    def test_buffered_roll_range(self):
+        """测试缓冲来源的点数范围"""
+        source = BufferedRandomSource(random.Random(1), buffer_size=64)
+        for sides in [1, 2, 6, 20, 100, 256, 1000]:
+            rolls = source.roll(200, sides)
+            self.assertEqual(200, len(rolls))
+            self.assertTrue(all(1 <= value <= sides for value in rolls))
+        self.assertTrue(all(3 <= source.randint(3, 8) <= 8 for _ in range(100)))
+
+    def test_seeded_streams_are_replayable(self):
+        """测试相同种子下同一会话的序列可以重放，不同会话互不影响"""
+        configure("seeded:42")
+        first = [get_stream("group:1").randint(1, 100) for _ in range(10)]
+        get_stream("group:2").randint(1, 100)
+        configure("seeded:42")
+        get_stream("group:2").randint(1, 100)
+        second = [get_stream("group:1").randint(1, 100) for _ in range(10)]
+        self.assertEqual(first, second)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            configure("quantum")
+
+
+if __name__ == '__main__':
+    unittest.main()
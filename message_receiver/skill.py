@@ -1,81 +1,150 @@
+import random
 import re
+import time
 import unittest
+from dataclasses import dataclass
 from typing import Optional, List
 from unittest.mock import patch
 
 from dice import calculate, DiceRollInfo
+from random_source import RandomSource, default_source
+from skill_template import COC7
 from user import CharacterInfo
 
 
+# 技能表中的一项：技能名（非表达式字符）后接可选的值（表达式字符）
+SKILL_ENTRY_PATTERN = re.compile(r'([^0-9d+\-*/^%()]+)([0-9d+\-*/^%()]*)')
+# 将表达式拆分为文本部分与表达式部分
+SKILL_PART_PATTERN = re.compile(r'[^0-9d+\-*/^%()]+|[0-9d+\-*/^%()]+')
+# 整段均为表达式字符
+EXPRESSION_PATTERN = re.compile(r'[0-9d+\-*/^%()]+')
+
+
+@dataclass
+class SkillSheetStats:
+    """
+    技能表解析统计
+    """
+    # 解析出的技能数量
+    entries: int = 0
+    # 其中需要计算骰子表达式的数量
+    dice_entries: int = 0
+    # 解析耗时（毫秒）
+    elapsed_ms: float = 0.0
+
+
+def _evaluate_value(
+        value_str: str,
+        dice_details: Optional[List[DiceRollInfo]],
+        default_sides: int,
+        rng: Optional[RandomSource]
+) -> Optional[int]:
+    # 纯整数不经过表达式引擎，计算失败时返回 None
+    if value_str.isdigit():
+        return int(value_str)
+    try:
+        value = calculate(value_str, dice_details, default_sides, rng=rng)
+        if isinstance(value, float):
+            value = int(value)
+        return value
+    except Exception:
+        return None
+
+
 def pass_skill_value_expression(
         expression: str,
         dice_details: Optional[List[DiceRollInfo]] = None,
-        default_sides: int = 100
+        default_sides: int = 100,
+        rng: Optional[RandomSource] = None,
+        stats: Optional[SkillSheetStats] = None
 ) -> dict[str, int]:
     """
     解析技能表达式，将形如"强化50力量50buff54"的字符串解析为字典
+    单次扫描整段文本，纯整数的值直接转换，只有骰子表达式才会被编译计算
 
     Args:
         expression: 技能表达式字符串
         dice_details: 可选参数，用于记录骰子投掷的详细信息
         default_sides: 默认骰子面数
+        rng: 随机数来源，默认使用 random_source.default_source()
+        stats: 可选参数，用于记录本次解析的统计信息
 
     Returns:
         dict[str, int]: 解析后的键值对字典
     """
+    start = time.perf_counter()
     expression = expression.replace(" ", "")
 
-    # 分割字符串
-    parts = re.findall(r'[^0-9d+\-*/^%()]+|[0-9d+\-*/^%()]+', expression)
-
-    # 移除空字符串
-    parts = [part for part in parts if len(part) > 0]
-
     result = {}
-    i = 0
-
-    # 检查是否以骰子表达式开头
-    if parts and re.match(r'^[0-9d+\-*/^%()]+$', parts[0]):
-        i = 1  # 跳过第一个元素
-
-    # 交替处理键和值
-    while i < len(parts):
-        # 键（文本部分）
-        key = parts[i]
-        i += 1
-
-        # 值（数字部分）
-        if i < len(parts):
-            value_str = parts[i]
-            # 尝试转换为整数
-            try:
-                value = calculate(value_str, dice_details, default_sides)
-                if isinstance(value, float):
-                    value = int(value)
-            except Exception:
-                value = 0
-            result[key] = value
-            i += 1
-        else:
+    dice_entries = 0
+    # 开头的骰子表达式没有对应的技能名，会被跳过
+    for match in SKILL_ENTRY_PATTERN.finditer(expression):
+        key, value_str = match.groups()
+        if not value_str:
             # 如果没有对应的值，默认为0
             result[key] = 0
-
+        elif value_str.isdigit():
+            result[key] = int(value_str)
+        else:
+            dice_entries += 1
+            value = _evaluate_value(value_str, dice_details, default_sides, rng)
+            result[key] = value if value is not None else 0
+
+    if stats is not None:
+        stats.entries = len(result)
+        stats.dice_entries = dice_entries
+        stats.elapsed_ms = (time.perf_counter() - start) * 1000
     return result
 
 
-
 class SkillRollResult:
     skill_name: str
     skill_value: int
     roll_result: int
     dice_details: List[DiceRollInfo]
     success_type: str
+    # 未找到技能时的候选技能名
+    suggestions: List[str]
+
+
+def _parse_skill_roll_expression(
+        expression: str,
+        default_sides: int,
+        rng: Optional[RandomSource]
+) -> tuple[str, Optional[int]]:
+    """
+    解析技能投掷表达式，返回技能名与指定的目标值（未指定或计算失败时为 None）
+    """
+    parts = SKILL_PART_PATTERN.findall(expression)
+    if not parts:
+        return "", 0
+    skill_name = parts[0]
+    if EXPRESSION_PATTERN.fullmatch(skill_name):
+        # 如果以数值开头，可能是直接指定目标值的情况
+        return "", _evaluate_value(skill_name, None, default_sides, rng) or 0
+    # 检查是否有指定的目标值
+    if len(parts) > 1 and EXPRESSION_PATTERN.fullmatch(parts[1]):
+        return skill_name, _evaluate_value(parts[1], None, default_sides, rng)
+    return skill_name, None
+
+
+def _make_skill_roll_result(skill_name: str, skill_value: int, roll_result: int,
+                            dice_details: List[DiceRollInfo], suggestions: List[str]) -> SkillRollResult:
+    result = SkillRollResult()
+    result.skill_name = skill_name
+    result.skill_value = skill_value
+    result.roll_result = roll_result
+    result.dice_details = dice_details
+    result.success_type = determine_success_type(roll_result, skill_value)
+    result.suggestions = suggestions
+    return result
 
 
 def calculate_skill_roll_expression(
         expression: str,
         character_info: CharacterInfo,
-        default_sides: int = 100
+        default_sides: int = 100,
+        rng: Optional[RandomSource] = None
 ) -> SkillRollResult:
     """
     计算技能投掷表达式，将形如"强化", "强化50"的字符串解析为结果
@@ -84,58 +153,74 @@ def calculate_skill_roll_expression(
         expression: 技能表达式字符串
         character_info: 角色信息
         default_sides: 默认骰子面数
+        rng: 随机数来源，默认使用 random_source.default_source()
 
     Returns:
         SkillRollResult: 技能检定结果
     """
-    # 解析表达式
-    parts = re.findall(r'[^0-9d+\-*/^%()]+|[0-9d+\-*/^%()]+', expression)
-    parts = [part for part in parts if len(part) > 0]
-
-    # 默认技能名和技能值
-    skill_name = ""
-    skill_value = 0
-
-    # 提取技能名和目标值
-    if parts:
-        if len(parts) >= 1:
-            skill_name = parts[0]
-            # 检查是否有指定的目标值
-            if len(parts) > 1 and re.match(r'^[0-9d+\-*/^%()]+$', parts[1]):
-                try:
-                    skill_value = calculate(parts[1], default_sides=default_sides)
-                    if isinstance(skill_value, float):
-                        skill_value = int(skill_value)
-                except Exception:
-                    # 如果计算失败，从角色信息中获取技能值
-                    skill_value = character_info.skills.get(skill_name, 0)
-            else:
-                # 从角色信息中获取技能值
-                skill_value = character_info.skills.get(skill_name, 0)
-        else:
-            # 如果以数值开头，可能是直接指定目标值的情况
-            try:
-                skill_value = calculate(parts[0], default_sides=default_sides)
-                if isinstance(skill_value, float):
-                    skill_value = int(skill_value)
-            except Exception:
-                skill_value = 0
+    skill_name, skill_value = _parse_skill_roll_expression(expression, default_sides, rng)
+    suggestions: List[str] = []
+    if skill_value is None:
+        # 从角色信息中获取技能值，支持别名与模糊匹配
+        skill_name, skill_value, suggestions = _find_skill_value(skill_name, character_info)
 
     # 执行骰子投掷
     dice_details = []
-    roll_result = calculate(f"1d{100 if skill_value < 100 else skill_value}", dice_details, default_sides=100)
+    roll_result = calculate(f"1d{100 if skill_value < 100 else skill_value}", dice_details, default_sides=100, rng=rng)
     if isinstance(roll_result, float):
         roll_result = int(roll_result)
 
-    # 创建结果对象
-    result = SkillRollResult()
-    result.skill_name = skill_name
-    result.skill_value = skill_value
-    result.roll_result = roll_result
-    result.dice_details = dice_details
-    result.success_type = determine_success_type(roll_result, skill_value)
+    return _make_skill_roll_result(skill_name, skill_value, roll_result, dice_details, suggestions)
 
-    return result
+
+def calculate_group_skill_roll(
+        expression: str,
+        characters: List[CharacterInfo],
+        default_sides: int = 100,
+        rng: Optional[RandomSource] = None
+) -> List[SkillRollResult]:
+    """
+    对多个角色进行同一项技能检定，表达式只解析一次，常规的 d100 一次性批量投掷
+
+    Args:
+        expression: 技能表达式字符串
+        characters: 参与检定的角色
+        default_sides: 默认骰子面数
+        rng: 随机数来源，默认使用 random_source.default_source()
+
+    Returns:
+        List[SkillRollResult]: 与 characters 顺序一致的检定结果
+    """
+    if rng is None:
+        rng = default_source()
+    skill_name, target_value = _parse_skill_roll_expression(expression, default_sides, rng)
+
+    targets: List[tuple[str, int, List[str]]] = []
+    for character_info in characters:
+        if target_value is None:
+            targets.append(_find_skill_value(skill_name, character_info))
+        else:
+            targets.append((skill_name, target_value, []))
+
+    # 目标值不超过100的检定共用一次批量投掷
+    d100_rolls = iter(rng.roll(sum(1 for _, value, _ in targets if value < 100), 100))
+    results: List[SkillRollResult] = []
+    for name, value, suggestions in targets:
+        sides = 100 if value < 100 else value
+        roll_result = next(d100_rolls) if value < 100 else rng.randint(1, sides)
+        dice_details = [DiceRollInfo(1, sides, [roll_result], roll_result, roll_result, roll_result)]
+        results.append(_make_skill_roll_result(name, value, roll_result, dice_details, suggestions))
+    return results
+
+
+def _find_skill_value(skill_name: str, character_info: CharacterInfo) -> tuple[str, int, List[str]]:
+    """
+    在角色技能中查找技能名，返回实际的技能名、技能值与无法确定时的候选技能名
+    """
+    match = character_info.find_skill(skill_name)
+    if match.name is None:
+        return skill_name, 0, match.suggestions
+    return match.name, character_info.get_skill_value(match.name), []
 
 
 def determine_success_type(roll_result: int, target_value: int, super_range: int = 5) -> str:
@@ -177,7 +262,7 @@ class TestPassSkillExpressionWithMock(unittest.TestCase):
     def test_with_mocked_dice_calculate(self, mock_calculate):
         """使用mock测试包含骰子表达式的解析"""
         # 设置mock的返回值
-        mock_calculate.side_effect = lambda x, default_sides: {
+        mock_calculate.side_effect = lambda x, dice_details=None, default_sides=100, rng=None: {
             '50': 50,
             '20': 20,
             '1d100': 42,
@@ -206,6 +291,101 @@ class TestPassSkillExpressionWithMock(unittest.TestCase):
         expected = {"强化": 3, "力量": 50, "Skill": 20, "Default": 0}
         self.assertEqual(expected, result)
 
+
+class TestPassSkillSheet(unittest.TestCase):
+    def test_literal_values_skip_dice_engine(self):
+        """测试纯整数的值不调用表达式引擎"""
+        stats = SkillSheetStats()
+        with patch('skill.calculate') as mock_calculate:
+            result = pass_skill_value_expression("力量50 敏捷 60图书馆使用70", stats=stats)
+        mock_calculate.assert_not_called()
+        self.assertEqual({"力量": 50, "敏捷": 60, "图书馆使用": 70}, result)
+        self.assertEqual(3, stats.entries)
+        self.assertEqual(0, stats.dice_entries)
+
+    def test_dice_values(self):
+        """测试骰子表达式的值与统计"""
+        stats = SkillSheetStats()
+        dice_info: List[DiceRollInfo] = []
+        result = pass_skill_value_expression("力量3d6*5智力(2d6+6)*5幸运", dice_info, stats=stats)
+        self.assertEqual(0, result["力量"] % 5)
+        self.assertTrue(15 <= result["力量"] <= 90)
+        self.assertTrue(40 <= result["智力"] <= 90)
+        self.assertEqual(0, result["幸运"])
+        self.assertEqual(2, stats.dice_entries)
+        self.assertEqual(2, len(dice_info))
+        self.assertGreaterEqual(stats.elapsed_ms, 0)
+
+    def test_invalid_value(self):
+        """测试无法计算的值记为0"""
+        self.assertEqual({"力量": 0, "敏捷": 5}, pass_skill_value_expression("力量(1敏捷5"))
+
+
+class TestSkillTemplate(unittest.TestCase):
+    def test_roll_reads_through_template(self):
+        """测试技能检定读取模板中的默认值，角色只保存与模板不同的值"""
+        character = CharacterInfo("调查员", COC7)
+        character.set_skill_value("侦查", 60)
+        character.set_skill_value("聆听", COC7.skills["聆听"])
+        self.assertEqual({"侦查": 60}, character.skills)
+        self.assertEqual(60, calculate_skill_roll_expression("侦查", character).skill_value)
+        self.assertEqual(20, calculate_skill_roll_expression("图书馆使用", character).skill_value)
+        character.remove_skill("侦查")
+        self.assertEqual(25, character.get_skill_value("侦查"))
+
+    def test_fuzzy_skill_name(self):
+        """测试别名与前缀匹配，以及新增技能后索引的更新"""
+        character = CharacterInfo("调查员", COC7)
+        character.set_skill_value("侦查", 60)
+        result = calculate_skill_roll_expression("侦察", character)
+        self.assertEqual(("侦查", 60), (result.skill_name, result.skill_value))
+        self.assertEqual("图书馆使用", calculate_skill_roll_expression("图书馆", character).skill_name)
+        self.assertEqual([], calculate_skill_roll_expression("不存在的技能", character).suggestions)
+        character.set_skill_value("拉丁语", 40)
+        self.assertEqual(40, calculate_skill_roll_expression("拉丁", character).skill_value)
+        character.remove_skill("拉丁语")
+        self.assertEqual(0, calculate_skill_roll_expression("拉丁", character).skill_value)
+
+    def test_explicit_target_value(self):
+        """测试指定目标值时不查找技能，也没有候选技能名"""
+        character = CharacterInfo("调查员", COC7)
+        for expression, expected in [("侦查50", ("侦查", 50)), ("50", ("", 50))]:
+            result = calculate_skill_roll_expression(expression, character)
+            self.assertEqual(expected, (result.skill_name, result.skill_value))
+            self.assertTrue(1 <= result.roll_result <= 100)
+            self.assertEqual([], result.suggestions)
+
+    def test_characters_do_not_share_skills(self):
+        """测试不同角色的技能表互不影响"""
+        first = CharacterInfo("甲")
+        second = CharacterInfo("乙")
+        first.set_skill_value("侦查", 60)
+        self.assertEqual(0, second.get_skill_value("侦查"))
+
+
+class TestGroupSkillRoll(unittest.TestCase):
+    def test_group_roll(self):
+        """测试多个角色的同一技能检定"""
+        first = CharacterInfo("甲", COC7)
+        first.set_skill_value("聆听", 70)
+        second = CharacterInfo("乙")
+        third = CharacterInfo("丙")
+        third.set_skill_value("聆听", 150)
+        results = calculate_group_skill_roll("聆听", [first, second, third], rng=RandomSource(random.Random(1)))
+        self.assertEqual([70, 0, 150], [result.skill_value for result in results])
+        self.assertTrue(all(1 <= result.roll_result <= 100 for result in results[:2]))
+        self.assertTrue(1 <= results[2].roll_result <= 150)
+        for result in results:
+            self.assertEqual(result.roll_result, result.dice_details[0].result)
+            self.assertEqual(determine_success_type(result.roll_result, result.skill_value), result.success_type)
+
+    def test_explicit_target(self):
+        """测试指定目标值时所有角色使用相同目标值"""
+        results = calculate_group_skill_roll("幸运50", [CharacterInfo("甲"), CharacterInfo("乙")])
+        self.assertEqual([50, 50], [result.skill_value for result in results])
+        self.assertEqual(["幸运", "幸运"], [result.skill_name for result in results])
+
+
 if __name__ == '__main__':
     # 可以单独运行这个测试类
     unittest.main()
\ No newline at end of file
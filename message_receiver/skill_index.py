@@ -0,0 +1,233 @@
+import bisect
+import unittest
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence
+
+from skill_template import SkillTemplate
+
+# 常见的技能别名与缩写，键为小写
+SKILL_ALIASES: dict[str, str] = {
+    "str": "力量", "dex": "敏捷", "con": "体质", "siz": "体型", "app": "外貌", "int": "智力",
+    "pow": "意志", "edu": "教育", "luck": "幸运", "san": "理智", "hp": "体力", "mp": "魔法",
+    "灵感": "智力", "运气": "幸运", "理智值": "理智", "san值": "理智", "生命": "体力", "生命值": "体力",
+    "魔法值": "魔法", "侦察": "侦查", "图书馆": "图书馆使用", "查资料": "图书馆使用", "魅惑": "取悦",
+    "计算机": "计算机使用", "电脑": "计算机使用", "电脑使用": "计算机使用", "汽车": "汽车驾驶",
+    "开车": "汽车驾驶", "驾驶汽车": "汽车驾驶", "信用": "信用评级", "信誉": "信用评级", "cm": "克苏鲁神话",
+    "克苏鲁": "克苏鲁神话", "快速交谈": "话术", "格斗": "斗殴", "拳击": "斗殴", "射击": "手枪",
+    "博物": "博物学", "自然学": "博物学", "导航": "领航", "重型机械": "操作重型机械", "心理": "心理学",
+    "躲藏": "潜行", "藏匿": "潜行", "潜藏": "潜行", "手艺": "艺术与手艺", "艺术": "艺术与手艺",
+    "精神分析学": "精神分析", "锁匠技艺": "锁匠", "开锁": "锁匠", "急救术": "急救", "闪躲": "闪避",
+}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    计算两个字符串的编辑距离，超过 limit 时提前返回 limit + 1
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SkillIndex:
+    """
+    技能名索引，支持前缀查找与按长度分桶的编辑距离查找，可随技能增删增量维护
+    """
+    __slots__ = ('names', 'sorted_keys', 'by_length')
+
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        # 小写键 -> 原始技能名，大小写不同的技能名共用一个键，按添加顺序排列
+        self.names: dict[str, List[str]] = {}
+        self.sorted_keys: List[str] = []
+        self.by_length: dict[int, set[str]] = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str) -> None:
+        key = name.lower()
+        originals = self.names.get(key)
+        if originals is not None:
+            if name not in originals:
+                originals.append(name)
+            return
+        self.names[key] = [name]
+        bisect.insort(self.sorted_keys, key)
+        self.by_length.setdefault(len(key), set()).add(key)
+
+    def remove(self, name: str) -> None:
+        key = name.lower()
+        originals = self.names.get(key)
+        if originals is None or name not in originals:
+            return
+        originals.remove(name)
+        if originals:
+            # 还有大小写不同的同名技能，保留键
+            return
+        del self.names[key]
+        del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+        self.by_length[len(key)].discard(key)
+
+    def get(self, name: str) -> Optional[str]:
+        originals = self.names.get(name.lower())
+        if originals is None:
+            return None
+        # 优先返回大小写完全一致的技能名
+        return name if name in originals else originals[0]
+
+    def with_prefix(self, prefix: str) -> List[str]:
+        key = prefix.lower()
+        start = bisect.bisect_left(self.sorted_keys, key)
+        result = []
+        for i in range(start, len(self.sorted_keys)):
+            if not self.sorted_keys[i].startswith(key):
+                break
+            result.append(self.names[self.sorted_keys[i]][0])
+        return result
+
+    def similar(self, name: str, max_distance: int) -> List[tuple[int, str]]:
+        """
+        查找编辑距离不超过 max_distance 的技能名，只比较长度相近的候选
+        """
+        key = name.lower()
+        result = []
+        for length in range(len(key) - max_distance, len(key) + max_distance + 1):
+            for candidate in self.by_length.get(length, ()):
+                distance = edit_distance(key, candidate, max_distance)
+                if distance <= max_distance:
+                    result.append((distance, self.names[candidate][0]))
+        return result
+
+
+@lru_cache(maxsize=None)
+def template_index(template: SkillTemplate) -> SkillIndex:
+    """
+    模板的索引只构建一次，由所有使用该模板的角色共享
+    """
+    return SkillIndex(template.skills.keys())
+
+
+class SkillMatch:
+    """
+    技能名查找结果
+    """
+    __slots__ = ('name', 'suggestions')
+
+    def __init__(self, name: Optional[str], suggestions: Optional[List[str]] = None) -> None:
+        # 唯一确定的技能名，无法确定时为 None
+        self.name = name
+        # 无法唯一确定时的候选技能名
+        self.suggestions = suggestions or []
+
+
+# 最多给出的候选数量
+MAX_SUGGESTIONS = 3
+
+
+def lookup_skill(query: str, indexes: Sequence[SkillIndex]) -> SkillMatch:
+    """
+    在若干索引中查找技能名，依次尝试精确匹配、别名、唯一前缀与编辑距离
+
+    Args:
+        query: 用户输入的技能名
+        indexes: 技能索引，如角色自身技能与模板技能
+
+    Returns:
+        SkillMatch: 查找结果
+    """
+    for index in indexes:
+        name = index.get(query)
+        if name is not None:
+            return SkillMatch(name)
+
+    alias = SKILL_ALIASES.get(query.lower())
+    if alias is not None:
+        for index in indexes:
+            name = index.get(alias)
+            if name is not None:
+                return SkillMatch(name)
+
+    # 单个字符的前缀过于宽泛，只作为候选
+    prefixed = sorted({name for index in indexes for name in index.with_prefix(query)})
+    if len(prefixed) == 1 and len(query) >= 2:
+        return SkillMatch(prefixed[0])
+
+    # 较长的名称才允许自动纠正错别字
+    max_distance = max(1, len(query) // 2)
+    auto_distance = len(query) // 3
+    similar = sorted({item for index in indexes for item in index.similar(query, max_distance)})
+    if similar and similar[0][0] <= auto_distance and (len(similar) == 1 or similar[1][0] > similar[0][0]):
+        return SkillMatch(similar[0][1])
+
+    suggestions = prefixed[:MAX_SUGGESTIONS]
+    for _, name in similar:
+        if len(suggestions) >= MAX_SUGGESTIONS:
+            break
+        if name not in suggestions:
+            suggestions.append(name)
+    return SkillMatch(None, suggestions)
+
+
+class TestSkillIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SkillIndex(["侦查", "聆听", "图书馆使用", "力量", "手枪", "步枪", "心理学", "Dodge"])
+
+    def test_exact_and_case_insensitive(self):
+        self.assertEqual("侦查", lookup_skill("侦查", [self.index]).name)
+        self.assertEqual("Dodge", lookup_skill("dodge", [self.index]).name)
+
+    def test_alias(self):
+        """测试别名: 侦察 -> 侦查, STR -> 力量"""
+        self.assertEqual("侦查", lookup_skill("侦察", [self.index]).name)
+        self.assertEqual("力量", lookup_skill("STR", [self.index]).name)
+
+    def test_unique_prefix(self):
+        """测试唯一前缀: 心理 -> 心理学"""
+        self.assertEqual("心理学", lookup_skill("心理", [self.index]).name)
+
+    def test_typo(self):
+        """测试较长名称的错别字自动纠正，短名称只给出候选"""
+        self.assertEqual("图书馆使用", lookup_skill("图书官使用", [self.index]).name)
+        match = lookup_skill("长枪", [self.index])
+        self.assertIsNone(match.name)
+        self.assertEqual({"手枪", "步枪"}, set(match.suggestions))
+
+    def test_incremental_update(self):
+        """测试增删技能后索引同步更新"""
+        self.index.add("克苏鲁神话")
+        self.assertEqual("克苏鲁神话", lookup_skill("cm", [self.index]).name)
+        self.index.remove("克苏鲁神话")
+        self.assertIsNone(lookup_skill("cm", [self.index]).name)
+        self.assertEqual([], self.index.with_prefix("克苏鲁"))
+
+    def test_case_variants(self):
+        """测试大小写不同的技能名共用一个键，删除其中一个后另一个仍能找到"""
+        index = SkillIndex(["STR", "str", "Strength"])
+        self.assertEqual("str", index.get("str"))
+        index.remove("STR")
+        self.assertEqual("str", index.get("STR"))
+        self.assertEqual(["str", "Strength"], index.with_prefix("st"))
+        self.assertEqual([(1, "str")], index.similar("stx", 1))
+        index.remove("str")
+        self.assertIsNone(index.get("str"))
+        self.assertEqual(["Strength"], index.with_prefix("st"))
+
+    def test_multiple_indexes(self):
+        """测试同时查找角色技能与模板技能"""
+        own = SkillIndex(["信用评级"])
+        self.assertEqual("信用评级", lookup_skill("信用", [own, self.index]).name)
+        self.assertEqual("聆听", lookup_skill("聆听", [own, self.index]).name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import sys
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+
+class SkillTemplate:
+    """
+    规则技能模板
+    模板只读且被所有使用它的角色共享，角色只保存与模板不同的技能值
+    """
+    __slots__ = ('name', 'description', 'skills')
+
+    name: str
+    description: str
+    skills: Mapping[str, int]
+
+    def __init__(self, name: str, description: str, skills: dict[str, int]) -> None:
+        self.name = name
+        self.description = description
+        # 技能名驻留后，角色技能表中的同名技能与模板共享同一字符串
+        self.skills = MappingProxyType({sys.intern(skill_name): value for skill_name, value in skills.items()})
+
+    def __repr__(self) -> str:
+        return f"SkillTemplate({self.name!r})"
+
+
+# 克苏鲁的呼唤第7版基础技能（依赖属性的闪避、母语不在此列）
+COC7 = SkillTemplate("coc7", "克苏鲁的呼唤第7版基础技能", {
+    "会计": 5, "人类学": 1, "估价": 5, "考古学": 1, "取悦": 15, "攀爬": 20, "计算机使用": 5,
+    "信用评级": 0, "克苏鲁神话": 0, "乔装": 5, "汽车驾驶": 20, "电气维修": 10, "电子学": 1,
+    "话术": 5, "斗殴": 25, "手枪": 20, "急救": 30, "历史": 5, "恐吓": 15, "跳跃": 20,
+    "外语": 1, "法律": 5, "图书馆使用": 20, "聆听": 20, "锁匠": 1, "机械维修": 10, "医学": 1,
+    "博物学": 10, "领航": 10, "神秘学": 5, "操作重型机械": 1, "说服": 10, "精神分析": 1,
+    "心理学": 10, "骑术": 5, "妙手": 10, "侦查": 25, "潜行": 20, "生存": 10, "游泳": 20,
+    "投掷": 20, "追踪": 10, "驯兽": 5, "潜水": 1, "爆破": 1, "读唇": 1, "催眠": 1, "炮术": 1,
+    "步枪": 25, "霰弹枪": 25, "弓": 15, "剑": 20, "斧": 15, "链锯": 10, "鞭": 5, "矛": 20,
+    "绞索": 15, "连枷": 10, "冲锋枪": 15, "机枪": 10, "重武器": 10, "火焰喷射器": 10,
+    "艺术与手艺": 5, "摄影": 5, "表演": 5, "美术": 5, "伪造": 5, "书法": 5, "木匠": 10, "厨艺": 5,
+    "科学": 1, "数学": 10, "物理学": 1, "化学": 1, "生物学": 1, "地质学": 1, "天文学": 1,
+    "药学": 1, "植物学": 1, "动物学": 1, "密码学": 1, "工程学": 1, "气象学": 1, "司法科学": 1,
+    "驾驶": 1, "飞行器驾驶": 1, "船驾驶": 1,
+})
+
+# 所有可用模板
+TEMPLATES: dict[str, SkillTemplate] = {
+    COC7.name: COC7,
+}
+
+
+def get_template(name: Optional[str]) -> Optional[SkillTemplate]:
+    """
+    按名称获取模板，名称为空或不存在时返回 None
+    """
+    if not name:
+        return None
+    return TEMPLATES.get(name.lower())
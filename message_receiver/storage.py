@@ -0,0 +1,410 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from typing import Iterable, List
+
+from codec import CODECS
+from json_data import save_data, load_data, make_directories, sync_directories
+
+
+class Storage:
+    """
+    用户数据存储接口，用户数据为 UserInfo.to_dict() 生成的字典
+    """
+
+    def load_user(self, user_id: int) -> dict:
+        """
+        读取用户数据，用户不存在时返回空字典
+        """
+        raise NotImplementedError
+
+    def has_user(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    def save_users(self, users: dict[int, dict]) -> List[int]:
+        """
+        批量保存用户数据
+
+        Args:
+            users: 用户ID -> 用户数据
+
+        Returns:
+            List[int]: 保存成功的用户ID
+        """
+        raise NotImplementedError
+
+    def save_user(self, user_id: int, data: dict) -> bool:
+        return user_id in self.save_users({user_id: data})
+
+    def user_ids(self) -> List[int]:
+        """
+        列出所有已保存的用户ID
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStorage(Storage):
+    """
+    每个用户一个 JSON 文件的存储
+    文件按用户ID的哈希分到 256 个目录中（如 users/ab/<id>.json），避免单个目录下文件过多，
+    同时一轮保存的文件集中在少数目录中，目录项的刷盘可以合并
+    旧版平铺在 users/<id>.json 或两级目录 users/ab/cd/<id>.json 的文件在首次读取时迁移
+    """
+
+    def __init__(self, directory: str = "users") -> None:
+        self.directory = directory
+
+    def file_path(self, user_id: int) -> str:
+        digest = hashlib.md5(str(user_id).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{user_id}.json")
+
+    def flat_file_path(self, user_id: int) -> str:
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def legacy_file_paths(self, user_id: int) -> List[str]:
+        """
+        旧版布局下的文件路径，先检查较新的两级目录
+        """
+        digest = hashlib.md5(str(user_id).encode()).hexdigest()
+        return [os.path.join(self.directory, digest[:2], digest[2:4], f"{user_id}.json"),
+                self.flat_file_path(user_id)]
+
+    def load_user(self, user_id: int) -> dict:
+        path = self.file_path(user_id)
+        if os.path.exists(path):
+            return load_data(path)
+        for legacy_path in self.legacy_file_paths(user_id):
+            if not os.path.exists(legacy_path):
+                continue
+            data = load_data(legacy_path)
+            if data and save_data(path, data):
+                os.remove(legacy_path)
+                logging.info(f"已将用户 {user_id} 的数据迁移到 {path}")
+            return data
+        return {}
+
+    def has_user(self, user_id: int) -> bool:
+        return any(os.path.exists(path) for path in [self.file_path(user_id), *self.legacy_file_paths(user_id)])
+
+    def save_users(self, users: dict[int, dict]) -> List[int]:
+        saved = []
+        # 需要刷入磁盘的目录：写入了文件的目录，以及新建目录的上级目录
+        written_dirs = set()
+        checked_dirs = set()
+        for user_id, data in users.items():
+            path = self.file_path(user_id)
+            dir_name = os.path.dirname(os.path.abspath(path))
+            try:
+                if dir_name not in checked_dirs:
+                    written_dirs.update(make_directories(dir_name))
+                    checked_dirs.add(dir_name)
+            except OSError as e:
+                logging.error(f"创建目录 {dir_name} 时出错: {e}")
+                continue
+            if save_data(path, data, fsync_dir=False):
+                saved.append(user_id)
+                written_dirs.add(dir_name)
+                for legacy_path in self.legacy_file_paths(user_id):
+                    if os.path.exists(legacy_path):
+                        os.remove(legacy_path)
+        # 本轮写入的文件统一刷入一次目录项
+        sync_directories(written_dirs)
+        return saved
+
+    def user_ids(self) -> List[int]:
+        user_ids = []
+        for _, _, file_names in os.walk(self.directory):
+            user_ids.extend(int(file_name[:-5]) for file_name in file_names
+                            if file_name.endswith(".json") and file_name[:-5].isdigit())
+        # 迁移中途可能同时存在平铺与分级两份文件
+        return list(dict.fromkeys(user_ids))
+
+
+# 用户字段与数据库列的对应关系
+USER_COLUMNS = ("nickname", "points", "last_point_get_time", "lucky_points",
+                "last_lucky_point_check_time", "current_character_name")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    nickname TEXT,
+    points INTEGER,
+    last_point_get_time INTEGER,
+    lucky_points INTEGER,
+    last_lucky_point_check_time INTEGER,
+    current_character_name TEXT
+);
+CREATE TABLE IF NOT EXISTS characters (
+    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    max_hp INTEGER NOT NULL DEFAULT 0,
+    current_hp INTEGER NOT NULL DEFAULT 0,
+    template TEXT,
+    skills TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (user_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS characters_name ON characters(name);
+"""
+
+
+class SqliteStorage(Storage):
+    """
+    SQLite 存储，使用 WAL 模式，用户与角色分表保存，一轮保存在同一个事务中完成
+    """
+
+    def __init__(self, path: str = "users.db") -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # 连接由消息处理与后台保存线程共享，访问时持有锁
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 提交后断电仍可能丢失，而保存成功后修改日志会被删除，因此每次提交都要刷入磁盘
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+
+    def load_user(self, user_id: int) -> dict:
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return {}
+            character_rows = self.connection.execute(
+                "SELECT name, max_hp, current_hp, template, skills FROM characters WHERE user_id = ?",
+                (user_id,)).fetchall()
+        data = {column: value for column, value in zip(USER_COLUMNS, row) if value is not None}
+        characters = {}
+        for name, max_hp, current_hp, template, skills in character_rows:
+            character = {"name": name, "max_hp": max_hp, "current_hp": current_hp, "skills": json.loads(skills)}
+            if template is not None:
+                character["template"] = template
+            characters[name] = character
+        data["characters"] = characters
+        return data
+
+    def has_user(self, user_id: int) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def save_users(self, users: dict[int, dict]) -> List[int]:
+        if not users:
+            return []
+        if self._save_batch(users):
+            return list(users)
+        if len(users) == 1:
+            return []
+        # 整批失败时逐个重试，避免个别用户的问题导致整轮保存失败
+        return [user_id for user_id, data in users.items() if self._save_batch({user_id: data})]
+
+    def _save_batch(self, users: dict[int, dict]) -> bool:
+        user_rows = []
+        character_rows = []
+        for user_id, data in users.items():
+            user_rows.append((user_id, *(data.get(column) for column in USER_COLUMNS)))
+            for name, character in data.get("characters", {}).items():
+                character_rows.append((user_id, name, character.get("max_hp", 0), character.get("current_hp", 0),
+                                       character.get("template"),
+                                       json.dumps(character.get("skills", {}), ensure_ascii=False)))
+        placeholders = ", ".join("?" * (len(USER_COLUMNS) + 1))
+        with self.lock:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+                self.connection.executemany(
+                    f"INSERT INTO users (user_id, {', '.join(USER_COLUMNS)}) VALUES ({placeholders}) "
+                    f"ON CONFLICT(user_id) DO UPDATE SET "
+                    f"{', '.join(f'{column} = excluded.{column}' for column in USER_COLUMNS)}",
+                    user_rows)
+                self.connection.executemany("DELETE FROM characters WHERE user_id = ?",
+                                            [(user_id,) for user_id in users])
+                self.connection.executemany(
+                    "INSERT INTO characters (user_id, name, max_hp, current_hp, template, skills) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", character_rows)
+                self.connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK")
+                logging.error(f"保存 {len(users)} 个用户到 {self.path} 时出错: {e}")
+                return False
+        return True
+
+    def user_ids(self) -> List[int]:
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT user_id FROM users")]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def create_storage(spec: str) -> Storage:
+    """
+    根据描述创建存储，格式为 "json"、"json:<目录>"、"sqlite" 或 "sqlite:<数据库文件>"
+    """
+    backend, _, location = spec.partition(":")
+    if backend == "json":
+        return JsonStorage(location or "users")
+    if backend == "sqlite":
+        return SqliteStorage(location or "users.db")
+    raise ValueError(f"未知的存储后端: {backend}")
+
+
+_storage: Storage = JsonStorage()
+
+
+def configure(spec: str) -> None:
+    """
+    配置全局使用的存储后端
+    """
+    global _storage
+    storage = create_storage(spec)
+    _storage.close()
+    _storage = storage
+
+
+def get_storage() -> Storage:
+    return _storage
+
+
+def write_snapshot(path: str, users: List[tuple[int, dict]]) -> bool:
+    """
+    将一批用户数据打包写入单个快照文件，启动时一次顺序读取即可预热缓存
+    """
+    return save_data(path, {"users": users}, codec=CODECS.get("orjson", CODECS["json-compact"]))
+
+
+def read_snapshot(path: str) -> List[tuple[int, dict]]:
+    """
+    读取并删除快照文件，快照只在写入后的下一次启动时有效
+    """
+    if not os.path.exists(path):
+        return []
+    data = load_data(path)
+    os.remove(path)
+    return [(int(user_id), user_data) for user_id, user_data in data.get("users", [])]
+
+
+def migrate(source: Storage, target: Storage, batch_size: int = 500) -> int:
+    """
+    将 source 中的所有用户复制到 target，每 batch_size 个用户一个批次
+    source 与 target 为同一个 JSON 目录时，相当于将平铺的文件全部迁移到分级目录
+
+    Returns:
+        int: 迁移的用户数
+    """
+    migrated = 0
+    batch: dict[int, dict] = {}
+    for user_id in source.user_ids():
+        data = source.load_user(user_id)
+        if not data:
+            continue
+        batch[user_id] = data
+        if len(batch) >= batch_size:
+            migrated += len(target.save_users(batch))
+            batch = {}
+    if batch:
+        migrated += len(target.save_users(batch))
+    return migrated
+
+
+def main(argv: Iterable[str] or None = None) -> int:
+    parser = argparse.ArgumentParser(description="在存储后端之间迁移用户数据")
+    parser.add_argument("source", help="源存储，如 json:users")
+    parser.add_argument("target", help="目标存储，如 sqlite:users.db")
+    parser.add_argument("--batch-size", type=int, default=500, help="每个事务保存的用户数")
+    args = parser.parse_args(argv)
+    source = create_storage(args.source)
+    target = create_storage(args.target)
+    try:
+        migrated = migrate(source, target, args.batch_size)
+    finally:
+        source.close()
+        target.close()
+    print(f"已迁移 {migrated} 个用户")
+    return 0
+
+
+class TestStorage(unittest.TestCase):
+    USER = {
+        "nickname": "调查员", "points": 3, "last_point_get_time": 10, "lucky_points": 70,
+        "last_lucky_point_check_time": 20, "current_character_name": "甲",
+        "characters": {
+            "甲": {"name": "甲", "max_hp": 12, "current_hp": 9, "skills": {"侦查": 60}, "template": "coc7"},
+            "乙": {"name": "乙", "max_hp": 0, "current_hp": 0, "skills": {}},
+        },
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """测试两种后端保存后读取的数据一致"""
+        for storage in [JsonStorage(os.path.join(self.directory.name, "users")),
+                        SqliteStorage(os.path.join(self.directory.name, "users.db"))]:
+            self.assertEqual({}, storage.load_user(1))
+            self.assertFalse(storage.has_user(1))
+            self.assertEqual([1, 2], sorted(storage.save_users({1: self.USER, 2: {"nickname": "b"}})))
+            self.assertEqual(self.USER, storage.load_user(1))
+            self.assertTrue(storage.has_user(2))
+            # 删除角色后再次保存，旧角色不应残留
+            self.assertTrue(storage.save_user(1, dict(self.USER, characters={})))
+            self.assertEqual({}, storage.load_user(1)["characters"])
+            storage.close()
+
+    def test_sharded_layout(self):
+        """测试旧版平铺文件与两级目录文件在读取时迁移到分级目录"""
+        storage = JsonStorage(os.path.join(self.directory.name, "users"))
+        self.assertEqual(os.path.join(storage.directory, "c9"), os.path.dirname(storage.file_path(8)))
+        for user_id, legacy_path in [(7, storage.flat_file_path(7)), (8, storage.legacy_file_paths(8)[0])]:
+            save_data(legacy_path, self.USER)
+            self.assertTrue(storage.has_user(user_id))
+            self.assertEqual(self.USER, storage.load_user(user_id))
+            self.assertFalse(os.path.exists(legacy_path))
+            self.assertTrue(os.path.exists(storage.file_path(user_id)))
+            self.assertEqual(self.USER, storage.load_user(user_id))
+        self.assertEqual([7, 8], sorted(storage.user_ids()))
+
+    def test_new_directories_synced(self):
+        """测试一轮保存只刷入少数目录，新建目录的上级目录也会刷入"""
+        from unittest.mock import patch
+        root = os.path.abspath(self.directory.name)
+        storage = JsonStorage(os.path.join(root, "users"))
+        with patch("storage.sync_directories") as sync:
+            self.assertEqual(300, len(storage.save_users({user_id: self.USER for user_id in range(300)})))
+        synced = set(sync.call_args[0][0])
+        shards = {os.path.dirname(storage.file_path(user_id)) for user_id in range(300)}
+        self.assertEqual(shards | {root, storage.directory}, synced)
+        self.assertLessEqual(len(shards), 256)
+
+    def test_snapshot(self):
+        """测试快照写入后只能读取一次"""
+        path = os.path.join(self.directory.name, "users.snapshot")
+        self.assertTrue(write_snapshot(path, [(1, self.USER), (2, {"nickname": "b"})]))
+        self.assertEqual([(1, self.USER), (2, {"nickname": "b"})], read_snapshot(path))
+        self.assertEqual([], read_snapshot(path))
+
+    def test_migrate(self):
+        """测试从 JSON 迁移到 SQLite"""
+        source = JsonStorage(os.path.join(self.directory.name, "users"))
+        source.save_users({user_id: dict(self.USER, nickname=str(user_id)) for user_id in range(1, 6)})
+        target = SqliteStorage(os.path.join(self.directory.name, "users.db"))
+        self.assertEqual(5, migrate(source, target, batch_size=2))
+        self.assertEqual([1, 2, 3, 4, 5], sorted(target.user_ids()))
+        self.assertEqual("3", target.load_user(3)["nickname"])
+        target.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,42 +1,85 @@
+import asyncio
 import logging
-import time
-from threading import Thread
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+from dataclasses import dataclass
 
-from json_data import save_data, load_data
+from skill_index import SkillIndex, SkillMatch, lookup_skill, template_index
+from skill_template import SkillTemplate, get_template
+from journal import get_journal, list_segments, read_records
+from storage import configure as configure_storage, get_storage, read_snapshot, write_snapshot
 
 
 class CharacterInfo:
-    name: str
-    max_hp: int = 0
-    current_hp: int = 0
-    skills: dict[str, int] = {}
+    """
+    角色信息，使用 __slots__ 减少大量缓存角色的内存占用，技能名经过驻留以便不同角色共享同一字符串
+    """
+    __slots__ = ('name', 'max_hp', 'current_hp', 'template', 'skills', 'owner', 'version', '_skill_index')
 
-    def __init__(self, name: str) -> None:
+    name: str
+    max_hp: int
+    current_hp: int
+    # 共享的技能模板，角色自身只保存与模板不同的技能值
+    template: SkillTemplate or None
+    skills: dict[str, int]
+    # 所属用户，角色的修改会使其变为待保存状态
+    owner: 'UserInfo' or None
+
+    def __init__(self, name: str, template: SkillTemplate or None = None) -> None:
         self.name = name
+        self.max_hp = 0
+        self.current_hp = 0
+        self.template = template
+        self.skills = {}
+        self.owner = None
+        # 修改计数，每次修改角色信息时递增
+        self.version = 0
+        # 角色自身技能的名称索引，首次查找时构建，之后随技能增删增量维护
+        self._skill_index: SkillIndex or None = None
 
     def to_dict(self) -> dict:
-        return {
+        data = {
             "name": self.name,
             "max_hp": self.max_hp,
             "current_hp": self.current_hp,
-            "skills": self.skills
+            "skills": dict(self.skills)
         }
+        if self.template is not None:
+            data["template"] = self.template.name
+        return data
 
     @classmethod
     def from_dict(cls, data: dict) -> 'CharacterInfo':
-        character = cls(data["name"])
+        character = cls(data["name"], get_template(data.get("template")))
         character.max_hp = data.get("max_hp", 0)
         character.current_hp = data.get("current_hp", 0)
-        character.skills = data.get("skills", {})
+        character.skills = {sys.intern(skill_name): value for skill_name, value in data.get("skills", {}).items()}
         return character
 
+    def mark_dirty(self, *record) -> None:
+        """
+        记录一次修改，record 为写入修改日志的操作及修改后的取值
+        """
+        self.version += 1
+        if self.owner is not None:
+            self.owner.mark_dirty(record[0], self.name, *record[1:])
+
     def set_max_hp(self, max_hp: int) -> None:
-        self.max_hp = max_hp
+        if max_hp != self.max_hp:
+            self.max_hp = max_hp
+            self.mark_dirty("c", {"max_hp": max_hp})
 
     def set_hp(self, current_hp: int) -> None:
         if current_hp > self.max_hp:
             current_hp = self.max_hp
-        self.current_hp = current_hp
+        if current_hp != self.current_hp:
+            self.current_hp = current_hp
+            self.mark_dirty("c", {"current_hp": current_hp})
 
     def get_current_hp(self) -> int:
         return self.current_hp
@@ -44,73 +87,263 @@ class CharacterInfo:
     def get_max_hp(self) -> int:
         return self.max_hp
 
+    def set_template(self, template: SkillTemplate or None) -> None:
+        """
+        切换技能模板，与新模板默认值相同的技能不再单独保存
+        """
+        merged = self.all_skills()
+        self.template = template
+        self.skills = {skill_name: value for skill_name, value in merged.items()
+                       if template is None or template.skills.get(skill_name) != value}
+        self._skill_index = None
+        self.mark_dirty("tpl", template.name if template is not None else None, dict(self.skills))
+
+    def has_skill(self, skill_name: str) -> bool:
+        return skill_name in self.skills or (self.template is not None and skill_name in self.template.skills)
+
     def get_skill_value(self, skill_name: str) -> int:
         if skill_name in self.skills:
             return self.skills[skill_name]
+        if self.template is not None:
+            return self.template.skills.get(skill_name, 0)
         return 0
 
     def set_skill_value(self, skill_name: str, value: int) -> None:
-        self.skills[skill_name] = value
+        skill_name = sys.intern(skill_name)
+        if self.template is not None and self.template.skills.get(skill_name) == value:
+            # 与模板默认值相同，无需单独保存
+            self.remove_skill(skill_name)
+        elif self.skills.get(skill_name) != value:
+            if self._skill_index is not None and skill_name not in self.skills:
+                self._skill_index.add(skill_name)
+            self.skills[skill_name] = value
+            self.mark_dirty("s", skill_name, value)
 
     def remove_skill(self, skill_name: str) -> None:
+        """
+        移除角色自身的技能值，模板中的技能会恢复为默认值
+        """
         if skill_name in self.skills:
             del self.skills[skill_name]
+            if self._skill_index is not None:
+                self._skill_index.remove(skill_name)
+            self.mark_dirty("s", skill_name, None)
+
+    def find_skill(self, query: str) -> SkillMatch:
+        """
+        按名称查找技能，支持别名、前缀与错别字纠正，角色自身的技能优先于模板
+        """
+        if query in self.skills:
+            return SkillMatch(query)
+        if self._skill_index is None:
+            self._skill_index = SkillIndex(self.skills.keys())
+        indexes = [self._skill_index]
+        if self.template is not None:
+            indexes.append(template_index(self.template))
+        return lookup_skill(query, indexes)
+
+    def all_skills(self) -> dict[str, int]:
+        """
+        获取合并模板后的完整技能表
+        """
+        if self.template is None:
+            return dict(self.skills)
+        merged = dict(self.template.skills)
+        merged.update(self.skills)
+        return merged
+
+
+# 估算内存占用时使用的近似大小（字节），由 benchmark.py memory 实测得出并包含缓存自身的开销
+USER_BASE_SIZE = 384
+CHARACTER_BASE_SIZE = 448
+SKILL_ENTRY_SIZE = 24
+
+# 快照中最多保存的最近活跃用户数
+SNAPSHOT_USERS = 5000
+
+# 修改日志中允许出现的用户与角色字段
+USER_FIELDS = ("nickname", "points", "last_point_get_time", "lucky_points",
+               "last_lucky_point_check_time", "current_character_name")
+CHARACTER_FIELDS = ("max_hp", "current_hp")
 
 
 class UserInfo:
+    """
+    用户信息，使用 __slots__ 并为每个实例创建独立的角色字典
+    """
+    __slots__ = ('user_id', 'nickname', 'points', 'last_point_get_time', 'lucky_points',
+                 'last_lucky_point_check_time', 'characters', 'current_character_name', 'version', 'saved_version')
+
     user_id: int
     nickname: str
     # 点数
-    points: int = 0
+    points: int
     # 上次获取点数的时间，以纳秒为单位
-    last_point_get_time: int = 0
+    last_point_get_time: int
     # 幸运点数
-    lucky_points: int = 50
+    lucky_points: int
     # 上次检查幸运点数时间，以纳秒为单位
-    last_lucky_point_check_time: int = 0
-    characters: dict[str, CharacterInfo] = {}
-    current_character_name: str or None = None
+    last_lucky_point_check_time: int
+    characters: dict[str, CharacterInfo]
+    current_character_name: str or None
 
     def __init__(self, user_id: int, nickname: str) -> None:
         self.user_id = user_id
         self.nickname = nickname
+        self.points = 0
+        self.last_point_get_time = 0
+        self.lucky_points = 50
+        self.last_lucky_point_check_time = 0
+        self.characters = {}
+        self.current_character_name = None
+        # 修改计数与最近一次成功保存时的修改计数，两者不同时需要保存
+        self.version = 0
+        self.saved_version = 0
+
+    def mark_dirty(self, *record) -> None:
+        """
+        记录一次修改，打开了修改日志时将 record 写入日志
+        """
+        self.version += 1
+        if record:
+            journal = get_journal()
+            if journal is not None:
+                journal.append([self.user_id, *record])
 
-    def file_path(self) -> str:
-        return f"users/{self.user_id}.json"
+    def apply_record(self, record: list) -> None:
+        """
+        应用一条修改日志记录，记录中只包含修改后的取值，重复应用结果不变
+        """
+        operation = record[0]
+        if operation == "u":
+            for field, value in record[1].items():
+                if field in USER_FIELDS:
+                    setattr(self, field, value)
+        elif operation == "new":
+            if record[1] not in self.characters:
+                character = CharacterInfo(record[1])
+                character.owner = self
+                self.characters[record[1]] = character
+        elif operation == "del":
+            if record[1] in self.characters:
+                self.characters.pop(record[1]).owner = None
+        elif operation == "ren":
+            self.rename_character(record[1], record[2])
+        else:
+            character = self.characters.get(record[1])
+            if character is None:
+                return
+            if operation == "c":
+                for field, value in record[2].items():
+                    if field in CHARACTER_FIELDS:
+                        setattr(character, field, value)
+            elif operation == "tpl":
+                character.template = get_template(record[2])
+                character.skills = {sys.intern(skill_name): value for skill_name, value in record[3].items()}
+                character._skill_index = None
+            elif operation == "s":
+                if record[3] is None:
+                    character.skills.pop(record[2], None)
+                else:
+                    character.skills[sys.intern(record[2])] = record[3]
+            character._skill_index = None
+        self.version += 1
+
+    def is_dirty(self) -> bool:
+        return self.version != self.saved_version
+
+    def approximate_size(self) -> int:
+        """
+        估算用户信息占用的内存，用于限制缓存大小
+        """
+        size = USER_BASE_SIZE
+        for character in self.characters.values():
+            size += CHARACTER_BASE_SIZE + SKILL_ENTRY_SIZE * len(character.skills)
+        return size
 
-    def sync_to_file(self) -> None:
-        characters_dict = {name: char.to_dict() for name, char in self.characters.items()}
-        save_data(self.file_path(), {
+    def to_dict(self) -> dict:
+        return {
             "nickname": self.nickname,
             "points": self.points,
             "last_point_get_time": self.last_point_get_time,
             "lucky_points": self.lucky_points,
             "last_lucky_point_check_time": self.last_lucky_point_check_time,
-            "characters": characters_dict,
+            "characters": {name: char.to_dict() for name, char in self.characters.items()},
             "current_character_name": self.current_character_name,
-        })
+        }
 
-    def sync_from_file(self) -> None:
-        data = load_data(self.file_path())
-        self.nickname = data.get("nickname", self.nickname)
+    def load_dict(self, data: dict) -> None:
+        self.nickname = data.get("nickname") or self.nickname
         self.points = data.get("points", self.points)
         self.last_point_get_time = data.get("last_point_get_time", self.last_point_get_time)
         self.lucky_points = data.get("lucky_points", self.lucky_points)
         self.last_lucky_point_check_time = data.get("last_lucky_point_check_time", self.last_lucky_point_check_time)
         characters_data = data.get("characters", {})
         self.characters = {name: CharacterInfo.from_dict(char_data) for name, char_data in characters_data.items()}
+        for character in self.characters.values():
+            character.owner = self
         self.current_character_name = data.get("current_character_name", self.current_character_name)
+        self.saved_version = self.version
+
+    def sync_to_file(self) -> bool:
+        """
+        保存用户信息到当前配置的存储，成功后将当前修改计数记为已保存
+        保存期间发生的修改会使修改计数继续增加，留待下次保存
+        """
+        version = self.version
+        saved = get_storage().save_user(self.user_id, self.to_dict())
+        if saved:
+            self.saved_version = version
+        return saved
+
+    def sync_from_file(self) -> None:
+        self.load_dict(get_storage().load_user(self.user_id))
+
+    def set_nickname(self, nickname: str) -> None:
+        if nickname != self.nickname:
+            self.nickname = nickname
+            self.mark_dirty("u", {"nickname": nickname})
 
     def increase_points(self, points: int) -> None:
         self.points += points
+        self.mark_dirty("u", {"points": self.points})
 
     def decrease_points(self, points: int) -> None:
         self.points -= points
+        self.mark_dirty("u", {"points": self.points})
+
+    def set_last_point_get_time(self, time_ns: int) -> None:
+        self.last_point_get_time = time_ns
+        self.mark_dirty("u", {"last_point_get_time": time_ns})
+
+    def set_lucky_points(self, lucky_points: int, check_time_ns: int) -> None:
+        self.lucky_points = lucky_points
+        self.last_lucky_point_check_time = check_time_ns
+        self.mark_dirty("u", {"lucky_points": lucky_points, "last_lucky_point_check_time": check_time_ns})
 
     def set_current_character(self, character_name: str) -> None:
         if character_name not in self.characters:
-            self.characters[character_name] = CharacterInfo(character_name)
-        self.current_character_name = character_name
+            character = CharacterInfo(character_name)
+            character.owner = self
+            self.characters[character_name] = character
+            self.mark_dirty("new", character_name)
+        if self.current_character_name != character_name:
+            self.current_character_name = character_name
+            self.mark_dirty("u", {"current_character_name": character_name})
+
+    def rename_character(self, old_name: str, new_name: str) -> bool:
+        """
+        重命名角色，角色不存在或新名称已被占用时返回 False
+        """
+        if old_name not in self.characters or new_name in self.characters:
+            return False
+        character = self.characters.pop(old_name)
+        character.name = new_name
+        self.characters[new_name] = character
+        if self.current_character_name == old_name:
+            self.current_character_name = new_name
+        self.mark_dirty("ren", old_name, new_name)
+        return True
 
     def get_current_character_info(self) -> CharacterInfo or None:
         if self.current_character_name is None:
@@ -127,82 +360,503 @@ class UserInfo:
     def remove_character(self, character_name: str) -> None:
         if self.current_character_name == character_name:
             self.current_character_name = None
+            self.mark_dirty("u", {"current_character_name": None})
         if character_name in self.characters:
-            del self.characters[character_name]
+            self.characters.pop(character_name).owner = None
+            self.mark_dirty("del", character_name)
+
+
+@dataclass
+class SaveStats:
+    """
+    一轮保存的统计
+    """
+    # 写入的用户数
+    written: int = 0
+    # 未修改而跳过的用户数
+    skipped: int = 0
+    # 保存失败的用户数
+    failed: int = 0
 
 
 class UserInfoStore:
     """
     用户信息管理类
-    维护用户信息字典，定期保存到文件并清理长时间未使用的用户信息
+    按最近使用顺序（LRU）缓存用户信息，超过数量或估算内存上限时淘汰最久未使用的用户，有修改的用户淘汰前先保存
+    所有对用户字典的访问都在事件循环中进行，保存时在事件循环中生成快照，序列化与磁盘读写交给线程池
     """
-    user_dict: dict[int, UserInfo] = {}
-    last_access_time: dict[int, float] = {}
+    user_dict: OrderedDict[int, UserInfo]
     running: bool
-    clean_thread: Thread
 
-    def __init__(self) -> None:
-        # 清理线程运行标志
+    def __init__(self, save_interval: float = 60, max_users: int = 10000,
+                 max_bytes: int = 64 * 1024 * 1024) -> None:
+        # 按访问顺序排列，最久未使用的在最前面
+        self.user_dict = OrderedDict()
+        # 缓存中各用户的估算内存大小及总和
+        self.user_sizes: dict[int, int] = {}
+        self.total_bytes = 0
+        # 已被淘汰但修改尚未保存的用户，保存完成前再次访问时直接放回缓存
+        self.pending_writes: dict[int, UserInfo] = {}
+        self.flushing = False
+        # 正在读取的用户
+        self.loading: dict[int, asyncio.Future] = {}
+        # 保存间隔（秒）
+        self.save_interval = save_interval
+        # 缓存的最大用户数与估算内存上限（字节）
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        # 正常退出时写入最近活跃用户的快照文件，下次启动时用于预热缓存，为 None 时不写入
+        self.snapshot_path: str or None = None
         self.running = True
-        # 启动后台清理线程
-        self.clean_thread = Thread(target=self._clean_save_loop, daemon=True)
-        self.clean_thread.start()
 
-    def get_user(self, user_id: int, nickname: str) -> UserInfo:
+    def _touch(self, user: UserInfo) -> None:
         """
-        获取用户信息，如果不存在则创建新用户
-        更新用户的最后访问时间
+        将用户标记为最近使用并更新其估算大小，必要时淘汰最久未使用的用户
         """
-        if user_id not in self.user_dict:
-            user = UserInfo(user_id, nickname)
-            user.sync_from_file()
-            self.user_dict[user_id] = user
-            self.last_access_time[user_id] = time.time()
+        user_id = user.user_id
+        if user_id in self.user_dict:
+            self.user_dict.move_to_end(user_id)
         else:
-            user = self.user_dict[user_id]
-            self.last_access_time[user_id] = time.time()
+            self.user_dict[user_id] = user
+        size = user.approximate_size()
+        self.total_bytes += size - self.user_sizes.get(user_id, 0)
+        self.user_sizes[user_id] = size
+        self._evict()
+
+    def _evict(self) -> None:
+        # 至少保留最近使用的一个用户
+        while len(self.user_dict) > 1 and (len(self.user_dict) > self.max_users or self.total_bytes > self.max_bytes):
+            user_id, user = self.user_dict.popitem(last=False)
+            self.total_bytes -= self.user_sizes.pop(user_id)
+            if user.is_dirty():
+                self.pending_writes[user_id] = user
+        if self.pending_writes and not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self._flush_pending_writes())
+
+    async def _flush_pending_writes(self) -> None:
+        """
+        保存被淘汰的有修改的用户
+        """
+        try:
+            while self.pending_writes:
+                stats = SaveStats()
+                users = list(self.pending_writes.values())
+                batch, versions = self._snapshot(users, stats)
+                saved_ids = await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+                self._finish_save(stats, batch, versions, saved_ids, None)
+                if not saved_ids:
+                    # 保存失败时留给定期保存重试
+                    break
+        finally:
+            self.flushing = False
+
+    def _cached(self, user_id: int) -> UserInfo or None:
+        user = self.user_dict.get(user_id)
+        if user is None:
+            user = self.pending_writes.pop(user_id, None)
+            if user is not None:
+                self._touch(user)
         return user
 
-    def save_all_users(self) -> None:
+    async def _load_user_data(self, user_id: int) -> dict:
+        """
+        在线程池中读取用户数据，同一用户同时只会有一次读取，并发的请求共享同一个结果
+        """
+        future = self.loading.get(user_id)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, get_storage().load_user, user_id)
+            self.loading[user_id] = future
+            future.add_done_callback(lambda _: self.loading.pop(user_id, None))
+        # 某个等待者被取消时不影响其他等待同一读取的协程
+        return await asyncio.shield(future)
+
+    async def get_user(self, user_id: int, nickname: str) -> UserInfo:
+        """
+        获取用户信息，如果不存在则创建新用户
+        并将用户标记为最近使用
+        """
+        user = self._cached(user_id)
+        if user is None:
+            data = await self._load_user_data(user_id)
+            # 等待读取期间可能已由其他协程创建
+            user = self._cached(user_id)
+            if user is None:
+                user = UserInfo(user_id, nickname)
+                user.load_dict(data)
+        self._touch(user)
+        return user
+
+    def prefetch(self, user_id: int, nickname: str) -> None:
+        """
+        在解析指令前提前开始读取用户信息，使读取与消息解析并行
+        """
+        if user_id in self.user_dict or user_id in self.pending_writes or user_id in self.loading:
+            return
+        task = asyncio.ensure_future(self.get_user(user_id, nickname))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or logging.error(
+            f"预读用户 {user_id} 时出错: {t.exception()}"))
+
+    async def get_users(self, user_ids: list[int]) -> dict[int, UserInfo]:
         """
-        将所有用户信息保存到文件
+        批量获取已存在的用户信息，不在缓存中的用户并发读取
+        没有任何记录的用户不会被创建，也不会出现在结果中
         """
-        for user in self.user_dict.values():
+        user_ids = list(dict.fromkeys(user_ids))
+        missing = [user_id for user_id in user_ids if self._cached(user_id) is None]
+        loaded = await asyncio.gather(*(self._load_user_data(user_id) for user_id in missing))
+        users: dict[int, UserInfo] = {}
+        for user_id, data in zip(missing, loaded):
+            if data and self._cached(user_id) is None:
+                user = UserInfo(user_id, str(user_id))
+                user.load_dict(data)
+                users[user_id] = user
+        for user_id in user_ids:
+            user = users.get(user_id) or self._cached(user_id)
+            if user is not None:
+                users[user_id] = user
+                self._touch(user)
+        return {user_id: users[user_id] for user_id in user_ids if user_id in users}
+
+    def _snapshot(self, users: list[UserInfo], stats: SaveStats) -> tuple[dict[int, dict], dict[int, int]]:
+        """
+        生成有修改的用户的数据快照及对应的修改计数，快照与缓存中的对象不共享可变数据
+        单个用户生成快照失败只影响该用户
+        """
+        batch: dict[int, dict] = {}
+        versions: dict[int, int] = {}
+        for user in users:
+            if not user.is_dirty():
+                stats.skipped += 1
+                continue
             try:
-                user.sync_to_file()
+                batch[user.user_id] = user.to_dict()
+                versions[user.user_id] = user.version
             except Exception as e:
-                logging.error(f"保存用户 {user} 时出错: {e}")
-
-    def _clean_save_loop(self) -> None:
+                stats.failed += 1
+                logging.error(f"生成用户 {user.user_id} 的快照时出错: {e}")
+        return batch, versions
+
+    @staticmethod
+    def _write(batch: dict[int, dict]) -> list[int]:
+        if not batch:
+            return []
+        try:
+            return get_storage().save_users(batch)
+        except Exception as e:
+            logging.error(f"保存 {len(batch)} 个用户时出错: {e}")
+            return []
+
+    def _finish_save(self, stats: SaveStats, batch: dict[int, dict], versions: dict[int, int],
+                     saved_ids: list[int], sealed: list[str] or None) -> SaveStats:
+        for user_id in saved_ids:
+            user = self.user_dict.get(user_id) or self.pending_writes.get(user_id)
+            if user is not None:
+                user.saved_version = versions[user_id]
+            if user_id in self.pending_writes and not self.pending_writes[user_id].is_dirty():
+                del self.pending_writes[user_id]
+        stats.written += len(saved_ids)
+        stats.failed += len(batch) - len(saved_ids)
+        journal = get_journal()
+        if journal is not None and sealed is not None and stats.failed == 0:
+            journal.discard(sealed)
+        if stats.failed:
+            failed_ids = [user_id for user_id in batch if user_id not in set(saved_ids)]
+            logging.error(f"有 {stats.failed} 个用户保存失败，将在下一轮重试: {failed_ids[:20]}")
+        if stats.written or stats.failed:
+            logging.info(f"保存用户信息: 写入 {stats.written}，跳过 {stats.skipped}，失败 {stats.failed}")
+        return stats
+
+    def _all_users(self) -> list[UserInfo]:
+        return [*self.user_dict.values(), *self.pending_writes.values()]
+
+    def save_all_users(self) -> SaveStats:
         """
-        后台清理循环，定期检查并清理长时间未访问的用户信息
+        同步保存有修改的用户信息，用于退出时等事件循环不可用的场合
         """
-        while self.running:
-            time.sleep(60)  # 每20秒检查一次
-            self.save_all_users()
-            self._clean_expired_users()
+        stats = SaveStats()
+        # 先切换日志段，本轮保存成功后之前日志段中的修改都已包含在存储中
+        journal = get_journal()
+        sealed = journal.rotate() if journal is not None else []
+        batch, versions = self._snapshot(self._all_users(), stats)
+        return self._finish_save(stats, batch, versions, self._write(batch), sealed)
+
+    async def save_all_users_async(self) -> SaveStats:
+        """
+        将有修改的用户信息保存到存储，未修改的用户直接跳过
+        快照在事件循环中生成，写入在线程池中执行，写入期间的新修改会留到下一轮保存
+        同一轮的写入作为一个批次提交（SQLite 为一个事务，JSON 统一刷入目录项）
+        """
+        loop = asyncio.get_running_loop()
+        stats = SaveStats()
+        journal = get_journal()
+        sealed = await loop.run_in_executor(None, journal.rotate) if journal is not None else []
+        batch, versions = self._snapshot(self._all_users(), stats)
+        saved_ids = await loop.run_in_executor(None, self._write, batch)
+        self._finish_save(stats, batch, versions, saved_ids, sealed)
+        # 有修改的用户大小可能已变化，重新估算后按上限淘汰
+        for user_id in batch:
+            user = self.user_dict.get(user_id)
+            if user is not None:
+                size = user.approximate_size()
+                self.total_bytes += size - self.user_sizes[user_id]
+                self.user_sizes[user_id] = size
+        self._evict()
+        return stats
+
+    def recover(self, journal_directory: str) -> int:
+        """
+        重放上次运行遗留的修改日志并保存受影响的用户，全部保存成功后删除这些日志
+        保存失败的用户作为待保存的用户留在缓存中，由之后的定期保存重试，重试成功前日志不会被删除
+        需要在打开修改日志之前调用
 
-    def _clean_expired_users(self) -> None:
+        Returns:
+            int: 重放的用户数
         """
-        清理超过1小时未访问的用户信息
+        segments = list_segments(journal_directory)
+        users: dict[int, UserInfo] = {}
+        for record in read_records(segments):
+            user = users.get(record[0])
+            if user is None:
+                # 昵称未知时留空，用户下次发言时由 get_user 填入
+                user = UserInfo(record[0], None)
+                user.sync_from_file()
+                users[record[0]] = user
+            user.apply_record(record[1:])
+        saved_ids = self._write({user_id: user.to_dict() for user_id, user in users.items()})
+        if len(saved_ids) < len(users):
+            saved = set(saved_ids)
+            for user_id, user in users.items():
+                if user_id in saved:
+                    continue
+                if user.nickname is None:
+                    user.nickname = str(user_id)
+                self.pending_writes[user_id] = user
+            logging.error(f"恢复修改日志时有 {len(users) - len(saved_ids)} 个用户保存失败，保留日志并在定期保存时重试")
+            return len(users)
+        for segment in segments:
+            os.remove(segment)
+        if users:
+            logging.info(f"从修改日志恢复了 {len(users)} 个用户")
+        return len(users)
+
+    def load_snapshot(self) -> int:
         """
-        current_time = time.time()
-        expired_users = []
+        从上次正常退出时写入的快照一次性载入最近活跃的用户
 
-        # 找出超过一段时间未访问的用户
-        for user_id, last_access in self.last_access_time.items():
-            if current_time - last_access > 3600:  # 3600秒
-                expired_users.append(user_id)
+        Returns:
+            int: 载入的用户数
+        """
+        if self.snapshot_path is None:
+            return 0
+        try:
+            entries = read_snapshot(self.snapshot_path)
+        except Exception as e:
+            logging.error(f"读取用户快照 {self.snapshot_path} 时出错: {e}")
+            return 0
+        loaded = 0
+        # 快照按最近使用顺序排列，依次放入缓存后顺序保持不变
+        for user_id, data in entries:
+            if user_id in self.user_dict:
+                continue
+            user = UserInfo(user_id, str(user_id))
+            user.load_dict(data)
+            self._touch(user)
+            loaded += 1
+        if loaded:
+            logging.info(f"从快照载入了 {loaded} 个用户")
+        return loaded
+
+    def write_snapshot(self) -> bool:
+        """
+        将缓存中最近使用的用户写入快照文件，只应在所有修改都已保存后调用
+        """
+        if self.snapshot_path is None:
+            return False
+        users = list(self.user_dict.values())[-SNAPSHOT_USERS:]
+        return write_snapshot(self.snapshot_path, [(user.user_id, user.to_dict()) for user in users])
 
-        # 保存并移除过期用户
-        for user_id in expired_users:
-            del self.user_dict[user_id]
-            del self.last_access_time[user_id]
+    async def run(self) -> None:
+        """
+        在事件循环中定期保存有修改的用户
+        """
+        while self.running:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save_all_users_async()
+            except Exception as e:
+                logging.error(f"保存用户信息时出错: {e}")
 
     def stop(self) -> None:
         """
-        停止清理线程并保存所有用户数据
+        停止定期保存并保存所有用户数据
         """
         self.running = False
-        self.save_all_users()
+        stats = self.save_all_users()
+        # 有用户未保存成功时快照可能比存储更新，此时不写快照
+        if stats.failed == 0 and self.write_snapshot():
+            logging.info(f"已写入用户快照 {self.snapshot_path}")
         logging.info(f"用户信息存储已关闭")
+
+
+class TestUserInfoStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        configure_storage(f"json:{self.directory}")
+
+    def tearDown(self):
+        configure_storage("json")
+        shutil.rmtree(self.directory)
+
+    def block_writes(self) -> tuple[threading.Event, threading.Event]:
+        """
+        让存储的写入等待 release 后再执行，返回 (started, release)
+        """
+        storage = get_storage()
+        save_users = storage.save_users
+        started, release = threading.Event(), threading.Event()
+
+        def blocked(users):
+            started.set()
+            release.wait(5)
+            return save_users(users)
+
+        storage.save_users = blocked
+        return started, release
+
+    @staticmethod
+    async def wait_flushed(store: UserInfoStore) -> None:
+        while store.flushing:
+            await asyncio.sleep(0.001)
+
+    def test_count_limit_evicts_least_recently_used(self):
+        """测试超过数量上限时淘汰最久未使用的用户，未修改的用户直接丢弃"""
+        async def run():
+            store = UserInfoStore(max_users=2)
+            await store.get_user(1, "a")
+            await store.get_user(2, "b")
+            await store.get_user(1, "a")
+            await store.get_user(3, "c")
+            self.assertEqual([1, 3], list(store.user_dict))
+            self.assertEqual({}, store.pending_writes)
+            self.assertEqual(sum(store.user_sizes.values()), store.total_bytes)
+
+        asyncio.run(run())
+
+    def test_byte_limit(self):
+        """测试超过估算内存上限时淘汰用户，角色越多估算越大"""
+        async def run():
+            # 三个没有角色的用户放得下
+            store = UserInfoStore(max_bytes=USER_BASE_SIZE * 3 + CHARACTER_BASE_SIZE - 1)
+            big = await store.get_user(1, "a")
+            big.set_current_character("甲")
+            # 估算大小在访问时更新
+            await store.get_user(1, "a")
+            await store.get_user(2, "b")
+            self.assertEqual([1, 2], list(store.user_dict))
+            # 用户 1 有一个角色，加上用户 3 后超过上限
+            await store.get_user(3, "c")
+            self.assertEqual([2, 3], list(store.user_dict))
+            self.assertEqual(USER_BASE_SIZE * 2, store.total_bytes)
+            await self.wait_flushed(store)
+
+        asyncio.run(run())
+
+    def test_dirty_user_written_on_eviction(self):
+        """测试有修改的用户被淘汰后保存到存储，并从待保存列表中移除"""
+        async def run():
+            store = UserInfoStore(max_users=1)
+            user = await store.get_user(1, "a")
+            user.increase_points(5)
+            await store.get_user(2, "b")
+            self.assertIn(1, store.pending_writes)
+            await self.wait_flushed(store)
+            self.assertEqual({}, store.pending_writes)
+            self.assertFalse(user.is_dirty())
+            self.assertEqual(5, get_storage().load_user(1)["points"])
+
+        asyncio.run(run())
+
+    def test_refetch_during_pending_write(self):
+        """测试被淘汰的用户写入期间再次访问时取回同一对象，写入期间的修改不会丢失"""
+        async def run():
+            store = UserInfoStore(max_users=1)
+            started, release = self.block_writes()
+            user = await store.get_user(1, "a")
+            user.increase_points(5)
+            await store.get_user(2, "b")
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            again = await store.get_user(1, "a")
+            self.assertIs(user, again)
+            self.assertNotIn(1, store.pending_writes)
+            again.increase_points(1)
+            release.set()
+            await self.wait_flushed(store)
+            # 写入的是修改前的快照，之后的修改仍需保存
+            self.assertEqual(5, get_storage().load_user(1)["points"])
+            self.assertTrue(again.is_dirty())
+            self.assertEqual(1, (await store.save_all_users_async()).written)
+            self.assertEqual(6, get_storage().load_user(1)["points"])
+
+        asyncio.run(run())
+
+    def test_unmodified_users_skipped(self):
+        """测试只保存有修改的用户，保存成功后不再重复写入"""
+        async def run():
+            store = UserInfoStore()
+            first = await store.get_user(1, "a")
+            await store.get_user(2, "b")
+            first.set_nickname("甲")
+            stats = store.save_all_users()
+            self.assertEqual((1, 1, 0), (stats.written, stats.skipped, stats.failed))
+            self.assertEqual({}, get_storage().load_user(2))
+            stats = store.save_all_users()
+            self.assertEqual((0, 2), (stats.written, stats.skipped))
+            # 角色的修改同样使用户需要保存
+            first.set_current_character("乙")
+            first.get_current_character_info().set_skill_value("侦查", 60)
+            self.assertEqual(1, (await store.save_all_users_async()).written)
+            self.assertEqual({"侦查": 60}, get_storage().load_user(1)["characters"]["乙"]["skills"])
+
+        asyncio.run(run())
+
+    def test_change_during_write_stays_dirty(self):
+        """测试写入期间的修改不会被标记为已保存，下一轮保存写入新值"""
+        async def run():
+            store = UserInfoStore()
+            started, release = self.block_writes()
+            user = await store.get_user(1, "a")
+            user.increase_points(1)
+            save = asyncio.ensure_future(store.save_all_users_async())
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            user.increase_points(1)
+            release.set()
+            self.assertEqual(1, (await save).written)
+            self.assertEqual(1, get_storage().load_user(1)["points"])
+            self.assertTrue(user.is_dirty())
+            self.assertEqual(1, (await store.save_all_users_async()).written)
+            self.assertEqual(2, get_storage().load_user(1)["points"])
+            self.assertFalse(user.is_dirty())
+
+        asyncio.run(run())
+
+    def test_async_save_evicts_after_growth(self):
+        """测试定期保存后按重新估算的大小淘汰用户"""
+        async def run():
+            store = UserInfoStore(max_bytes=USER_BASE_SIZE * 2 + CHARACTER_BASE_SIZE)
+            first = await store.get_user(1, "a")
+            first.increase_points(1)
+            second = await store.get_user(2, "b")
+            for name in ("甲", "乙"):
+                second.set_current_character(name)
+            stats = await store.save_all_users_async()
+            self.assertEqual(2, stats.written)
+            self.assertEqual([2], list(store.user_dict))
+            self.assertEqual({}, store.pending_writes)
+            await self.wait_flushed(store)
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()